@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+"""
+Module: Adlibre DMS File Upload Client benchmark
+Project: Adlibre DMS File Upload Client
+Copyright: Adlibre Pty Ltd 2012
+License: See LICENSE for license information
+
+Measures upload performance of dms_client.py against the local mock DMS server (mock_dms_server.py).
+Runs offline, on synthetic directory trees generated from a fixed seed, so results of
+different client versions can be compared.
+
+For every scenario and client mode reports files/s and MB/s of files the server stored,
+p50/p99 of upload request latency (as seen by the server, from request line to response sent),
+CPU time per GB uploaded and peak RSS of the client process.
+Results are printed and written as json.
+
+Usage:
+    python benchmark.py
+    python benchmark.py -s small,deep -m threads,async --latency 0.01 -o results.json
+    python benchmark.py --compare results.json
+"""
+
+import json
+import optparse
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import mock_dms_server
+
+
+PROJECT_PATH = os.path.dirname(os.path.abspath(__file__))
+CLIENT_PATH = os.path.join(PROJECT_PATH, 'dms_client.py')
+RESULTS_VERSION = 1
+DATA_SEED = 2012
+DATA_BLOCK_SIZE = 64 * 1024
+FILE_TYPE = 'pdf'
+
+# Synthetic directory trees: (number of files, file size in bytes, directories nesting depth, files per directory)
+SCENARIOS = {
+    'small': (2000, 4 * 1024, 1, 100),
+    'huge': (4, 64 * 1024 * 1024, 1, 4),
+    'deep': (500, 16 * 1024, 25, 20),
+}
+DEFAULT_SCENARIOS = 'small,huge,deep'
+# Client command line options of benchmarked modes
+MODES = {
+    'single': ['-workers', '1'],
+    'threads': ['-workers', '8'],
+    'async': ['-async', '-async_concurrency', '50'],
+}
+DEFAULT_MODES = 'single,threads,async'
+CLIENT_CONFIG = '''[main]
+user=benchmark
+pass=benchmark
+url=api/file/
+host=%(host)s
+API_FILEINFO_LOCATION=api/revision_count/
+file_type=%(file_type)s
+config_retry_on_errors=yes
+retry_base_delay=0.1
+'''
+
+
+def generate_tree(directory, files, size, depth, per_directory):
+    """Writes synthetic files tree. Content is the same for the same arguments."""
+    rnd = random.Random(DATA_SEED)
+    block = ''.join(chr(rnd.randint(0, 255)) for i in xrange(DATA_BLOCK_SIZE))
+    for number in xrange(files):
+        group = number // per_directory
+        # Nesting directories of a group one into another down to the depth
+        parts = ['d%s' % group] + ['n%s' % level for level in range(depth - 1)]
+        path = os.path.join(directory, *parts)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        data_file = open(os.path.join(path, 'BENCH%06d.%s' % (number, FILE_TYPE)), 'wb')
+        try:
+            header = 'file %s\n' % number
+            data_file.write(header)
+            left = size - len(header)
+            while left > 0:
+                data_file.write(block[:left])
+                left -= len(block[:left])
+        finally:
+            data_file.close()
+
+
+def percentile(values, share):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * share), len(values) - 1)]
+
+
+def run_client(work_dir, config_path, data_dir, args):
+    """Runs client process. Returns (exit code, seconds, CPU seconds or None, peak RSS in KB or None)."""
+    command = [sys.executable, CLIENT_PATH, '-config', config_path, '-dir', data_dir, '-s'] + args
+    output = open(os.path.join(work_dir, 'client.out'), 'ab')
+    try:
+        started = time.time()
+        process = subprocess.Popen(command, cwd=work_dir, stdout=output, stderr=subprocess.STDOUT)
+        if hasattr(os, 'wait4'):
+            # Resource usage of this very process, not of all the children
+            pid, status, usage = os.wait4(process.pid, 0)
+            seconds = time.time() - started
+            process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+            peak_rss = usage.ru_maxrss
+            if sys.platform == 'darwin':
+                peak_rss //= 1024
+            return process.returncode, seconds, usage.ru_utime + usage.ru_stime, peak_rss
+        process.wait()
+        return process.returncode, time.time() - started, None, None
+    finally:
+        output.close()
+
+
+def run_benchmark(options):
+    server_options = mock_dms_server.parse_options([
+        '--port', '0',
+        '--latency', str(options.latency),
+        '--error-rate', str(options.error_rate),
+        '--bandwidth', str(options.bandwidth),
+        '--retry-after', '0',
+    ])
+    server = mock_dms_server.DMSServer(('127.0.0.1', 0), server_options)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    host = 'http://127.0.0.1:%s/' % server.server_address[1]
+
+    work_dir = tempfile.mkdtemp(prefix='dms_benchmark_')
+    config_path = os.path.join(work_dir, 'benchmark.cfg')
+    config_file = open(config_path, 'w')
+    config_file.write(CLIENT_CONFIG % {'host': host, 'file_type': FILE_TYPE})
+    config_file.close()
+
+    results = []
+    try:
+        for scenario in options.scenarios.split(','):
+            files, size, depth, per_directory = SCENARIOS[scenario]
+            files = max(int(files * options.scale), 1)
+            data_dir = os.path.join(work_dir, scenario)
+            generate_tree(data_dir, files, size, depth, per_directory)
+            for mode in options.modes.split(','):
+                for repeat in range(options.repeat):
+                    server.state.reset_stats()
+                    exit_code, seconds, cpu_seconds, peak_rss = run_client(
+                        work_dir, config_path, data_dir, MODES[mode] + options.client_args.split()
+                    )
+                    state = server.state
+                    # Throughput counts files stored, so a run stopped early does not look fast
+                    stored = state.stored
+                    result = {
+                        'scenario': scenario,
+                        'mode': mode,
+                        'repeat': repeat + 1,
+                        'files': files,
+                        'bytes': files * size,
+                        'stored': stored,
+                        'exit_code': exit_code,
+                        'seconds': round(seconds, 3),
+                        'files_per_second': round(stored / seconds, 2),
+                        'mb_per_second': round(stored * size / seconds / 1024 / 1024, 2),
+                        'requests': len(state.latencies),
+                        'errors': state.errors,
+                        'latency_p50': percentile(state.latencies, 0.5),
+                        'latency_p99': percentile(state.latencies, 0.99),
+                        'cpu_seconds': cpu_seconds,
+                        'cpu_seconds_per_gb': round(cpu_seconds / (stored * size / 1024.0 ** 3), 3)
+                        if cpu_seconds and stored else None,
+                        'peak_rss_kb': peak_rss,
+                    }
+                    results.append(result)
+                    print_result(result)
+            shutil.rmtree(data_dir)
+    finally:
+        server.shutdown()
+        server.server_close()
+        if options.keep:
+            print 'Work directory kept: %s' % work_dir
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        'version': RESULTS_VERSION,
+        'client_version': get_client_version(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {
+            'scale': options.scale,
+            'latency': options.latency,
+            'error_rate': options.error_rate,
+            'bandwidth': options.bandwidth,
+            'client_args': options.client_args,
+        },
+        'results': results,
+    }
+
+
+def get_client_version():
+    for line in open(CLIENT_PATH):
+        if line.startswith('__version__'):
+            return line.split('=', 1)[1].strip().strip('\'"')
+    return None
+
+
+def format_ms(seconds):
+    if seconds is None:
+        return '-'
+    return '%.1fms' % (seconds * 1000)
+
+
+def print_result(result):
+    print '%-6s %-8s #%s: %8.2f files/s %8.2f MB/s  p50 %8s  p99 %8s  cpu %6s s/GB  rss %6s KB  exit %s' % (
+        result['scenario'],
+        result['mode'],
+        result['repeat'],
+        result['files_per_second'],
+        result['mb_per_second'],
+        format_ms(result['latency_p50']),
+        format_ms(result['latency_p99']),
+        result['cpu_seconds_per_gb'],
+        result['peak_rss_kb'],
+        result['exit_code'],
+    )
+
+
+def compare(report, baseline):
+    """Prints change of throughput and memory against results of another run.
+
+    Runs failed (client exit code other than 0) are not compared."""
+    def best(results):
+        runs = {}
+        for result in results:
+            if result['exit_code']:
+                continue
+            key = (result['scenario'], result['mode'])
+            if key not in runs or result['files_per_second'] > runs[key]['files_per_second']:
+                runs[key] = result
+        return runs
+
+    before = best(baseline['results'])
+    after = best(report['results'])
+    print 'Compared to client %s of %s:' % (baseline.get('client_version'), baseline.get('time'))
+    for key in sorted(after):
+        if key not in before:
+            continue
+        old, new = before[key], after[key]
+        print '%-6s %-8s files/s %+7.1f%%  cpu/GB %s  rss %s' % (
+            key[0],
+            key[1],
+            100.0 * (new['files_per_second'] - old['files_per_second']) / max(old['files_per_second'], 0.01),
+            '%+.1f%%' % (100.0 * (new['cpu_seconds_per_gb'] - old['cpu_seconds_per_gb']) / old['cpu_seconds_per_gb'])
+            if new.get('cpu_seconds_per_gb') and old.get('cpu_seconds_per_gb') else '-',
+            '%+.1f%%' % (100.0 * (new['peak_rss_kb'] - old['peak_rss_kb']) / max(old['peak_rss_kb'], 1))
+            if new['peak_rss_kb'] and old['peak_rss_kb'] else '-',
+        )
+
+
+def parse_options(argv):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-s', '--scenarios', default=DEFAULT_SCENARIOS,
+                      help='comma separated of: %s' % ', '.join(sorted(SCENARIOS)))
+    parser.add_option('-m', '--modes', default=DEFAULT_MODES,
+                      help='comma separated client modes of: %s' % ', '.join(sorted(MODES)))
+    parser.add_option('--scale', type='float', default=1.0, help='multiplier of scenario files number')
+    parser.add_option('-r', '--repeat', type='int', default=1, help='runs of every scenario and mode')
+    parser.add_option('--latency', type='float', default=0.0, help='mock server API latency in seconds')
+    parser.add_option('--error-rate', type='float', default=0.0, help='share of uploads mock server fails, 0..1')
+    parser.add_option('--bandwidth', type='int', default=0, help='upload bytes per second of a connection')
+    parser.add_option('--client-args', default='', help='more client command line options')
+    parser.add_option('-o', '--output', help='json results file')
+    parser.add_option('--compare', help='json results file of another run to compare with')
+    parser.add_option('--keep', action='store_true', default=False, help='keep work directory with client logs')
+    options, args = parser.parse_args(argv)
+    for name, known in ((options.scenarios, SCENARIOS), (options.modes, MODES)):
+        for value in name.split(','):
+            if value not in known:
+                parser.error('unknown value: %s' % value)
+    return options
+
+
+if __name__ == '__main__':
+    options = parse_options(sys.argv[1:])
+    report = run_benchmark(options)
+    if options.output:
+        output = open(options.output, 'w')
+        json.dump(report, output, indent=2, sort_keys=True)
+        output.close()
+    else:
+        print json.dumps(report, indent=2, sort_keys=True)
+    if options.compare:
+        compare(report, json.load(open(options.compare)))
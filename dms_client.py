@@ -6,13 +6,51 @@ Copyright: Adlibre Pty Ltd 2012
 License: See LICENSE for license information
 """
 
+import urllib
 import urllib2
+import httplib
+import socket
+import select
+import threading
+import time
+import StringIO
+import Queue
+import SocketServer
+import asyncore
+import collections
+import errno
+import ssl
+import urlparse
+import hashlib
+import sqlite3
+import itertools
+import cPickle
+import ctypes
+import ctypes.util
+import struct
+import atexit
+import heapq
+import stat
+import fnmatch
+import re
+import random
+import email.utils
+import zlib
+import mmap
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # Python 2 backport of os.scandir()
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 import os
 import sys
 import json
 import mimetools
 import mimetypes
-import itertools
 import ConfigParser
 import datetime
 import base64
@@ -34,6 +72,59 @@ DEFAULT_CFG_OPTIONS = [
     'remove',
     'API_FILEINFO_LOCATION',
     'config_retry_on_errors',
+    'pool_size',
+    'pool_idle_timeout',
+    'workers',
+    'async_engine',
+    'async_concurrency',
+    'verify',
+    'verify_sample',
+    'dedup',
+    'dedup_remove',
+    'dedup_index',
+    'dedup_max_age',
+    'snapshot',
+    'watch',
+    'watch_settle',
+    'watch_interval',
+    'chunk_url',
+    'chunk_size',
+    'chunk_threshold',
+    'log_format',
+    'log_flush_interval',
+    'log_flush_size',
+    'retry_max_attempts',
+    'retry_base_delay',
+    'retry_max_delay',
+    'compress',
+    'compress_threshold',
+    'compress_level',
+    'compress_skip',
+    'metrics_file',
+    'metrics_format',
+    'metrics_interval',
+    'zero_copy',
+    'adaptive_concurrency',
+    'concurrency_min',
+    'concurrency_max',
+    'targets',
+    'batch_url',
+    'batch_files',
+    'batch_size',
+    'order',
+    'claim',
+    'claim_timeout',
+    'claim_dir',
+    'instance',
+    'shard',
+    'agent_socket',
+    'agent_wait',
+    'expect_threshold',
+    'expect_timeout',
+    'include',
+    'exclude',
+    'scan_threads',
+    'prefetch_budget',
 ]
 DEFAULT_API_LOCATION = 'api/file/'
 DEFAULT_USER_AGENT = 'Adlibre DMS API file uploader version: %s' % __version__
@@ -54,9 +145,135 @@ DEFAULT_ERROR_MESSAGES = {
     'no_proper_data': 'You have provided a directory instead of a file,\n' +
                       'reverse or target file/directory does not exist.\n' +
                       'Please recheck location in your config. Refer to -h for help.',
-    'no_file': 'File does not exist.'
+    'no_file': 'File does not exist.',
+    'no_number': 'Option %s [%s] must be a number, got: %s. Refer to -h for help.',
+    'no_workers': 'You should provide at least 1 upload worker. Refer to -h for help.',
+    'no_concurrency': 'You should allow at least 1 upload in flight. Refer to -h for help.',
+    'no_concurrency_range': 'Adaptive concurrency needs concurrency_max above concurrency_min. Refer to -h for help.',
+    'no_verify_mode': 'Unknown file uploaded check mode. Use one of: inline, pipeline, sample, end. Refer to -h for help.',
+    'no_log_format': 'Unknown log format. Use one of: text, json. Refer to -h for help.',
+    'no_metrics_format': 'Unknown metrics format. Use one of: prometheus, json. Refer to -h for help.',
+    'no_target': 'Fan-out target chapter %s is not found in config file. Refer to -h for help.',
+    'no_order': 'Unknown upload order. Use one of: scan, largest, smallest, oldest. Refer to -h for help.',
+    'no_claim': 'Unknown claim mode. Use one of: lease, rename. Refer to -h for help.',
+    'no_agent_socket': 'You should provide upload agent socket path with -agent_socket. Refer to -h for help.',
+    'no_agent_running': 'Another upload agent is listening on the socket already.',
+    'no_agent_dir': 'Upload agent takes files of the directories given with -dir only. Refer to -h for help.',
+    'no_agent_file': 'File is not in the directories upload agent takes files from.',
+    'no_rule': 'Wrong file name rule %s: %s. Refer to -h for help.',
+    'no_claim_roots': 'Rename claims can be used with one directory only. Refer to -h for help.',
+    'no_shard': 'Shard must be <number>/<count>, number from 0 to count - 1, e.g. 0/3. Refer to -h for help.',
 }
 UPLOAD_RETRIES_COUNT = 3
+DEFAULT_RETRY_BASE_DELAY = 1.0
+DEFAULT_RETRY_MAX_DELAY = 60.0
+DEFAULT_COMPRESS_THRESHOLD = 64 * 1024
+DEFAULT_COMPRESS_LEVEL = 6
+# Already compressed file formats
+DEFAULT_COMPRESS_SKIP = 'zip,gz,tgz,bz2,xz,7z,rar,jpg,jpeg,png,gif,mp3,mp4,docx,xlsx,pptx,odt,ods'
+# zlib window bits value producing gzip header and trailer
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+METRICS_FORMAT_PROMETHEUS = 'prometheus'
+METRICS_FORMAT_JSON = 'json'
+METRICS_FORMATS = (METRICS_FORMAT_PROMETHEUS, METRICS_FORMAT_JSON)
+METRICS_PREFIX = 'dms_client_'
+DEFAULT_METRICS_INTERVAL = 60
+SENDFILE_BLOCK_SIZE = 8 * 1024 * 1024
+DEFAULT_CONCURRENCY_MIN = 1
+DEFAULT_CONCURRENCY_MAX = 16
+CONCURRENCY_DECREASE_FACTOR = 0.5
+CONCURRENCY_LATENCY_TOLERANCE = 1.5
+CONCURRENCY_BASELINE_DRIFT = 1.05
+CONCURRENCY_LATENCY_SIZE_UNIT = 1024 * 1024
+# libc sendfile() function, False when not available, None before first use
+SENDFILE = None
+MULTIPART_CHUNK_SIZE = 64 * 1024
+DEFAULT_POOL_SIZE = 4
+DEFAULT_EXPECT_THRESHOLD = 1024 * 1024
+DEFAULT_EXPECT_TIMEOUT = 1.0
+# Seconds hosts not answering to 'Expect: 100-continue' get bodies without waiting
+EXPECT_IGNORE_TIME = 300
+DEFAULT_POOL_IDLE_TIMEOUT = 30
+DEFAULT_WORKERS = 1
+UPLOAD_QUEUE_FACTOR = 2
+UPLOAD_QUEUE_TIMEOUT = 0.5
+LOG_LOCK = threading.RLock()
+LOG_FORMAT_TEXT = 'text'
+LOG_FORMAT_JSON = 'json'
+LOG_FORMATS = (LOG_FORMAT_TEXT, LOG_FORMAT_JSON)
+LOG_RECORD_LINE = '\n-----------------------------------------------------------------------------\n'
+DEFAULT_LOG_FLUSH_INTERVAL = 1.0
+DEFAULT_LOG_FLUSH_SIZE = 64 * 1024
+LOG_SETTINGS = {
+    'log_format': LOG_FORMAT_TEXT,
+    'flush_interval': DEFAULT_LOG_FLUSH_INTERVAL,
+    'flush_size': DEFAULT_LOG_FLUSH_SIZE,
+}
+LOG_SINKS = {}
+DEFAULT_ASYNC_CONCURRENCY = 100
+DEFAULT_ASYNC_TIMEOUT = 300
+ASYNC_LOOP_TIMEOUT = 1.0
+ASYNC_RECV_SIZE = 64 * 1024
+VERIFY_INLINE = 'inline'
+VERIFY_PIPELINE = 'pipeline'
+VERIFY_SAMPLE = 'sample'
+VERIFY_END = 'end'
+VERIFY_MODES = [VERIFY_INLINE, VERIFY_PIPELINE, VERIFY_SAMPLE, VERIFY_END]
+DEFAULT_VERIFY_SAMPLE = 10
+VERIFY_WORKERS = 2
+VERIFY_QUEUE_SIZE = 1000
+DEDUP_INDEX_FILE = 'dms_client.sqlite'
+DEDUP_HASH = 'sha1'
+DEDUP_COMMIT_EVERY = 100
+CLAIM_LEASE = 'lease'
+CLAIM_RENAME = 'rename'
+CLAIM_MODES = [CLAIM_LEASE, CLAIM_RENAME]
+CLAIM_LEASE_SUFFIX = '.dms_lease'
+CLAIM_DIR = '.dms_claims'
+CLAIM_HEARTBEAT_FILE = '.alive'
+DEFAULT_CLAIM_TIMEOUT = 300
+# Owner and group of the agent may hand files to it
+AGENT_SOCKET_MODE = 0660
+UPLOAD_ORDER_SCAN = 'scan'
+UPLOAD_ORDER_LARGEST = 'largest'
+UPLOAD_ORDER_SMALLEST = 'smallest'
+UPLOAD_ORDER_OLDEST = 'oldest'
+UPLOAD_ORDERS = [UPLOAD_ORDER_SCAN, UPLOAD_ORDER_LARGEST, UPLOAD_ORDER_SMALLEST, UPLOAD_ORDER_OLDEST]
+DEFAULT_SCAN_THREADS = 1
+SCAN_QUEUE_SIZE = 1000
+MIMETYPE_AUTO = 'auto'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_MTIME_SLACK = 2
+DEFAULT_WATCH_SETTLE = 2
+DEFAULT_WATCH_INTERVAL = 5
+WATCH_CHECK_INTERVAL = 0.5
+# Linux inotify constants, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+INOTIFY_WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+INOTIFY_EVENT_SIZE = 16
+INOTIFY_READ_SIZE = 64 * 1024
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+DEFAULT_CHUNK_THRESHOLD = 64 * 1024 * 1024
+CHUNK_RETRIES_COUNT = 5
+CHUNK_NOT_SUPPORTED_CODES = (404, 405, 501)
+CHUNK_STATE_DIR = 'dms_client.chunks'
+DEFAULT_BATCH_FILES = 50
+DEFAULT_BATCH_SIZE = 1024 * 1024
+BATCH_NOT_SUPPORTED_CODES = (404, 405, 501)
+FANOUT_BLOCK_SIZE = 64 * 1024
+# Blocks of a file held in memory at most, while it is sent to several targets
+FANOUT_WINDOW_BLOCKS = 64
+DEFAULT_PREFETCH_BUDGET = 0
+# Files queued for every worker, to read ahead while uploads are in flight
+PREFETCH_QUEUE_FACTOR = 8
 
 help_text = """
 Command line Adlibre DMS file uploader utility.
@@ -118,6 +335,8 @@ Available options:
         e.g.(for windows): C:\scan\documents\adlibre\
 
         e.g.(for unix): ../../somedir/files/lie/into/
+        Several directories are separated with ';' on windows and ':' on unix,
+        e.g. /mnt/scans:/mnt/archive
     -user
     [user=your_user_name] in config
         DMS Username to access API
@@ -144,12 +363,315 @@ Available options:
         Default is set to 'pdf'
         This needs to be set up if you have provided a -dir setting.
         (In order to know files to scan in provided directory)
+        Several types are separated with commas, e.g. pdf,tif,jpg
     -mimetype
     [mimetype=application/pdf] in config
         mimetype of file to be sent. Default is: application/pdf
+        'auto' guesses it from the name of every file, for several file types.
     [config_retry_on_errors=yes] in config
         Either to retry upload of a file or just fail with error.
         Default retries count is 3.
+    -pool_size
+    [pool_size=4] in config
+        Number of idle keep-alive connections kept open per host.
+        Upload and file revisions check requests reuse them
+        instead of connecting to the server for every request.
+        At least one connection per upload worker is kept.
+        Default is 4.
+    -pool_idle_timeout
+    [pool_idle_timeout=30] in config
+        Seconds an unused keep-alive connection is kept open.
+        Default is 30.
+    -workers
+    [workers=1] in config
+        Number of files uploaded at the same time in directory mode.
+        Default is 1.
+    -async
+    [async_engine=yes] in config
+        Upload directory files on a single thread with asynchronous network engine,
+        instead of upload worker threads.
+        Suits very large directories, uploading hundreds of files at the same time.
+    -async_concurrency
+    [async_concurrency=100] in config
+        Number of files uploaded at the same time by asynchronous engine.
+        Default is 100.
+    -verify
+    [verify=inline] in config
+        When to check file revisions of uploaded files (with API_FILEINFO_LOCATION set) in directory mode:
+        inline - after every upload, before uploading next file (default)
+        pipeline - by separate checking threads, while uploads go on
+        sample - only every n-th file is checked, while uploads go on
+        end - all files are checked after all of them are uploaded
+        Files are logged as uploaded and removed only after the check succeeds.
+    -verify_sample
+    [verify_sample=10] in config
+        Check every n-th uploaded file in 'sample' verify mode.
+        Default is 10.
+    -dedup
+    [dedup=yes] in config
+        Skip files with content uploaded before.
+        Hashes of uploaded files content are stored in a local index file
+        and files with the same content are not sent to API again.
+    -dedup_remove
+    [dedup_remove=yes] in config
+        Delete files skipped as duplicates of uploaded ones.
+    -dedup_index
+    [dedup_index=dms_client.sqlite] in config
+        Deduplication index file location.
+        Default is 'dms_client.sqlite' next to 'dms_client.log'.
+    -dedup_max_age
+    [dedup_max_age=0] in config
+        Days to keep uploaded files in deduplication index, when compacting it.
+        Default is 0, keeping all of them.
+    -dedup_rebuild
+        Recreate deduplication index tables from stored records, dropping broken ones,
+        add content of files in the directory given with -dir (e.g. documents stored in DMS already)
+        as uploaded, and quit. Content indexed already keeps its record.
+    -dedup_compact
+        Remove records older then dedup_max_age days from deduplication index,
+        shrink the index file and quit.
+    -snapshot
+    [snapshot=dms_client.snapshot] in config
+        File to keep the scanned directory state in between runs.
+        With this set only files new or changed since the last run are uploaded,
+        and directories not changed since then are not read again.
+        Files failed to upload are tried again on the next run.
+        Note: files rewritten in place, without creating or renaming them, are not noticed.
+        Not used by default.
+    -full_scan
+        Read the whole directory ignoring the saved snapshot (a new one is saved).
+    -watch
+    [watch=yes] in config
+        Keep running and upload files as soon as they are written into the directory.
+        Files found in the directory at start are uploaded too.
+        Uses Linux inotify events, or reads the directory every watch_interval seconds on other systems.
+        Stop it with Ctrl+C.
+    -watch_settle
+    [watch_settle=2] in config
+        Seconds a file must stay unchanged to be uploaded in watch mode,
+        unless it was closed after writing or moved into the directory.
+        Default is 2.
+    -watch_interval
+    [watch_interval=5] in config
+        Seconds between directory reads in watch mode without inotify.
+        Default is 5.
+    -chunk_url
+    [chunk_url=api/chunked/] in config
+        Location of the chunked upload API at host.
+        Files of chunk_threshold bytes and larger are sent to it in resumable parts,
+        so a failed upload continues from the last stored part instead of the file start.
+        Progress is kept in the dms_client.chunks directory.
+        Falls back to ordinary upload if server has no such API.
+        Not used with -async and by default.
+    -chunk_size
+    [chunk_size=8388608] in config
+        Size of a chunked upload part in bytes.
+        Default is 8388608 (8 MB).
+    -chunk_threshold
+    [chunk_threshold=67108864] in config
+        Smallest file size in bytes to send in chunks.
+        Default is 67108864 (64 MB).
+    -log_format
+    [log_format=json] in config
+        Format of dms_client.log and error.txt records:
+        'text' blocks with date line or 'json' lines with time, level, message and file fields.
+        Default is 'text'.
+    -log_flush_interval
+    [log_flush_interval=1] in config
+        Seconds log records are kept in memory before they are written to log files.
+        0 writes every record at once.
+        Default is 1.
+    -log_flush_size
+    [log_flush_size=65536] in config
+        Bytes of log records kept in memory before they are written to log files.
+        Default is 65536.
+    -retry_max_attempts
+    [retry_max_attempts=3] in config
+        Upload attempts for a file with config_retry_on_errors=yes.
+        Failed files are put off and uploaded again later, not holding up other files.
+        Default is 3.
+    -retry_base_delay
+    [retry_base_delay=1] in config
+        Seconds to wait before the second upload attempt.
+        Delay is doubled with every next attempt, and randomly shortened up to a half.
+        Longer delay asked by server with Retry-After header is used instead.
+        Default is 1.
+    -retry_max_delay
+    [retry_max_delay=60] in config
+        Longest delay in seconds between upload attempts.
+        Default is 60.
+    -compress
+    [compress=yes] in config
+        Compress uploaded files with gzip on the fly (Content-Encoding: gzip).
+        Body is sent with chunked transfer encoding, so DMS web server must accept it.
+        Compression ratio is logged for every file and in total.
+        Not used by default.
+    -compress_threshold
+    [compress_threshold=65536] in config
+        Smallest file size in bytes to compress.
+        Default is 65536.
+    -compress_level
+    [compress_level=6] in config
+        gzip compression level from 1 (fastest) to 9 (smallest).
+        Default is 6.
+    -compress_skip
+    [compress_skip=zip,jpg,png] in config
+        Comma separated extensions of already compressed files to send as they are.
+        Default is: zip,gz,tgz,bz2,xz,7z,rar,jpg,jpeg,png,gif,mp3,mp4,docx,xlsx,pptx,odt,ods
+    -metrics_file
+    [metrics_file=dms_client.prom] in config
+        File to export upload metrics to: time spent in phases (scan, dedup, read, compress, send, verify)
+        and counters (bytes read and sent, files uploaded and failed, retries, verification failures,
+        connections opened and reused).
+        Written at exit, and every metrics_interval seconds while running.
+        Not used by default.
+    -metrics_format
+    [metrics_format=json] in config
+        'prometheus' text format (for node exporter textfile collector) or 'json'.
+        Default is 'prometheus'.
+    -metrics_interval
+    [metrics_interval=60] in config
+        Seconds between metrics file updates. 0 writes it only at exit.
+        Default is 60.
+    -zero_copy
+    [zero_copy=no] in config
+        Send files to plain http hosts straight from the file with sendfile() (on Linux),
+        or from memory mapped file, instead of reading them block by block.
+        Saves CPU on large files. Not used for https, compressed and async uploads.
+        Default is 'yes'.
+    -adaptive
+    [adaptive_concurrency=yes] in config
+        Change the number of uploads in flight to the server load.
+        Starting from concurrency_min, it is raised by one while upload latency stays flat,
+        and cut by half on timeouts, 5xx or 429 responses.
+        Changes are printed and logged.
+        Not used by default.
+    -concurrency_min
+    [concurrency_min=1] in config
+        Lowest number of uploads in flight with adaptive concurrency.
+        Default is 1.
+    -concurrency_max
+    [concurrency_max=16] in config
+        Highest number of uploads in flight with adaptive concurrency, must be above concurrency_min.
+        Default is the number of workers when more than one, 16 otherwise, or async_concurrency with -async.
+    -targets
+    [targets=main,dr] in config
+        Comma separated config file chapters to upload every file to, e.g. a primary and a DR DMS.
+        Every file is read once and sent to all the targets at the same time.
+        A chapter may set host, url, API_FILEINFO_LOCATION, user and pass of its target,
+        the ones it does not set and all other options are taken from the main options.
+        File is logged as uploaded and removed (with remove=yes) only after every target has confirmed it.
+        Failed uploads are retried only to the targets that failed.
+        Files are checked on targets right after upload, chunked upload, compression and -async are not used.
+        Not used by default.
+    -batch_url
+    [batch_url=api/files/] in config
+        Bulk upload API location (to be added to host url), to send many small files with one request.
+        Upload workers take small files waiting in the queue together, up to batch_files files
+        and batch_size bytes, and send them as one multipart form of several 'file' fields.
+        API must return json list of per file results in the order of the form,
+        {"file": "name", "code": "stored code"} or {"file": "name", "error": "text"}.
+        Files failed in a batch are sent one by one. If server has no such API, files are sent one by one.
+        Not used with -async and -targets. Not used by default.
+    -batch_files
+    [batch_files=50] in config
+        Highest number of files in a batch.
+        Default is 50.
+    -batch_size
+    [batch_size=1048576] in config
+        Highest size of a batch in bytes. Files of this size and larger are sent alone.
+        Default is 1048576 (1 MB).
+    -order
+    [order=largest] in config
+        Order to upload files of a directory in:
+            scan - as they are found, uploads start at once,
+            largest - largest files first, so the run does not end with one worker on a huge file,
+            smallest - smallest files first, for the most files uploaded soon,
+            oldest - least recently modified files first.
+        With an order other then 'scan' the whole directory is scanned before uploads start.
+        File sizes and times are the ones read while scanning. Not used with -watch.
+        Default is 'scan'.
+    -claim
+    [claim=lease] in config
+        Claim every file before uploading it, for several client instances (e.g. on several hosts)
+        uploading one shared directory. A file claimed by another instance is skipped.
+            lease - create '<file>.dms_lease' lease file next to the file, only if there is none,
+            rename - move the file into '<claim_dir>/<instance>/' in-progress directory.
+        Claims are refreshed while held. Claims not refreshed for claim_timeout seconds are left
+        by a stopped instance and are taken over. Files failed to upload are given back at exit.
+        Meant to be used with remove=yes, as files not removed are uploaded again by the next scan.
+        Clocks of the hosts and the file server should be in sync.
+        Not used by default.
+    -claim_timeout
+    [claim_timeout=300] in config
+        Seconds after which a claim not refreshed is taken over by other instances.
+        Default is 300.
+    -claim_dir
+    [claim_dir=/mnt/share/upload/.dms_claims] in config
+        In-progress directory of the rename claims. Must be on the same file system as the uploaded directory.
+        Default is '.dms_claims' in the uploaded directory.
+    -instance
+    [instance=node1] in config
+        Name of this client instance in claims, unique among instances.
+        Default is '<host name>-<process id>'.
+    -shard
+    [shard=0/3] in config
+        Upload only files of this shard, given as <number>/<count>, to split a directory between
+        count instances without claims contention. Each subdirectory goes to one shard, by hash of its path.
+        Not used by default.
+    -agent
+        Run as resident upload agent, taking files to upload over agent_socket Unix domain socket.
+        Config, connections and upload workers stay ready between files. Runs until stopped with Ctrl+C.
+        Files are uploaded with all the options set (retries, dedup, targets, etc).
+        Takes only files of the directories given with -dir matching file type and include/exclude rules,
+        so peers of the socket can not have other files uploaded or removed.
+    -agent_socket
+    [agent_socket=/var/run/dms_client.sock] in config
+        Unix domain socket of the upload agent. Owner and group of the agent may hand files to it.
+        With this option set, '-f <file>' hands the file to the agent running and returns at once,
+        or uploads it by itself if no agent is running.
+        Not used by default.
+    -wait
+    [agent_wait=yes] in config
+        With '-f <file>' handed to the agent, wait until the file is uploaded
+        and exit with error if it was not.
+        Not used by default.
+    -expect_threshold
+    [expect_threshold=1048576] in config
+        Request bodies of this size in bytes and larger are sent with 'Expect: 100-continue' header:
+        the body is sent only after server answers '100 Continue', so a large file is not sent in vain
+        when server rejects the request at once (e.g. for expired credentials).
+        Hosts not answering to it in expect_timeout seconds get bodies without waiting for 5 minutes,
+        then it is tried again.
+        Not used by -async uploads. 0 turns it off.
+        Default is 1048576 (1 MB).
+    -expect_timeout
+    [expect_timeout=1] in config
+        Seconds to wait for '100 Continue' before sending the body anyway.
+        Default is 1.
+    -include
+    [include=*.pdf,re:^scan_\d+\.tif$] in config
+        Comma separated rules of file names to upload, instead of file types.
+        Rules are shell-style wildcards, or regular expressions after 're:' prefix, searched in the name.
+        Default is not set (files of file types are uploaded).
+    -exclude
+    [exclude=~$*,*.tmp,*.error,tmp/] in config
+        Comma separated rules of file names never uploaded, e.g. temporary files and locks.
+        Rules ending with '/' match names of directories, skipped with all their files.
+        Default is not set.
+    -scan_threads
+    [scan_threads=4] in config
+        Number of threads reading directories at the same time, for network file systems
+        where directory listing waits for the server. Files are found in no particular order then.
+        Default is 1.
+    -prefetch_budget
+    [prefetch_budget=67108864] in config
+        Bytes of memory to read files waiting in the upload queue into, while other files are sent,
+        so disk and network are busy at the same time (e.g. for spinning disks and SMB shares).
+        Files larger than the budget are read while they are sent, as without it.
+        Files read ahead are not sent with sendfile(). Not used by -async uploads and -targets fan-out.
+        How often uploads waited for disk is written to the log at the end and exported with -metrics_file.
+        Default is 0 (files are not read ahead).
 
 Note: Console commands are for overriding config settings.
 e.g. In case you will run '""" + sys.argv[0] + """ -f somefile.pdf'
@@ -163,7 +685,11 @@ even with provided -config and/or -chapter setting.
 ############################## MULTIPART FORM EMULATOR ####################################
 ###########################################################################################
 class MultiPartForm(object):
-    """Accumulate the data to be used when posting a form."""
+    """Accumulate the data to be used when posting a form.
+
+    Files are not read into memory when added.
+    The form body is produced part by part on request,
+    so its size does not depend on the size of files sent."""
 
     def __init__(self):
         self.form_fields = []
@@ -180,58 +706,393 @@ class MultiPartForm(object):
         return
 
     def add_file(self, field_name, file_name, file_handle, current_mimetype=None):
-        """Add a file to be uploaded."""
-        body = file_handle.read()
+        """Add a file to be uploaded.
+
+        File is read from its current position only while the body is sent."""
         if current_mimetype is None:
-            current_mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
-        self.files.append((field_name, file_name, current_mimetype, body))
+            current_mimetype = mimetypes.guess_type(file_name)[0] or 'application/octet-stream'
+        offset = file_handle.tell()
+        size = get_file_size(file_handle) - offset
+        self.files.append((field_name, file_name, current_mimetype, (file_handle, offset, size)))
         return
 
-    def __str__(self):
-        """Return a string representing the form data, including attached files."""
-        # Build a list of lists, each containing "lines" of the
-        # request.  Each part is separated by a boundary string.
-        # Once the list is built, return a string where each
-        # line is separated by '\r\n'.
+    def get_parts(self):
+        """Return the form body layout.
+
+        A list of strings and (file_handle, offset, size) tuples,
+        that joined together make the request body."""
         parts = []
         part_boundary = '--' + self.boundary
 
         # Add the form fields
-        parts.extend(
-            [
+        for n, value in self.form_fields:
+            parts.append('\r\n'.join([
                 part_boundary,
                 'Content-Disposition: form-data; name="%s"' % n,
                 '',
                 value,
-            ] for n, value in self.form_fields
-        )
+                '',
+            ]))
 
         # Add the files to upload
-        parts.extend(
-            [
+        for field_name, file_name, content_type, file_part in self.files:
+            parts.append('\r\n'.join([
                 part_boundary,
                 'Content-Disposition: file; name="%s"; filename="%s"' % (field_name, file_name),
                 'Content-Type: %s' % content_type,
                 '',
-                body,
-            ] for field_name, file_name, content_type, body in self.files
+                '',
+            ]))
+            parts.append(file_part)
+            parts.append('\r\n')
+
+        # Add closing boundary marker
+        parts.append('--' + self.boundary + '--\r\n')
+        return parts
+
+    def get_content_length(self):
+        """Return the size of form body in bytes, without reading the files."""
+        length = 0
+        for part in self.get_parts():
+            if isinstance(part, tuple):
+                length += part[2]
+            else:
+                length += len(part)
+        return length
+
+    def get_body(self, hash_files=False, zero_copy=False, count_reads=True):
+        """Return a file-like object reading the form body.
+
+        With hash_files set it computes hash of the files content while reading it."""
+        return MultiPartBody(self.get_parts(), hash_files, zero_copy, count_reads)
+
+    def __str__(self):
+        """Return a string representing the form data, including attached files."""
+        return self.get_body().read()
+
+
+class MultiPartBody(object):
+    """File-like reader of the multipart form body.
+
+    Passed to the request as data it makes httplib send the body block by block.
+    Only one block of the file is held in memory at a time.
+    With hash_files set, digests holds a hash of every file in the form order, digest is the one of the first file."""
+
+    def __init__(self, parts, hash_files=False, zero_copy=False, count_reads=True):
+        self.parts = parts
+        self.hash_files = hash_files
+        # Body can be sent with send_to() instead of reading it
+        self.zero_copy = zero_copy
+        # Files read by other means (e.g. shared by fan-out targets) count their disk reads themselves
+        self.count_reads = count_reads
+        self.rewind()
+
+    def rewind(self):
+        """Start reading the body from the beginning again (e.g. to resend it)."""
+        self.index = 0
+        self.position = 0
+        self.digests = []
+        # Part index: hash of the file of that part
+        self.part_digests = {}
+        if self.hash_files:
+            for index, part in enumerate(self.parts):
+                if isinstance(part, tuple):
+                    self.part_digests[index] = hashlib.new(DEDUP_HASH)
+                    self.digests.append(self.part_digests[index])
+        self.digest = self.digests[0] if self.digests else None
+        for part in self.parts:
+            if isinstance(part, tuple):
+                part[0].seek(part[1])
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = []
+            chunk = self.read(MULTIPART_CHUNK_SIZE)
+            while chunk:
+                chunks.append(chunk)
+                chunk = self.read(MULTIPART_CHUNK_SIZE)
+            return ''.join(chunks)
+        while self.index < len(self.parts):
+            part = self.parts[self.index]
+            if isinstance(part, tuple):
+                file_handle, offset, length = part
+                chunk = ''
+                if self.position < length:
+                    started = time.time()
+                    chunk = file_handle.read(min(size, length - self.position))
+                    if self.count_reads and not isinstance(file_handle, PrefetchedFile):
+                        METRICS.add_time('read', time.time() - started)
+                        METRICS.count('bytes_read', len(chunk))
+                    digest = self.part_digests.get(self.index)
+                    if digest is not None:
+                        digest.update(chunk)
+            else:
+                chunk = part[self.position:self.position + size]
+            if chunk:
+                self.position += len(chunk)
+                return chunk
+            self.index += 1
+            self.position = 0
+        return ''
+
+    def send_to(self, sock):
+        """Sends the whole body to the socket without reading files into Python strings.
+
+        Form headers go as small buffers, files are sent by the kernel with sendfile(),
+        or from memory mapped file where sendfile() is not available or content must be hashed.
+        Must not be used for SSL sockets."""
+        for index, part in enumerate(self.parts):
+            if isinstance(part, tuple):
+                file_handle, offset, length = part
+                send_file(sock, file_handle, offset, length, self.part_digests.get(index))
+            else:
+                sock.sendall(part)
+        self.index = len(self.parts)
+        self.position = 0
+
+
+def send_file(sock, file_handle, offset, length, digest=None):
+    """Sends part of the file to the socket with sendfile() or from memory map.
+
+    Content is hashed with the digest given, if any. Then sendfile() can not be used.
+    Files read into memory already are sent by blocks."""
+    sent = 0
+    if digest is None and not isinstance(file_handle, PrefetchedFile):
+        sent = sendfile_all(sock, file_handle.fileno(), offset, length)
+        METRICS.count('bytes_sendfile', sent)
+    if sent < length:
+        send_file_mapped(sock, file_handle, offset + sent, length - sent, digest)
+
+
+def get_sendfile():
+    """Returns libc sendfile() function or None if system has none"""
+    global SENDFILE
+    if SENDFILE is None:
+        # Set at once, as upload workers may call it at the same time
+        sendfile = False
+        if sys.platform.startswith('linux'):
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+                # 64 bit file offsets are needed for files over 2 GB on 32 bit systems
+                sendfile = getattr(libc, 'sendfile64', None) or libc.sendfile
+                sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+                sendfile.restype = ctypes.c_ssize_t
+            except (OSError, AttributeError):
+                sendfile = False
+        SENDFILE = sendfile
+    return SENDFILE or None
+
+
+def sendfile_all(sock, file_descriptor, offset, length):
+    """Sends part of the file with sendfile(). Returns number of bytes sent.
+
+    Less then length is sent only if sendfile() does not work for this file or socket."""
+    sendfile = get_sendfile()
+    if sendfile is None:
+        return 0
+    position = ctypes.c_int64(offset)
+    end = offset + length
+    timeout = sock.gettimeout()
+    while position.value < end:
+        block_size = min(end - position.value, SENDFILE_BLOCK_SIZE)
+        count = sendfile(sock.fileno(), file_descriptor, ctypes.byref(position), block_size)
+        if count > 0:
+            continue
+        if count == 0:
+            raise socket.error(errno.EPIPE, 'file ended before all its data was sent')
+        error = ctypes.get_errno()
+        if error == errno.EINTR:
+            continue
+        if error in (errno.EAGAIN, errno.EWOULDBLOCK):
+            # Socket with timeout is non-blocking, waiting till it can send more
+            if not select.select([], [sock], [], timeout)[1]:
+                raise socket.timeout('timed out')
+            continue
+        if error in (errno.EINVAL, errno.ENOSYS, getattr(errno, 'EOPNOTSUPP', errno.EINVAL)):
+            break
+        raise socket.error(error, os.strerror(error))
+    return position.value - offset
+
+
+def send_file_mapped(sock, file_handle, offset, length, digest=None):
+    """Sends part of the file from its memory map, or read by blocks if it can not be mapped"""
+    if length <= 0:
+        return
+    try:
+        mapped = mmap.mmap(file_handle.fileno(), 0, access=mmap.ACCESS_READ)
+    except (mmap.error, ValueError, EnvironmentError, OverflowError, AttributeError):
+        mapped = None
+    if mapped is None:
+        file_handle.seek(offset)
+        while length > 0:
+            chunk = file_handle.read(min(length, MULTIPART_CHUNK_SIZE))
+            if not chunk:
+                raise socket.error(errno.EPIPE, 'file ended before all its data was sent')
+            if digest is not None:
+                digest.update(chunk)
+            sock.sendall(chunk)
+            length -= len(chunk)
+        return
+    try:
+        end = offset + length
+        while offset < end:
+            block = buffer(mapped, offset, min(end - offset, SENDFILE_BLOCK_SIZE))
+            if digest is not None:
+                digest.update(block)
+            sock.sendall(block)
+            offset += len(block)
+        METRICS.count('bytes_mmap', length)
+    finally:
+        mapped.close()
+
+
+class GzipBody(object):
+    """File-like reader compressing the body given with gzip on the fly.
+
+    Compressed size is not known before the end, so output is framed for chunked transfer encoding
+    and the request must be sent with 'Transfer-Encoding: chunked' header instead of Content-Length."""
+
+    def __init__(self, body, level=DEFAULT_COMPRESS_LEVEL):
+        self.body = body
+        self.level = level
+        self.rewind()
+
+    @property
+    def digest(self):
+        return self.body.digest
+
+    def rewind(self):
+        self.body.rewind()
+        self.compressor = zlib.compressobj(self.level, zlib.DEFLATED, GZIP_WBITS)
+        self.buffer = ''
+        self.offset = 0
+        self.finished = False
+        self.raw_size = 0
+        self.compressed_size = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = sys.maxint
+        if self.offset == len(self.buffer):
+            self.buffer = ''
+            self.offset = 0
+        while len(self.buffer) - self.offset < size and not self.finished:
+            data = self.body.read(MULTIPART_CHUNK_SIZE)
+            started = time.time()
+            if data:
+                self.raw_size += len(data)
+                compressed = self.compressor.compress(data)
+            else:
+                compressed = self.compressor.flush()
+                self.finished = True
+            METRICS.add_time('compress', time.time() - started)
+            if compressed:
+                self.compressed_size += len(compressed)
+                self.buffer = self.buffer[self.offset:] + '%x\r\n%s\r\n' % (len(compressed), compressed)
+                self.offset = 0
+            if self.finished:
+                self.buffer += '0\r\n\r\n'
+        chunk = self.buffer[self.offset:self.offset + size]
+        self.offset += len(chunk)
+        return chunk
+
+
+class CompressionStats(object):
+    """Totals of request body compression, shared by upload workers"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = 0
+        self.raw_size = 0
+        self.compressed_size = 0
+
+    def add(self, file_place, body, opt):
+        """Counts compressed body sent and logs compression ratio of the file"""
+        self.lock.acquire()
+        try:
+            self.files += 1
+            self.raw_size += body.raw_size
+            self.compressed_size += body.compressed_size
+        finally:
+            self.lock.release()
+        message = 'Compressed %s to %s bytes (%s). For file:' % (
+            body.raw_size, body.compressed_size, format_ratio(body.raw_size, body.compressed_size)
+        )
+        write_successlog(file_place, message=message)
+        if not opt['silent']:
+            print '%s %s' % (message, file_place)
+
+    def format(self):
+        return 'Compressed %s files from %s to %s bytes (%s)' % (
+            self.files, self.raw_size, self.compressed_size, format_ratio(self.raw_size, self.compressed_size)
         )
 
-        # Flatten the list and add closing boundary marker,
-        # then return CR+LF separated data
-        flattened = list(itertools.chain(*parts))
-        flattened.append('--' + self.boundary + '--')
-        flattened.append('')
-        return '\r\n'.join(flattened)
+
+def format_ratio(raw_size, compressed_size):
+    """Returns compressed size as percent of the original"""
+    return '%.1f%%' % (100.0 * compressed_size / max(raw_size, 1))
+
+
+def use_compression(file_place, opt):
+    """Checks file should be compressed before sending"""
+    if not opt.get('compress'):
+        return False
+    extension = os.path.splitext(file_place)[1][1:].lower()
+    if extension in opt['compress_skip']:
+        return False
+    return os.path.getsize(file_place) >= opt['compress_threshold']
+
+
+def compress_request_body(request, body, opt):
+    """Replaces request body with its gzip compressed stream. Returns the new body."""
+    body = GzipBody(body, opt['compress_level'])
+    request.add_data(body)
+    del request.headers['Content-length']
+    request.add_header('Content-encoding', 'gzip')
+    request.add_header('Transfer-encoding', 'chunked')
+    return body
+
+
+def get_file_size(file_handle):
+    """Returns size of an opened file in bytes"""
+    try:
+        return os.fstat(file_handle.fileno()).st_size
+    except (AttributeError, OSError):
+        position = file_handle.tell()
+        file_handle.seek(0, os.SEEK_END)
+        size = file_handle.tell()
+        file_handle.seek(position)
+        return size
 
 
 def check_file_uploaded(file_place, opts, opener):
     """Checking if file revision for uploaded code is greater then 0"""
+    code = check_uploaded_code(file_place, opts['uploaded_code'], opts)
+    request = urllib2.Request(get_fileinfo_url(code, opts))
+    with METRICS.timer('verify'):
+        response = opener.open(request)
+    if response:
+        if response.code == 200:
+            file_info = response.fp.read()
+            revisions_count = int(file_info)
+            if revisions_count > 0:
+                return True
+        else:
+            METRICS.count('verify_failures')
+            return False
+    METRICS.count('verify_failures')
+    return False
+
+
+def check_uploaded_code(file_place, uploaded_code, opts):
+    """Warns if API has stored the file under a code other then its name.
+
+    Returns the code file is stored with."""
     original_code = False
     original_filename = get_full_filename(file_place)
     if "." in original_filename:
         original_code, file_extension = os.path.splitext(original_filename)
-    file_name = opts['uploaded_code']
+    file_name = uploaded_code
     code = file_name
     if "." in file_name:
         code, file_extension = os.path.splitext(file_name)
@@ -240,19 +1101,12 @@ def check_file_uploaded(file_place, opts, opener):
         if not opts['silent']:
             print msg + ' %s' % original_filename
         write_successlog(original_filename, msg)
-    full_url = opts['host'] + opts['fileinfo_loc'] + code + '?only_metadata=true'
-    request = urllib2.Request(full_url)
-    response = opener.open(request)
-    opener.close()
-    if response:
-        if response.code == 200:
-            file_info = response.fp.read()
-            revisions_count = int(file_info)
-            if revisions_count > 0:
-                return True
-        else:
-            return False
-    return False
+    return code
+
+
+def get_fileinfo_url(code, opts):
+    """Returns url of the file revisions count API for the code given"""
+    return opts['host'] + opts['fileinfo_loc'] + code + '?only_metadata=true'
 
 
 class PreemptiveBasicAuthHandler(urllib2.HTTPBasicAuthHandler):
@@ -268,14 +1122,330 @@ class PreemptiveBasicAuthHandler(urllib2.HTTPBasicAuthHandler):
         # but returns a request object.
         user, pw = self.passwd.find_user_password(realm, url)
         if pw:
-            raw = "%s:%s" % (user, pw)
-            auth = 'Basic %s' % base64.b64encode(raw).strip()
-            req.add_unredirected_header(self.auth_header, auth)
+            req.add_unredirected_header(self.auth_header, get_basic_auth(user, pw))
         return req
 
     https_request = http_request
 
 
+def get_basic_auth(user, pw):
+    """Returns value of the Basic Authorization header"""
+    raw = "%s:%s" % (user, pw)
+    return 'Basic %s' % base64.b64encode(raw).strip()
+
+
+###########################################################################################
+##################### KEEP-ALIVE CONNECTION POOL ##########################################
+###########################################################################################
+class ConnectionPool(object):
+    """Keeps HTTP/1.1 connections open between requests.
+
+    Idle connections are stored per scheme and host and are reused by next requests to the same host,
+    saving TCP connection setup and TLS handshake for each of them.
+    Bodies of expect_threshold bytes and larger are sent with 'Expect: 100-continue' header:
+    body is sent only after server answers '100 Continue', so it is not sent in vain when server rejects
+    the request (e.g. for wrong credentials). Hosts not answering in expect_timeout seconds
+    get bodies without waiting for EXPECT_IGNORE_TIME seconds, as they may be just overloaded or restarted.
+    Safe to share between threads."""
+
+    def __init__(self, max_size=None, idle_timeout=None, expect_threshold=None, expect_timeout=None):
+        self.max_size = max_size or DEFAULT_POOL_SIZE
+        self.idle_timeout = idle_timeout or DEFAULT_POOL_IDLE_TIMEOUT
+        self.expect_threshold = expect_threshold
+        self.expect_timeout = expect_timeout or DEFAULT_EXPECT_TIMEOUT
+        # Key of host not answering to 'Expect: 100-continue': time it stopped being used
+        self.expect_ignored = {}
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.stats = {
+            'requests': 0,
+            'connections_opened': 0,
+            'connections_reused': 0,
+            'connections_closed': 0,
+            'expect_continued': 0,
+            'expect_rejected': 0,
+            'expect_ignored': 0,
+            'expect_bytes_saved': 0,
+        }
+
+    def count(self, name, value=1):
+        self.lock.acquire()
+        try:
+            self.stats[name] += value
+        finally:
+            self.lock.release()
+
+    def get_connection(self, key, http_class, host, timeout, **conn_args):
+        """Returns (connection, reused) pair for the host given"""
+        now = time.time()
+        self.lock.acquire()
+        try:
+            idle = self.idle.get(key, [])
+            while idle:
+                conn, released = idle.pop()
+                if now - released < self.idle_timeout and not connection_dropped(conn):
+                    self.stats['connections_reused'] += 1
+                    return conn, True
+                conn.close()
+                self.stats['connections_closed'] += 1
+            self.stats['connections_opened'] += 1
+        finally:
+            self.lock.release()
+        return http_class(host, timeout=timeout, **conn_args), False
+
+    def release_connection(self, key, conn):
+        """Returns connection to the pool or closes it if the pool is full"""
+        self.lock.acquire()
+        try:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.max_size:
+                idle.append((conn, time.time()))
+                return
+            self.stats['connections_closed'] += 1
+        finally:
+            self.lock.release()
+        conn.close()
+
+    def use_expect(self, key, data, headers):
+        """Checks request body is large enough to wait for '100 Continue' and the host answers it"""
+        if data is None or not self.expect_threshold or not self.expect_allowed(key):
+            return False
+        if headers.get('Transfer-Encoding') == 'chunked':
+            return True
+        try:
+            return int(headers.get('Content-Length', 0)) >= self.expect_threshold
+        except ValueError:
+            return False
+
+    def expect_allowed(self, key):
+        """Checks the host is not ignored for 'Expect: 100-continue', or is ignored long enough to try it again"""
+        ignored = self.expect_ignored.get(key)
+        if ignored is None:
+            return True
+        if time.time() - ignored < EXPECT_IGNORE_TIME:
+            return False
+        self.lock.acquire()
+        try:
+            self.expect_ignored.pop(key, None)
+        finally:
+            self.lock.release()
+        return True
+
+    def ignore_expect(self, key):
+        self.lock.acquire()
+        try:
+            if key not in self.expect_ignored:
+                self.expect_ignored[key] = time.time()
+                self.stats['expect_ignored'] += 1
+        finally:
+            self.lock.release()
+
+    def discard_connection(self, conn):
+        conn.close()
+        self.count('connections_closed')
+
+    def close(self):
+        """Closes all idle connections"""
+        self.lock.acquire()
+        try:
+            for idle in self.idle.itervalues():
+                for conn, released in idle:
+                    conn.close()
+                    self.stats['connections_closed'] += 1
+            self.idle = {}
+        finally:
+            self.lock.release()
+
+    def open(self, http_class, req, **conn_args):
+        """Performs urllib2 request over the pooled connection.
+
+        Response body is read at once, so connection can be given back to the pool
+        before the response is returned."""
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+        key = (req.get_type(), host)
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items() if k not in headers))
+        headers = dict((name.title(), val) for name, val in headers.items())
+        data = req.get_data()
+        if self.use_expect(key, data, headers):
+            headers['Expect'] = '100-continue'
+
+        self.count('requests')
+        while True:
+            conn, reused = self.get_connection(key, http_class, host, req.timeout, **conn_args)
+            # Final response server has sent instead of '100 Continue', body is not sent then
+            early = None
+            try:
+                if conn.sock is None:
+                    conn.connect()
+                    set_nodelay(conn.sock)
+                if 'Expect' in headers:
+                    conn.request(req.get_method(), req.get_selector(), None, headers)
+                    answered, early = wait_for_continue(conn, req.get_method(), self.expect_timeout)
+                    if not answered:
+                        self.ignore_expect(key)
+                    if early is None:
+                        if answered:
+                            self.count('expect_continued')
+                        send_body(conn, data)
+                    elif early.status == httplib.EXPECTATION_FAILED:
+                        # Server does not support it, sending the request again with the body at once
+                        early.read()
+                        self.discard_connection(conn)
+                        self.ignore_expect(key)
+                        del headers['Expect']
+                        continue
+                    else:
+                        self.count('expect_rejected')
+                        self.count('expect_bytes_saved', int(headers.get('Content-Length', 0)))
+                elif getattr(data, 'zero_copy', False) and not isinstance(conn, httplib.HTTPSConnection):
+                    # Request head is sent by httplib, file body straight from the file to the socket
+                    conn.request(req.get_method(), req.get_selector(), None, headers)
+                    data.send_to(conn.sock)
+                else:
+                    conn.request(req.get_method(), req.get_selector(), data, headers)
+                r = early or conn.getresponse()
+                body = r.read()
+            except (socket.error, httplib.HTTPException), err:
+                self.discard_connection(conn)
+                if reused:
+                    # Server has closed the idle connection. Resending over a new one.
+                    if hasattr(data, 'rewind'):
+                        data.rewind()
+                    continue
+                raise urllib2.URLError(err)
+            break
+
+        if r.will_close or early is not None:
+            # Server expects body of the request rejected to be sent or connection to be closed
+            self.discard_connection(conn)
+        else:
+            self.release_connection(key, conn)
+
+        resp = urllib.addinfourl(StringIO.StringIO(body), r.msg, req.get_full_url())
+        resp.code = r.status
+        resp.msg = r.reason
+        return resp
+
+
+def send_body(conn, data):
+    """Sends request body after the head is sent"""
+    if getattr(data, 'zero_copy', False) and not isinstance(conn, httplib.HTTPSConnection):
+        data.send_to(conn.sock)
+    else:
+        conn.send(data)
+
+
+def wait_for_continue(conn, method, timeout):
+    """Waits for server answer to the request head sent with 'Expect: 100-continue'.
+
+    Returns (answered, response) pair. Response is None if the body should be sent:
+    server has answered '100 Continue' or has not answered in timeout seconds.
+    Otherwise it is the final response server has sent without waiting for the body."""
+    try:
+        readable = select.select([conn.sock], [], [], timeout)[0]
+    except (select.error, ValueError):
+        readable = []
+    if not readable:
+        return False, None
+    response = EarlyResponse(conn.sock, method=method)
+    status = response.read_status_line()
+    if status[1] == httplib.CONTINUE:
+        # Skipping headers of the interim response
+        while response.fp.readline().strip():
+            pass
+        return True, None
+    response.begin()
+    return True, response
+
+
+class EarlyResponse(httplib.HTTPResponse):
+    """Response read while waiting for '100 Continue'. Status line is read first, to tell interim one."""
+
+    status_line = None
+
+    def read_status_line(self):
+        self.status_line = self._read_status()
+        return self.status_line
+
+    def _read_status(self):
+        if self.status_line is not None:
+            status, self.status_line = self.status_line, None
+            return status
+        return httplib.HTTPResponse._read_status(self)
+
+
+def set_nodelay(sock):
+    """Turns off Nagle algorithm on the socket.
+
+    Request head and body are sent by separate writes, and with Nagle algorithm on
+    the last small segment waits for delayed ACK of the server, about 40 ms a request."""
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except (socket.error, AttributeError):
+        pass
+
+
+def connection_dropped(conn):
+    """Checks if idle connection was closed by the server.
+
+    Idle connection socket must have nothing to read. Readable means EOF or garbage."""
+    sock = conn.sock
+    if sock is None:
+        return True
+    try:
+        return bool(select.select([sock], [], [], 0)[0])
+    except (select.error, socket.error, ValueError):
+        return True
+
+
+class KeepAliveHTTPHandler(urllib2.HTTPHandler):
+    """Sends plain HTTP requests over pooled keep-alive connections"""
+
+    def __init__(self, pool, debuglevel=0):
+        urllib2.HTTPHandler.__init__(self, debuglevel)
+        self.pool = pool
+
+    def http_open(self, req):
+        return self.pool.open(httplib.HTTPConnection, req)
+
+    def http_request(self, req):
+        return prepare_request(self, req)
+
+
+class KeepAliveHTTPSHandler(urllib2.HTTPSHandler):
+    """Sends HTTPS requests over pooled keep-alive connections.
+
+    TLS session is kept open together with connection, so handshake happens once per connection."""
+
+    def __init__(self, pool, debuglevel=0, context=None):
+        urllib2.HTTPSHandler.__init__(self, debuglevel, context)
+        self.pool = pool
+
+    def https_open(self, req):
+        return self.pool.open(httplib.HTTPSConnection, req, context=self._context)
+
+    def https_request(self, req):
+        return prepare_request(self, req)
+
+
+def prepare_request(handler, req):
+    """Adds default headers to the request.
+
+    Body of chunked request has no length, so it is hidden from urllib2, which would count it."""
+    if not req.has_header('Transfer-encoding'):
+        return handler.do_request_(req)
+    data = req.get_data()
+    req.add_data(None)
+    try:
+        return handler.do_request_(req)
+    finally:
+        req.add_data(data)
+
+
 def build_opener(opt):
     # Creating Auth Opener
     # create a password manager
@@ -288,14 +1458,138 @@ def build_opener(opt):
         user=opt['username'],
         passwd=opt['password']
     )
+    # Sharing keep-alive connections between all requests made with this opener
+    pool = opt.get('pool') or ConnectionPool(
+        opt.get('pool_size'), opt.get('pool_idle_timeout'), opt.get('expect_threshold'), opt.get('expect_timeout')
+    )
     # create "opener" (OpenerDirector instance)
-    opener = urllib2.build_opener(auth_handler)
+    opener = urllib2.build_opener(auth_handler, KeepAliveHTTPHandler(pool), KeepAliveHTTPSHandler(pool))
+    opener.pool = pool
     # Install the opener.
     # Now all calls to urllib2.urlopen use our opener.
     urllib2.install_opener(opener)
     return opener
 
 
+class RevisionVerifier(object):
+    """Checks file revisions of uploaded files in a separate pipeline stage.
+
+    Uploads hand (file, uploaded code) pairs over and go on with next files,
+    while verifier threads check them over their own connections.
+    Files are logged as uploaded and removed only after the check succeeds.
+
+    Modes:
+        pipeline - every file is checked while uploads go on
+        sample - only every n-th file is checked, others are accepted at once
+        end - all files are checked after the uploads are finished"""
+
+    def __init__(self, opt, mode=VERIFY_PIPELINE, sample=DEFAULT_VERIFY_SAMPLE, workers=VERIFY_WORKERS):
+        self.opt = opt
+        self.mode = mode
+        self.sample = sample
+        self.workers = workers
+        # Own opener makes a separate connections pool
+        self.opener = build_opener(dict(opt, pool=None))
+        self.queue = Queue.Queue(maxsize=VERIFY_QUEUE_SIZE)
+        self.pending = []
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.stats = {'verified': 0, 'failed': 0, 'not_checked': 0}
+        self.threads = []
+        if mode != VERIFY_END:
+            self.start()
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.worker, name='verify-worker-%s' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def count(self, name):
+        self.lock.acquire()
+        try:
+            self.stats[name] += 1
+        finally:
+            self.lock.release()
+
+    def submit(self, file_place, uploaded_code, content_hash=None):
+        """Takes uploaded file to check"""
+        self.lock.acquire()
+        try:
+            self.submitted += 1
+            sampled = self.submitted % self.sample == 0
+        finally:
+            self.lock.release()
+        if self.mode == VERIFY_SAMPLE and not sampled:
+            self.count('not_checked')
+            finish_upload(file_place, self.opt, uploaded_code, content_hash)
+        elif self.mode == VERIFY_END:
+            self.lock.acquire()
+            try:
+                self.pending.append((file_place, uploaded_code, content_hash))
+            finally:
+                self.lock.release()
+        else:
+            self.queue.put((file_place, uploaded_code, content_hash))
+
+    def worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            self.verify(*item)
+
+    def verify(self, file_place, uploaded_code, content_hash):
+        file_name = get_full_filename(file_place)
+        try:
+            result = check_file_uploaded(file_place, dict(self.opt, uploaded_code=uploaded_code), self.opener)
+        except (urllib2.URLError, httplib.HTTPException, socket.error, ValueError), e:
+            result = False
+            METRICS.count('verify_failures')
+            write_successlog(file_name, message='File uploaded check error: %s. For file:' % e)
+        if result:
+            self.count('verified')
+            finish_upload(file_place, self.opt, uploaded_code, content_hash)
+        else:
+            self.count('failed')
+            if 'snapshot' in self.opt:
+                self.opt['snapshot'].forget(file_place)
+            raise_error('File uploaded check failed %s' % file_name, retry=True)
+
+    def close(self):
+        """Checks remaining files and waits for verifier threads to finish.
+
+        Returns dictionary of verification statistics."""
+        if self.mode == VERIFY_END:
+            self.start()
+            for item in self.pending:
+                self.queue.put(item)
+            self.pending = []
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            # Joining with timeout keeps main thread responsive to Ctrl+C
+            while thread.is_alive():
+                thread.join(UPLOAD_QUEUE_TIMEOUT)
+        self.opener.pool.close()
+        return self.stats
+
+
+def format_verify_stats(stats):
+    """Returns verification statistics as a text line"""
+    return 'Verified %(verified)s files, check failed for %(failed)s, not checked %(not_checked)s' % stats
+
+
+def format_pool_stats(pool):
+    """Returns connection reuse counters of the pool as a text line"""
+    line = 'Requests: %(requests)s, connections opened: %(connections_opened)s, ' \
+           'reused: %(connections_reused)s, closed: %(connections_closed)s' % pool.stats
+    if pool.stats['expect_rejected']:
+        line += ', rejected before body sent: %(expect_rejected)s (%(expect_bytes_saved)s bytes)' % pool.stats
+    return line
+
+
 def upload_file(file_place, opt):
     """Main uploader function"""
     silent_ = opt['silent']
@@ -306,112 +1600,1151 @@ def upload_file(file_place, opt):
     else:
         opener = opt['opener']
 
-    # File upload
-    # Opening file for operations
-    work_file = open(file_place, "rb")
-    # Initializing the form
-    form = MultiPartForm()
+    # Skipping files with content uploaded before
+    dedup = opt.get('dedup')
+    content_hash = None
+    if dedup:
+        with METRICS.timer('dedup'):
+            duplicate, content_hash = dedup.find(file_place)
+        if duplicate:
+            skip_duplicate(file_place, duplicate, opt)
+            return True
 
     # Extracting filename
     file_name = get_full_filename(file_place)
 
-    # Adding our file to form
-    form.add_file('file', file_name, file_handle=work_file, current_mimetype=opt['mimetype'])
-
-    # Build the request
-    full_url = opt['url'] + file_name
-    request = urllib2.Request(full_url)
-    request.add_header('User-agent', opt['user_agent'])
-    body = str(form)
-    request.add_header('Content-type', form.get_content_type())
-    request.add_header('Content-length', len(body))
-    request.add_data(body)
-
     if not silent_:
         print 'SENDING FILE: %s' % file_place
+    if 'fanout' in opt:
+        return opt['fanout'].upload(file_place, opt, content_hash)
     response = None
+    controller = opt.get('concurrency_controller')
+    started = time.time()
     try:
-        response = opener.open(request)
-        opener.close()
-        work_file.close()
+        with METRICS.timer('send'):
+            response, content_hash = post_file(file_place, opt, opener, content_hash)
+        if controller is not None:
+            controller.record(time.time() - started, os.path.getsize(file_place))
     # Usecases when connection with this URL is not established and URL is wrong
     except (urllib2.HTTPError, urllib2.URLError), e:
+        if controller is not None:
+            controller.record(time.time() - started, 0, e)
         if not silent_:
             print 'SERVER RESPONSE: %s' % e
             print 'Writing Error file'
         raise_error("%s : %s""" % (file_place, e), retry=retry)
-        pass
+        if 'retry_scheduler' in opt:
+            opt['retry_scheduler'].note_retry_after(file_place, get_retry_after(e))
     if response:
         if not silent_:
             print 'SERVER RESPONSE: OK'
         if response.code == 200:
+            r = ''
             if opt['fileinfo_loc']:
-                r = ''
                 try:
                     r = json.loads(response.fp.read())
                 except ValueError:
-                    raise_error('No Json returned from API: %s' % filename)
+                    raise_error('No Json returned from API: %s' % file_name)
                     return False
                     pass
-                opt['uploaded_code'] = r
-                result = check_file_uploaded(file_place, opt, opener)
+                if 'verifier' in opt:
+                    # Verification and removal of the file are left to verifier pipeline stage
+                    opt['verifier'].submit(file_place, r, content_hash)
+                    return True
+                # Uploaded code is passed with a copy of options, as they are shared between upload workers
+                result = check_file_uploaded(file_place, dict(opt, uploaded_code=r), opener)
                 if not result:
                     raise_error('File uploaded check failed %s' % file_name, retry=retry)
                     return False
-            write_successlog(file_name)
-            if opt['remove']:
-                remove_file(file_place)
+            finish_upload(file_place, opt, r, content_hash)
             return True
     return False
 
 
-def get_full_filename(full_name):
-    """Extracts only filename from full path"""
-    result_name = full_name
-    if os.sep or os.pardir in full_name:
-        result_name = os.path.split(full_name)[1]
-    return result_name
+def post_file(file_place, opt, opener, content_hash=None):
+    """Sends file to API. Returns (response, file content hash) pair.
 
+    Large files are sent in resumable chunks, if chunked upload API is configured and server supports it.
+    Content hash is computed for deduplication index only, while the file is sent."""
+    dedup = opt.get('dedup')
+    if use_chunked_upload(file_place, opt):
+        try:
+            response = upload_file_chunked(file_place, opt, opener)
+            if dedup and content_hash is None:
+                content_hash = hash_file(file_place)
+            return response, content_hash
+        except ChunkedUploadNotSupported:
+            # Falling back to ordinary upload for this and next files
+            opt['chunk_url'] = None
 
-def getopts(argv):
-    """Gets options from sys.argv and transfers them into handy dictionary"""
-    opts = {}
-    while argv:
-        if argv[0][0] == '-':               # find "-name value" pairs
-            try:
-                # Getting value of this option
-                if argv[1][0] == '-':  # Next option is an argv
-                    opts[argv[0]] = ''
-                    argv = argv[1:]
-                else:
-                    opts[argv[0]] = argv[1]     # dict key is "-name" arg
-                    argv = argv[2:]
-            except IndexError:
-                # option has no argv left in the end
-                opts[argv[0]] = None
-                argv = argv[1:]
+    # File upload
+    # Opening file for operations
+    work_file = open_upload_file(file_place, opt)
+    try:
+        # Initializing the form
+        form = MultiPartForm()
+
+        # Extracting filename
+        file_name = get_full_filename(file_place)
+
+        # Adding our file to form
+        form.add_file('file', file_name, file_handle=work_file, current_mimetype=opt['mimetype'])
+
+        # Build the request
+        full_url = opt['url'] + file_name
+        request = urllib2.Request(full_url)
+        request.add_header('User-agent', opt['user_agent'])
+        request.add_header('Content-type', form.get_content_type())
+        request.add_header('Content-length', form.get_content_length())
+        # Hash of the file content is computed while it is sent, unless it is known already
+        body = form.get_body(hash_files=bool(dedup) and content_hash is None, zero_copy=opt.get('zero_copy'))
+        request.add_data(body)
+        compressed = use_compression(file_place, opt)
+        if compressed:
+            body = compress_request_body(request, body, opt)
+
+        response = opener.open(request)
+        if compressed:
+            METRICS.count('bytes_sent', body.compressed_size)
+            opt['compression_stats'].add(file_place, body, opt)
         else:
-            argv = argv[1:]
-    return opts
+            METRICS.count('bytes_sent', form.get_content_length())
+        if body.digest is not None:
+            content_hash = body.digest.hexdigest()
+        return response, content_hash
+    finally:
+        work_file.close()
 
 
-def parse_config(cfg_file_name=None, config_chapter=False, _silent=False):
-    """Parses specified config file or uses system set."""
+def finish_upload(file_place, opt, uploaded_code='', content_hash=None):
+    """Logs succeeded upload and removes the file if configured to.
 
-    def get_option(opt_config, opt, config_opts):
-        # looks for option and appends it to options dictionary
-        try:
-            try:
-                opt_value = opt_config.get(config_chapter or DEFAULT_CFG_CHAPTER, opt)
-                config_opts[option] = opt_value
-            except ConfigParser.NoOptionError:
-                pass
-        except ConfigParser.NoSectionError, err:
-            if not _silent:
-                print 'Config file Error:', err
-            raise_error(err)
+    Stores uploaded file content hash in the deduplication index, if it is used."""
+    file_name = get_full_filename(file_place)
+    write_successlog(file_name)
+    METRICS.count('files_uploaded')
+    if content_hash and opt.get('dedup'):
+        opt['dedup'].add(content_hash, os.path.getsize(file_place), uploaded_code, file_name)
+    if opt['remove']:
+        remove_file(file_place)
+    if 'claims' in opt:
+        opt['claims'].release(file_place)
 
-    config_instance = None
+
+def skip_duplicate(file_place, duplicate, opt):
+    """Logs file skipped as a duplicate of uploaded one and removes it if configured to"""
+    code, file_name, uploaded = duplicate
+    # Records added by index rebuild from a directory have no code
+    msg = 'DUPLICATE of %s uploaded as %s at %s skipped:' % (
+        file_name, code or 'unknown code', datetime.datetime.fromtimestamp(uploaded)
+    )
+    if not opt['silent']:
+        print '%s %s' % (msg, file_place)
+    write_successlog(file_place, message=msg)
+    METRICS.count('duplicates_skipped')
+    if opt['dedup_remove']:
+        remove_file(file_place)
+    if 'claims' in opt:
+        opt['claims'].release(file_place)
+
+
+###########################################################################################
+#################################### CHUNKED UPLOAD #######################################
+###########################################################################################
+class ChunkedUploadNotSupported(Exception):
+    """Server has no chunked upload API at the configured location"""
+
+
+def use_chunked_upload(file_place, opt):
+    """Checks file is large enough to be sent in chunks and chunked upload API is configured"""
+    if not opt.get('chunk_url'):
+        return False
+    return os.path.getsize(file_place) >= opt.get('chunk_threshold', DEFAULT_CHUNK_THRESHOLD)
+
+
+def upload_file_chunked(file_place, opt, opener):
+    """Sends file to chunked upload API in parts of chunk_size bytes.
+
+    Protocol (all locations relative to host + chunk_url):
+        POST <file name> with X-Upload-Length header starts upload, returns {"upload_id": id, "offset": 0}
+        GET <id> returns {"offset": bytes received}
+        PUT <id> with Content-Range header stores a part, returns {"offset": bytes received}
+        POST <id>/complete finishes upload, returns the same as file upload API
+
+    Each part is retried on errors, continuing from the offset server reports.
+    Upload progress is stored locally, so an interrupted upload of the same file
+    is continued on the next attempt. Returns response of the completed upload."""
+    silent_ = opt['silent']
+    file_name = get_full_filename(file_place)
+    base_url = opt['host'] + opt['chunk_url']
+    chunk_size = opt.get('chunk_size', DEFAULT_CHUNK_SIZE)
+    st = os.stat(file_place)
+    size = st.st_size
+    state = ChunkedUploadState(file_place, st)
+
+    upload_id = state.upload_id
+    offset = None
+    if upload_id:
+        offset = get_chunked_offset(opener, base_url + upload_id)
+        if offset is not None and not silent_:
+            print 'RESUMING UPLOAD of %s from byte %s' % (file_place, offset)
+    if offset is None:
+        upload_id = start_chunked_upload(opener, base_url + file_name, size)
+        offset = 0
+        state.save(upload_id, offset)
+
+    url = base_url + upload_id
+    work_file = open(file_place, 'rb')
+    try:
+        failures = 0
+        while offset < size:
+            length = min(chunk_size, size - offset)
+            try:
+                offset = send_chunk(opener, url, work_file, offset, length, size)
+                failures = 0
+            except (urllib2.URLError, httplib.HTTPException, socket.error, ValueError, KeyError), e:
+                failures += 1
+                message = 'Chunk upload error at byte %s: %s. For file:' % (offset, e)
+                write_successlog(file_place, message=message)
+                if not silent_:
+                    print '%s %s' % (message, file_place)
+                if failures >= CHUNK_RETRIES_COUNT:
+                    raise urllib2.URLError('chunked upload failed at byte %s: %s' % (offset, e))
+                time.sleep(failures)
+                server_offset = get_chunked_offset(opener, url)
+                if server_offset is not None:
+                    offset = server_offset
+            state.save(upload_id, offset)
+    finally:
+        work_file.close()
+
+    response = opener.open(urllib2.Request(url + '/complete', data=''))
+    state.remove()
+    return response
+
+
+def start_chunked_upload(opener, url, size):
+    """Starts chunked upload of a file. Returns upload id."""
+    request = urllib2.Request(url, data='')
+    request.add_header('X-Upload-Length', size)
+    try:
+        response = opener.open(request)
+    except urllib2.HTTPError, e:
+        if e.code in CHUNK_NOT_SUPPORTED_CODES:
+            raise ChunkedUploadNotSupported(url)
+        raise
+    try:
+        return str(json.loads(response.read())['upload_id'])
+    except (ValueError, KeyError, TypeError):
+        raise ChunkedUploadNotSupported(url)
+
+
+def get_chunked_offset(opener, url):
+    """Returns number of bytes server has received for the upload or None if it is not known to server"""
+    try:
+        response = opener.open(urllib2.Request(url))
+        return int(json.loads(response.read())['offset'])
+    except (urllib2.URLError, ValueError, KeyError, TypeError):
+        return None
+
+
+def send_chunk(opener, url, work_file, offset, length, size):
+    """Sends part of the file. Returns number of bytes server has received."""
+    request = urllib2.Request(url, data=FileSlice(work_file, offset, length))
+    request.get_method = lambda: 'PUT'
+    request.add_header('Content-type', 'application/octet-stream')
+    request.add_header('Content-length', length)
+    request.add_header('Content-range', 'bytes %s-%s/%s' % (offset, offset + length - 1, size))
+    response = opener.open(request)
+    METRICS.count('bytes_sent', length)
+    return int(json.loads(response.read())['offset'])
+
+
+class FileSlice(object):
+    """File-like reader of a part of the file, sent by httplib block by block"""
+
+    def __init__(self, file_handle, offset, length):
+        self.file_handle = file_handle
+        self.offset = offset
+        self.length = length
+        self.rewind()
+
+    def rewind(self):
+        self.file_handle.seek(self.offset)
+        self.position = 0
+
+    def read(self, size=-1):
+        left = self.length - self.position
+        if size is None or size < 0 or size > left:
+            size = left
+        started = time.time()
+        chunk = self.file_handle.read(size)
+        METRICS.add_time('read', time.time() - started)
+        METRICS.count('bytes_read', len(chunk))
+        self.position += len(chunk)
+        return chunk
+
+
+class ChunkedUploadState(object):
+    """Local record of a chunked upload progress.
+
+    Stored in CHUNK_STATE_DIR as a small json file named after the file path, size and mtime,
+    so a changed file is never continued from an old upload."""
+
+    def __init__(self, file_place, st):
+        key = '%s|%s|%s' % (os.path.abspath(file_place), st.st_size, st.st_mtime)
+        self.path = os.path.join(CHUNK_STATE_DIR, hashlib.sha1(key).hexdigest() + '.json')
+        self.file_place = file_place
+        self.upload_id = None
+        try:
+            state_file = open(self.path, 'rb')
+            try:
+                self.upload_id = str(json.load(state_file)['upload_id'])
+            finally:
+                state_file.close()
+        except (IOError, ValueError, KeyError, TypeError):
+            pass
+
+    def save(self, upload_id, offset):
+        if not os.path.isdir(CHUNK_STATE_DIR):
+            try:
+                os.makedirs(CHUNK_STATE_DIR)
+            except OSError:
+                # Created by other worker meanwhile
+                pass
+        temp_path = self.path + '.tmp'
+        state_file = open(temp_path, 'wb')
+        try:
+            json.dump({'file': self.file_place, 'upload_id': upload_id, 'offset': offset}, state_file)
+        finally:
+            state_file.close()
+        if os.name == 'nt' and os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(temp_path, self.path)
+        self.upload_id = upload_id
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+###########################################################################################
+##################################### BATCH UPLOAD ########################################
+###########################################################################################
+def use_batch_upload(size, opt):
+    """Checks file of the size can be sent in a batch with other files and bulk upload API is configured"""
+    if not opt.get('batch_url') or 'fanout' in opt:
+        return False
+    return size < opt.get('batch_size', DEFAULT_BATCH_SIZE)
+
+
+def upload_batch(file_places, opt):
+    """Sends several files with one multipart request to the bulk upload API (host + batch_url).
+
+    Every file is a 'file' field of the form. API returns a json list of per file results,
+    in the order of files in the form: {"file": file name, "code": stored code} or {"file": file name, "error": text}.
+    Files failed in the batch are returned, to be uploaded one by one.
+    When the API is not supported by server, batches are no longer used and all the files are returned."""
+    silent_ = opt['silent']
+    opener = opt['opener']
+    dedup = opt.get('dedup')
+    hashes = {}
+    if dedup:
+        # Skipping files with content uploaded before
+        places = []
+        for file_place in file_places:
+            with METRICS.timer('dedup'):
+                duplicate, hashes[file_place] = dedup.find(file_place)
+            if duplicate:
+                skip_duplicate(file_place, duplicate, opt)
+            else:
+                places.append(file_place)
+        file_places = places
+        if not file_places:
+            return []
+
+    if not silent_:
+        print 'SENDING BATCH OF %s FILES: %s' % (len(file_places), ', '.join(file_places))
+    work_files = []
+    controller = opt.get('concurrency_controller')
+    started = time.time()
+    try:
+        form = MultiPartForm()
+        for file_place in file_places:
+            work_file = open_upload_file(file_place, opt)
+            work_files.append(work_file)
+            form.add_file(
+                'file', get_full_filename(file_place), file_handle=work_file, current_mimetype=opt['mimetype']
+            )
+        request = urllib2.Request(opt['host'] + opt['batch_url'])
+        request.add_header('User-agent', opt['user_agent'])
+        request.add_header('Content-type', form.get_content_type())
+        request.add_header('Content-length', form.get_content_length())
+        # Hashes of files content for deduplication index are computed while they are sent
+        body = form.get_body(hash_files=bool(dedup), zero_copy=opt.get('zero_copy'))
+        request.add_data(body)
+        with METRICS.timer('send'):
+            response = opener.open(request)
+        for file_place, digest in zip(file_places, body.digests):
+            hashes[file_place] = hashes.get(file_place) or digest.hexdigest()
+        results = json.loads(response.fp.read())
+        if controller is not None:
+            controller.record(time.time() - started, form.get_content_length())
+        METRICS.count('bytes_sent', form.get_content_length())
+        METRICS.count('batches')
+    except urllib2.HTTPError, e:
+        if controller is not None:
+            controller.record(time.time() - started, 0, e)
+        if e.code in BATCH_NOT_SUPPORTED_CODES:
+            message = 'Bulk upload API is not supported by server (%s), sending files one by one.' % e
+            write_successlog(opt['batch_url'], message=message)
+            if not silent_:
+                print message
+            opt['batch_url'] = None
+        else:
+            raise_error('Batch upload failed: %s' % e, retry=True)
+        return file_places
+    except (urllib2.URLError, httplib.HTTPException, socket.error), e:
+        if controller is not None:
+            controller.record(time.time() - started, 0, e)
+        raise_error('Batch upload failed: %s' % e, retry=True)
+        return file_places
+    except ValueError:
+        raise_error('No Json returned from bulk upload API for files: %s' % ', '.join(file_places), retry=True)
+        return file_places
+    finally:
+        for work_file in work_files:
+            work_file.close()
+
+    failed = []
+    if not isinstance(results, list) or len(results) != len(file_places):
+        raise_error('Unexpected bulk upload API response: %s' % results, retry=True)
+        return file_places
+    for file_place, result in zip(file_places, results):
+        if not isinstance(result, dict) or 'code' not in result:
+            if not silent_:
+                print 'SERVER RESPONSE: %s for file %s in batch' % (result, file_place)
+            write_successlog(file_place, message='Upload in batch failed, %s. Will send alone file:' % result)
+            failed.append(file_place)
+            continue
+        try:
+            uploaded = batch_file_uploaded(file_place, result['code'], hashes.get(file_place), opt)
+        except (urllib2.URLError, httplib.HTTPException, socket.error, ValueError), e:
+            # Files of the batch finished already are not sent again
+            raise_error('File uploaded check error %s: %s' % (get_full_filename(file_place), e), retry=True)
+            uploaded = False
+        if not uploaded:
+            failed.append(file_place)
+    return failed
+
+
+def batch_file_uploaded(file_place, uploaded_code, content_hash, opt):
+    """Checks file of the batch is stored (if file revisions API is configured) and finishes its upload"""
+    if opt['fileinfo_loc']:
+        if 'verifier' in opt:
+            opt['verifier'].submit(file_place, uploaded_code, content_hash)
+            return True
+        if not check_file_uploaded(file_place, dict(opt, uploaded_code=uploaded_code), opt['opener']):
+            raise_error('File uploaded check failed %s' % get_full_filename(file_place), retry=True)
+            return False
+    finish_upload(file_place, opt, uploaded_code, content_hash)
+    return True
+
+
+###########################################################################################
+################################# MULTI-TARGET FAN-OUT ####################################
+###########################################################################################
+class FanOut(object):
+    """Uploads every file to several DMS instances (targets), reading it from disk once.
+
+    File is streamed to all the targets at the same time, each from its own thread and connection.
+    Targets having the file are remembered, so retries go only to the targets that failed,
+    until the file changes or its last attempt ends.
+    File is logged as uploaded (and removed if configured to) only when every target has confirmed it."""
+
+    def __init__(self, targets, silent=False):
+        self.targets = targets
+        self.silent = silent
+        self.lock = threading.Lock()
+        # File name -> ((size, mtime), names of targets it is not uploaded to yet), for files failed on some targets
+        self.pending = {}
+        self.stats = dict((target.name, {'uploaded': 0, 'failed': 0}) for target in targets)
+
+    def remaining(self, file_place, stamp):
+        """Returns targets the file is not uploaded to yet. File changed since then goes to all the targets."""
+        with self.lock:
+            entry = self.pending.get(file_place)
+        if entry is None or entry[0] != stamp:
+            return list(self.targets)
+        return [target for target in self.targets if target.name in entry[1]]
+
+    def finished(self, file_place):
+        """Forgets targets failed for the file, after its last upload attempt"""
+        with self.lock:
+            self.pending.pop(file_place, None)
+
+    def upload(self, file_place, opt, content_hash=None):
+        """Uploads the file to every target not having it yet. Returns True when all targets have it."""
+        controller = opt.get('concurrency_controller')
+        started = time.time()
+        # Target name -> (uploaded, uploaded code or error)
+        results = {}
+        work_file = open(file_place, 'rb')
+        try:
+            file_stat = os.fstat(work_file.fileno())
+            stamp = (file_stat.st_size, file_stat.st_mtime)
+            targets = self.remaining(file_place, stamp)
+            size = get_file_size(work_file)
+            reader = SharedFileReader(
+                file_place, work_file, size, len(targets), bool(opt.get('dedup')) and content_hash is None
+            )
+            threads = []
+            for number, target in enumerate(targets[1:], 1):
+                thread = threading.Thread(
+                    target=target.upload,
+                    args=(file_place, reader.cursor(number), results),
+                    name='fanout-%s' % target.name,
+                )
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+            # First target is uploaded to by the calling thread itself
+            targets[0].upload(file_place, reader.cursor(0), results)
+            for thread in threads:
+                thread.join()
+        finally:
+            work_file.close()
+
+        failed = [target.name for target in targets if not results.get(target.name, (False, None))[0]]
+        with self.lock:
+            for target in targets:
+                self.stats[target.name]['failed' if target.name in failed else 'uploaded'] += 1
+            if failed:
+                self.pending[file_place] = (stamp, set(failed))
+            else:
+                self.pending.pop(file_place, None)
+        errors = [results[name][1] for name in failed if name in results]
+        if controller is not None:
+            controller.record(time.time() - started, 0 if failed else size, errors[0] if errors else None)
+        if failed:
+            if 'retry_scheduler' in opt:
+                delays = [delay for delay in map(get_retry_after, errors) if delay is not None]
+                opt['retry_scheduler'].note_retry_after(file_place, max(delays) if delays else None)
+            raise_error(
+                '%s : not uploaded to: %s' % (file_place, ', '.join(failed)), retry=opt['config_retry_on_errors']
+            )
+            return False
+        if content_hash is None:
+            content_hash = reader.hexdigest()
+        finish_upload(file_place, opt, results[targets[0].name][1], content_hash)
+        return True
+
+    def close(self):
+        for target in self.targets:
+            target.opener.pool.close()
+
+    def format(self):
+        """Returns per target upload statistics as text lines"""
+        return '\n'.join(
+            'Target %s: %s uploaded, %s failed' % (target.name, self.stats[target.name]['uploaded'],
+                                                   self.stats[target.name]['failed'])
+            for target in self.targets
+        )
+
+
+class FanOutTarget(object):
+    """Upload destination of the fan-out, with its own host, API locations, user and connections"""
+
+    def __init__(self, name, opt):
+        self.name = name
+        self.opener = build_opener(opt)
+        self.opt = dict(opt, opener=self.opener)
+
+    def upload(self, file_place, file_handle, results):
+        """Uploads the file read from file_handle and checks it is stored.
+
+        Stores (uploaded, uploaded code or error) pair in results under the target name.
+        Errors are logged, but never stop the program here, as it may run in a thread of its own."""
+        opt = self.opt
+        file_name = get_full_filename(file_place)
+        try:
+            try:
+                form = MultiPartForm()
+                form.add_file('file', file_name, file_handle=file_handle, current_mimetype=opt['mimetype'])
+                request = urllib2.Request(opt['url'] + file_name)
+                request.add_header('User-agent', opt['user_agent'])
+                request.add_header('Content-type', form.get_content_type())
+                request.add_header('Content-length', form.get_content_length())
+                request.add_data(form.get_body(count_reads=False))
+                with METRICS.timer('send'):
+                    response = self.opener.open(request)
+                METRICS.count('bytes_sent', form.get_content_length())
+                code = ''
+                if opt['fileinfo_loc']:
+                    code = json.loads(response.fp.read())
+                    if not check_file_uploaded(file_place, dict(opt, uploaded_code=code), self.opener):
+                        raise_error('File uploaded check failed %s : %s' % (self.name, file_name), retry=True)
+                        results[self.name] = (False, None)
+                        return
+                if not opt['silent']:
+                    print 'SERVER RESPONSE %s: OK' % self.name
+                results[self.name] = (True, code)
+            except ValueError:
+                raise_error('No Json returned from API %s: %s' % (self.name, file_name), retry=True)
+                results[self.name] = (False, None)
+            except (IOError, httplib.HTTPException), e:
+                if not opt['silent']:
+                    print 'SERVER RESPONSE %s: %s' % (self.name, e)
+                raise_error('%s : %s : %s' % (self.name, file_place, e), retry=True)
+                results[self.name] = (False, e)
+        finally:
+            file_handle.close()
+
+
+def get_fanout_target(chapter, opt, cfg_file_name=None, main_chapter=DEFAULT_CFG_CHAPTER):
+    """Returns fan-out target of the config file chapter.
+
+    Chapter may set host, url, API_FILEINFO_LOCATION, user and pass of the target.
+    Options it does not set, and all the others, are the ones of main options."""
+    if chapter == main_chapter:
+        # Main options, console ones included
+        return FanOutTarget(chapter, opt)
+    config = parse_config(cfg_file_name=cfg_file_name, config_chapter=chapter, _silent=True)
+    if config is None:
+        raise_error(DEFAULT_ERROR_MESSAGES['no_target'] % chapter)
+    host = config.get('host', opt['host'])
+    return FanOutTarget(chapter, dict(
+        opt,
+        host=host,
+        url=host + config.get('url', opt['url'][len(opt['host']):]),
+        username=config.get('user', opt['username']),
+        password=config.get('pass', opt['password']),
+        fileinfo_loc=config.get('API_FILEINFO_LOCATION', opt['fileinfo_loc']),
+    ))
+
+
+class SharedFileReader(object):
+    """Reads a file once for several readers, sending it at their own pace.
+
+    Blocks read from disk are kept until every reader has passed them.
+    Readers get at most window blocks ahead of the slowest one,
+    so memory held is limited and a slow target holds the others back instead of reading the file again."""
+
+    def __init__(self, file_place, file_handle, size, readers, hash_content=False, window=FANOUT_WINDOW_BLOCKS):
+        self.file_place = file_place
+        self.file_handle = file_handle
+        self.size = size
+        self.window = window
+        self.condition = threading.Condition()
+        self.blocks = {}
+        # Index of the block to read from disk next, while reading is True a reader reads it
+        self.next_block = 0
+        self.reading = False
+        # Index of the block every reader needs next, None for readers done or reading the file by themselves
+        self.positions = [0] * readers
+        self.digest = None
+        if hash_content:
+            self.digest = hashlib.new(DEDUP_HASH)
+
+    def cursor(self, number):
+        return SharedFileCursor(self, number)
+
+    def lowest(self):
+        positions = [position for position in self.positions if position is not None]
+        if not positions:
+            return self.next_block
+        return min(positions)
+
+    def get_block(self, index):
+        """Returns the block of the file by index, reading it if no reader has done it yet.
+
+        Returns None if the block is dropped already."""
+        with self.condition:
+            while index not in self.blocks:
+                if index < self.next_block:
+                    return None
+                if self.reading or self.next_block - self.lowest() >= self.window:
+                    self.condition.wait()
+                    continue
+                # Reading with lock released, so other readers can take blocks read before
+                self.reading = True
+                self.condition.release()
+                try:
+                    started = time.time()
+                    block = self.file_handle.read(FANOUT_BLOCK_SIZE)
+                    METRICS.add_time('read', time.time() - started)
+                    METRICS.count('bytes_read', len(block))
+                finally:
+                    self.condition.acquire()
+                    self.reading = False
+                    self.condition.notify_all()
+                if self.digest is not None:
+                    self.digest.update(block)
+                self.blocks[self.next_block] = block
+                self.next_block += 1
+            return self.blocks[index]
+
+    def advance(self, number, index):
+        """Moves the reader to the block, blocks no reader needs any more are dropped"""
+        with self.condition:
+            self.positions[number] = index
+            lowest = self.lowest()
+            for block_index in [block_index for block_index in self.blocks if block_index < lowest]:
+                del self.blocks[block_index]
+            self.condition.notify_all()
+
+    def hexdigest(self):
+        """Returns hash of the file content, if it is computed and the whole file is read"""
+        if self.digest is None or self.next_block * FANOUT_BLOCK_SIZE < self.size:
+            return None
+        return self.digest.hexdigest()
+
+
+class SharedFileCursor(object):
+    """File-like reader of SharedFileReader blocks for one target.
+
+    If it has to go back (e.g. to send the body again on a dropped keep-alive connection)
+    or its block is dropped already, it leaves the shared reader and reads the file by itself."""
+
+    def __init__(self, reader, number):
+        self.reader = reader
+        self.number = number
+        self.position = 0
+        self.file_handle = None
+        self.closed = False
+
+    def fileno(self):
+        return self.reader.file_handle.fileno()
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if self.file_handle is None:
+            if whence == os.SEEK_SET and offset == self.position:
+                return
+            self.read_alone()
+        self.file_handle.seek(offset, whence)
+        self.position = self.file_handle.tell()
+
+    def read_alone(self):
+        """Leaves the shared reader and opens the file to read it further by itself"""
+        self.reader.advance(self.number, None)
+        self.file_handle = open(self.reader.file_place, 'rb')
+        self.file_handle.seek(self.position)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return ''.join(iter(lambda: self.read(FANOUT_BLOCK_SIZE), ''))
+        if self.file_handle is None:
+            index, start = divmod(self.position, FANOUT_BLOCK_SIZE)
+            block = self.reader.get_block(index)
+            if block is not None:
+                data = block[start:start + size]
+                self.position += len(data)
+                if start + len(data) >= len(block):
+                    self.reader.advance(self.number, index + 1)
+                return data
+            self.read_alone()
+        data = self.file_handle.read(size)
+        self.position += len(data)
+        return data
+
+    def close(self):
+        """Lets other readers go on without this one"""
+        if self.closed:
+            return
+        self.closed = True
+        if self.file_handle is None:
+            self.reader.advance(self.number, None)
+        else:
+            self.file_handle.close()
+
+
+###########################################################################################
+################################## READ-AHEAD PREFETCH ####################################
+###########################################################################################
+
+class Prefetcher(object):
+    """Reads files waiting in the upload queue into memory in background, while other files are sent.
+
+    So disk (e.g. a spinning disk or SMB share) and network are busy at the same time,
+    instead of reading and sending every file in turn. Files are read in the order they are queued,
+    as long as content held in memory fits into budget bytes. Content is held till upload of the file ends.
+    Upload takes the content from memory, waits for the file being read, or reads the file itself
+    when it was not read ahead in time (or is larger than max_size)."""
+
+    def __init__(self, budget, max_size=None):
+        self.budget = budget
+        self.max_size = min(budget, max_size or budget)
+        self.condition = threading.Condition()
+        self.queue = collections.deque()
+        # File path: content read, or None while it is being read
+        self.files = {}
+        # File path: bytes held in memory for it
+        self.held = {}
+        self.held_bytes = 0
+        self.closed = False
+        self.stats = {'hits': 0, 'waits': 0, 'wait_seconds': 0.0, 'misses': 0, 'bytes': 0, 'peak_bytes': 0}
+        self.reader = threading.Thread(target=self.read_files, name='prefetch-reader')
+        self.reader.daemon = True
+        self.reader.start()
+
+    def submit(self, file_place):
+        """Queues file to read ahead"""
+        with self.condition:
+            self.queue.append(file_place)
+            self.condition.notify_all()
+
+    def read_files(self):
+        while True:
+            with self.condition:
+                file_place, size = self.next_file()
+                if file_place is None:
+                    return
+                self.files[file_place] = None
+                self.held[file_place] = size
+                self.held_bytes += size
+            content = None
+            started = time.time()
+            try:
+                prefetched_file = open(file_place, 'rb')
+                try:
+                    content = prefetched_file.read()
+                finally:
+                    prefetched_file.close()
+                METRICS.add_time('read', time.time() - started)
+                METRICS.count('bytes_read', len(content))
+            except (IOError, OSError):
+                # Upload reads the file itself and reports the error
+                pass
+            with self.condition:
+                if file_place not in self.files:
+                    # Discarded while it was read
+                    pass
+                elif content is None:
+                    del self.files[file_place]
+                    self.release(file_place)
+                else:
+                    self.files[file_place] = content
+                    # File may have changed since its size was taken
+                    self.held_bytes += len(content) - self.held.get(file_place, len(content))
+                    self.held[file_place] = len(content)
+                    self.stats['bytes'] += len(content)
+                    self.stats['peak_bytes'] = max(self.stats['peak_bytes'], self.held_bytes)
+                self.condition.notify_all()
+
+    def next_file(self):
+        """Returns (path, size) of the next file to read when it fits into budget, (None, None) when closed.
+
+        Must be called with the condition held."""
+        while not self.closed:
+            if not self.queue:
+                self.condition.wait()
+                continue
+            file_place = self.queue[0]
+            try:
+                size = os.path.getsize(file_place)
+            except OSError:
+                size = -1
+            if size < 0 or size > self.max_size or file_place in self.held:
+                self.queue.popleft()
+                continue
+            if self.held_bytes + size <= self.budget:
+                self.queue.popleft()
+                return file_place, size
+            # Waiting for uploads to end and release their content
+            self.condition.wait()
+        return None, None
+
+    def take(self, file_place):
+        """Returns content of the file read ahead, or None if upload must read the file from disk itself"""
+        with self.condition:
+            if file_place in self.files:
+                content = self.files[file_place]
+                if content is None:
+                    started = time.time()
+                    while self.files.get(file_place, '') is None:
+                        self.condition.wait()
+                    waited = time.time() - started
+                    self.stats['waits'] += 1
+                    self.stats['wait_seconds'] += waited
+                    METRICS.add_time('prefetch_wait', waited)
+                    content = self.files.get(file_place)
+                else:
+                    self.stats['hits'] += 1
+                # Content is held in memory by the upload now
+                self.files.pop(file_place, None)
+                if content is not None:
+                    return content
+            else:
+                try:
+                    # Not read yet, reader skips it
+                    self.queue.remove(file_place)
+                except ValueError:
+                    pass
+            self.stats['misses'] += 1
+            return None
+
+    def discard(self, file_place):
+        """Drops content of the file, when its upload ended or it is not uploaded"""
+        with self.condition:
+            self.files.pop(file_place, None)
+            self.release(file_place)
+            try:
+                self.queue.remove(file_place)
+            except ValueError:
+                pass
+            self.condition.notify_all()
+
+    def release(self, file_place):
+        self.held_bytes -= self.held.pop(file_place, 0)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.files.clear()
+            self.held.clear()
+            self.held_bytes = 0
+            self.condition.notify_all()
+        self.reader.join()
+
+    def format(self):
+        """Returns a text line of how often uploads had to wait for disk"""
+        return 'Read ahead: %(hits)s files, waited for disk: %(waits)s files (%(wait_seconds).1f seconds), ' \
+               'read by upload: %(misses)s files, peak memory used: %(peak_bytes)s bytes' % self.stats
+
+
+class PrefetchedFile(StringIO.StringIO):
+    """File content read ahead into memory, read by upload as the file itself"""
+
+
+def open_upload_file(file_place, opt):
+    """Opens file to send, from memory if it was read ahead"""
+    prefetcher = opt.get('prefetcher')
+    if prefetcher is not None:
+        content = prefetcher.take(file_place)
+        if content is not None:
+            return PrefetchedFile(content)
+    return open(file_place, 'rb')
+
+
+###########################################################################################
+################################## DEDUPLICATION INDEX ####################################
+###########################################################################################
+class DedupIndex(object):
+    """Persistent index of uploaded files content.
+
+    Maps hashes of uploaded files content to the upload results (returned code and time),
+    so files with content uploaded before are skipped without any network request.
+    Index is an sqlite database file. Safe to share between threads."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.uncommitted = 0
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.create_schema()
+
+    def create_schema(self):
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS uploads ('
+            'hash TEXT PRIMARY KEY, size INTEGER, code TEXT, file_name TEXT, uploaded REAL)'
+        )
+        self.db.execute('CREATE INDEX IF NOT EXISTS uploads_size ON uploads (size)')
+        self.db.commit()
+
+    def find(self, file_place):
+        """Returns (duplicate, content hash) pair for the file.
+
+        Content is hashed here only if some indexed file has the same size.
+        Otherwise file can not be a duplicate and (None, None) is returned,
+        leaving hash to be computed while the file is uploaded.
+        Duplicate is a (code, file name, upload time) tuple of indexed file or None."""
+        size = os.path.getsize(file_place)
+        self.lock.acquire()
+        try:
+            same_size = self.db.execute('SELECT 1 FROM uploads WHERE size = ? LIMIT 1', (size,)).fetchone()
+        finally:
+            self.lock.release()
+        if not same_size:
+            return None, None
+        content_hash = hash_file(file_place)
+        self.lock.acquire()
+        try:
+            duplicate = self.db.execute(
+                'SELECT code, file_name, uploaded FROM uploads WHERE hash = ?', (content_hash,)
+            ).fetchone()
+        finally:
+            self.lock.release()
+        return duplicate, content_hash
+
+    def add(self, content_hash, size, code, file_name):
+        """Stores upload result of the file content"""
+        self.lock.acquire()
+        try:
+            self.db.execute(
+                'INSERT OR REPLACE INTO uploads (hash, size, code, file_name, uploaded) VALUES (?, ?, ?, ?, ?)',
+                (content_hash, size, unicode(code), unicode(file_name), time.time())
+            )
+            # Committing in batches saves a disk sync for every file
+            self.uncommitted += 1
+            if self.uncommitted >= DEDUP_COMMIT_EVERY:
+                self.db.commit()
+                self.uncommitted = 0
+        finally:
+            self.lock.release()
+
+    def rebuild(self, file_places=()):
+        """Recreates index table and its indexes from the stored records, dropping broken ones,
+        then adds content of the files given (e.g. of a directory with documents stored in DMS already).
+
+        Records of files added have no code, their upload time is the file mtime.
+        Content indexed already keeps its record. Returns (records kept, records added) pair."""
+        self.lock.acquire()
+        try:
+            self.db.execute('DROP TABLE IF EXISTS uploads_rebuild')
+            self.db.execute('ALTER TABLE uploads RENAME TO uploads_rebuild')
+            self.db.execute('DROP INDEX IF EXISTS uploads_size')
+            self.create_schema()
+            self.db.execute(
+                'INSERT OR REPLACE INTO uploads (hash, size, code, file_name, uploaded) '
+                'SELECT hash, size, code, file_name, uploaded FROM uploads_rebuild '
+                'WHERE hash IS NOT NULL AND size IS NOT NULL ORDER BY uploaded'
+            )
+            self.db.execute('DROP TABLE uploads_rebuild')
+            self.db.commit()
+            kept = self.db.execute('SELECT COUNT(*) FROM uploads').fetchone()[0]
+            added = 0
+            for file_place in file_places:
+                try:
+                    st = os.stat(file_place)
+                    content_hash = hash_file(file_place)
+                except (IOError, OSError):
+                    continue
+                cursor = self.db.execute(
+                    'INSERT OR IGNORE INTO uploads (hash, size, code, file_name, uploaded) VALUES (?, ?, ?, ?, ?)',
+                    (content_hash, st.st_size, u'', unicode(get_full_filename(file_place)), st.st_mtime)
+                )
+                added += cursor.rowcount
+            self.db.commit()
+            return kept, added
+        finally:
+            self.lock.release()
+
+    def compact(self, max_age_days=0):
+        """Removes records older then days given (0 keeps all) and shrinks the database file.
+
+        Returns number of records removed."""
+        self.lock.acquire()
+        try:
+            removed = 0
+            if max_age_days:
+                cursor = self.db.execute(
+                    'DELETE FROM uploads WHERE uploaded < ?', (time.time() - max_age_days * 24 * 3600,)
+                )
+                removed = cursor.rowcount
+            self.db.commit()
+            self.db.execute('VACUUM')
+            return removed
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            self.db.commit()
+            self.db.close()
+        finally:
+            self.lock.release()
+
+
+def hash_file(file_place):
+    """Returns hex digest of the file content"""
+    digest = hashlib.new(DEDUP_HASH)
+    work_file = open(file_place, 'rb')
+    try:
+        chunk = work_file.read(MULTIPART_CHUNK_SIZE)
+        while chunk:
+            digest.update(chunk)
+            chunk = work_file.read(MULTIPART_CHUNK_SIZE)
+    finally:
+        work_file.close()
+    return digest.hexdigest()
+
+
+def get_full_filename(full_name):
+    """Extracts only filename from full path"""
+    result_name = full_name
+    if os.sep or os.pardir in full_name:
+        result_name = os.path.split(full_name)[1]
+    return result_name
+
+
+def getopts(argv):
+    """Gets options from sys.argv and transfers them into handy dictionary"""
+    opts = {}
+    while argv:
+        if argv[0][0] == '-':               # find "-name value" pairs
+            try:
+                # Getting value of this option
+                if argv[1][0] == '-':  # Next option is an argv
+                    opts[argv[0]] = ''
+                    argv = argv[1:]
+                else:
+                    opts[argv[0]] = argv[1]     # dict key is "-name" arg
+                    argv = argv[2:]
+            except IndexError:
+                # option has no argv left in the end
+                opts[argv[0]] = None
+                argv = argv[1:]
+        else:
+            argv = argv[1:]
+    return opts
+
+
+def get_option(app_args, config, arg_name, config_name, default=None):
+    """Gets option value from console params first then trying config file"""
+    if app_args.get(arg_name):
+        return app_args[arg_name]
+    if config and config.get(config_name):
+        return config[config_name]
+    return default
+
+
+def get_number_option(app_args, config, arg_name, config_name, default, number_type=int):
+    """Gets numeric option value. Breaks with error if it is not a number."""
+    value = get_option(app_args, config, arg_name, config_name, default)
+    try:
+        return number_type(value)
+    except (TypeError, ValueError):
+        raise_error(DEFAULT_ERROR_MESSAGES['no_number'] % (arg_name, config_name, value))
+
+
+def get_flag_option(app_args, config, arg_name, config_name):
+    """Gets on/off option. Console flag or config value 'yes' turns it on."""
+    if arg_name in app_args:
+        return True
+    return bool(config) and config.get(config_name) == 'yes'
+
+
+def parse_config(cfg_file_name=None, config_chapter=False, _silent=False):
+    """Parses specified config file or uses system set."""
+
+    def get_option(opt_config, opt, config_opts):
+        # looks for option and appends it to options dictionary
+        try:
+            try:
+                opt_value = opt_config.get(config_chapter or DEFAULT_CFG_CHAPTER, opt)
+                config_opts[option] = opt_value
+            except ConfigParser.NoOptionError:
+                pass
+        except ConfigParser.NoSectionError, err:
+            if not _silent:
+                print 'Config file Error:', err
+            raise_error(err)
+
+    config_instance = None
     # Getting conf file defined
     if cfg_file_name:
         config_file = cfg_file_name
@@ -419,124 +2752,2257 @@ def parse_config(cfg_file_name=None, config_chapter=False, _silent=False):
         config_file = DEFAULT_CFG_FILE
     # Trying to open file and getting default config if failed.
     try:
-        config_instance = open(os.path.join(PROJECT_PATH, config_file), "rb")
+        config_instance = open(os.path.join(PROJECT_PATH, config_file), "rb")
+
+    except IOError, e:
+        if not _silent:
+            print e
+            print 'Trying to read standard config file: ./' + DEFAULT_CFG_FILE
+        # Trying to get config from default file if exists
+        try:
+            config_instance = open(DEFAULT_CFG_FILE, "rb")
+        except IOError, e:
+            if not _silent:
+                print e
+                print 'Not found standard config. can now function only with console params'
+        pass
+
+    if not config_instance:
+        if not _silent:
+            print 'config used ......................................................no'
+        return None
+    # Warning! allow_no_value may cause bugs in Python < 2.7
+    cfg = ConfigParser.RawConfigParser()  # allow_no_value=True)
+    cfg.readfp(config_instance)
+
+    config_options = {}
+    for option in DEFAULT_CFG_OPTIONS:
+        get_option(cfg, option, config_options)
+
+    if not _silent:
+        print 'config used ......................................................yes'
+    return config_options
+
+
+def raise_error(message=None, error_level=1, retry=False):
+    """Breaks program with error, message provided.
+
+    Writes down error text to file."""
+    if message:
+        get_log_sink(ERROR_FILE_MAIN).write('error', str(message))
+        write_successlog('Error!', message=message)
+    print message
+    if not retry:
+        sys.exit(error_level)
+
+
+def write_successlog(file_name, message=''):
+    """Writes down action of succeeded sending."""
+    if message:
+        get_log_sink(LOG_FILE_MAIN).write('message', message + u' ' + unicode(file_name), file_name)
+    else:
+        get_log_sink(LOG_FILE_MAIN).write('uploaded', 'UPLOAD SUCCESSFUL of file: %s' % str(file_name), file_name)
+
+
+class LogSink(object):
+    """Buffered writer of a log file shared by all upload workers.
+
+    File is kept open and records are written in batches: when flush_size bytes are buffered
+    and every flush_interval seconds.
+    Records are written as the text blocks with date line, or as json lines in 'json' format.
+    flush_interval of 0 writes every record at once."""
+
+    def __init__(self, path, log_format=LOG_FORMAT_TEXT, flush_interval=DEFAULT_LOG_FLUSH_INTERVAL,
+                 flush_size=DEFAULT_LOG_FLUSH_SIZE):
+        self.path = path
+        self.log_format = log_format
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.buffered = 0
+        self.log_file = None
+        self.flusher = None
+        self.closed = threading.Event()
+
+    def format_record(self, level, message, file_name=None):
+        now = datetime.datetime.now()
+        if self.log_format == LOG_FORMAT_JSON:
+            record = {'time': now.isoformat(), 'level': level, 'message': message}
+            if file_name is not None:
+                record['file'] = file_name
+            return json.dumps(record) + '\n'
+        text = LOG_RECORD_LINE + str(now) + '\n' + LOG_RECORD_LINE[1:] + message
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        return text
+
+    def write(self, level, message, file_name=None):
+        record = self.format_record(level, message, file_name)
+        self.lock.acquire()
+        try:
+            self.buffer.append(record)
+            self.buffered += len(record)
+            if self.buffered >= self.flush_size or self.flush_interval <= 0:
+                self.flush_buffer()
+            elif self.flusher is None:
+                self.flusher = threading.Thread(target=self.flush_periodically, name='log-flusher')
+                self.flusher.daemon = True
+                self.flusher.start()
+        finally:
+            self.lock.release()
+
+    def flush_buffer(self):
+        """Writes buffered records out. Must be called with the lock held."""
+        if not self.buffer:
+            return
+        if self.log_file is None:
+            self.log_file = open(self.path, 'ab')
+        self.log_file.write(''.join(self.buffer))
+        self.log_file.flush()
+        self.buffer = []
+        self.buffered = 0
+
+    def flush(self):
+        self.lock.acquire()
+        try:
+            self.flush_buffer()
+        finally:
+            self.lock.release()
+
+    def flush_periodically(self):
+        while not self.closed.is_set():
+            self.closed.wait(self.flush_interval if self.flush_interval > 0 else DEFAULT_LOG_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except IOError, e:
+                print 'Log %s write error: %s' % (self.path, e)
+
+    def close(self):
+        self.closed.set()
+        if self.flusher is not None and self.flusher is not threading.current_thread():
+            self.flusher.join()
+        self.lock.acquire()
+        try:
+            # Records written after closing go straight to the file
+            self.flush_interval = 0
+            self.flush_buffer()
+            if self.log_file is not None:
+                self.log_file.close()
+                self.log_file = None
+        finally:
+            self.lock.release()
+
+
+def get_log_sink(path):
+    """Returns log sink writing the file, created with settings from LOG_SETTINGS"""
+    LOG_LOCK.acquire()
+    try:
+        if path not in LOG_SINKS:
+            LOG_SINKS[path] = LogSink(path, **LOG_SETTINGS)
+        return LOG_SINKS[path]
+    finally:
+        LOG_LOCK.release()
+
+
+def configure_logs(log_format, flush_interval, flush_size):
+    """Sets format and flush thresholds of all log files"""
+    LOG_LOCK.acquire()
+    try:
+        LOG_SETTINGS.update(log_format=log_format, flush_interval=flush_interval, flush_size=flush_size)
+        for sink in LOG_SINKS.values():
+            sink.flush()
+            sink.log_format = log_format
+            sink.flush_interval = flush_interval
+            sink.flush_size = flush_size
+    finally:
+        LOG_LOCK.release()
+
+
+def close_logs():
+    """Writes out all buffered log records. Called at exit."""
+    LOG_LOCK.acquire()
+    try:
+        for sink in LOG_SINKS.values():
+            sink.close()
+        LOG_SINKS.clear()
+    finally:
+        LOG_LOCK.release()
+
+
+atexit.register(close_logs)
+
+
+def walk_directory(rootdir, f_type=None, snapshot=None, order=UPLOAD_ORDER_SCAN, threads=DEFAULT_SCAN_THREADS):
+    """Walks through directory with files of provided format and
+
+    yields their name with path (ready to open) as soon as they are found.
+    Directory may be a list of directories, file type may be a FileMatcher.
+    With directory snapshot given yields only files new or changed since the last run.
+    With order other then 'scan' the whole tree is scanned first, then files are yielded in that order."""
+    if order == UPLOAD_ORDER_SCAN:
+        return iter(DirectoryScanner(rootdir, f_type, snapshot, threads=threads))
+    return schedule_files(DirectoryScanner(rootdir, f_type, snapshot, stat_files=True, threads=threads), order)
+
+
+def schedule_files(files, order):
+    """Returns iterator of file paths sorted in the upload order, from (file path, os.stat() result) pairs.
+
+    Orders:
+        largest - largest files first, so no worker is left with a huge file at the end of the run,
+        smallest - smallest files first, for the most files uploaded soon after the start,
+        oldest - least recently modified files first, for files waiting longest to be uploaded first.
+    Files of the same key keep the scan order. Only (key, path) pairs are held in memory."""
+    if order == UPLOAD_ORDER_LARGEST:
+        queue = [(-st.st_size, file_place) for file_place, st in files]
+    elif order == UPLOAD_ORDER_SMALLEST:
+        queue = [(st.st_size, file_place) for file_place, st in files]
+    else:
+        queue = [(st.st_mtime, file_place) for file_place, st in files]
+    with METRICS.timer('schedule'):
+        queue.sort(key=lambda item: item[0])
+    return (file_place for key, file_place in queue)
+
+
+class DirectoryScanner(object):
+    """Lazy directory tree walker.
+
+    Yields files one by one while the tree is being read, so uploads start immediately.
+    Directories waiting to be scanned are kept as (parent path, name) pairs,
+    with one parent path string shared by all its subdirectories,
+    instead of the full path strings of all files found.
+    Root directory may be a list of directories, files to yield are told by FileMatcher or file type.
+    With stat_files set yields (file path, os.stat() result) pairs, stat taken while listing is reused for that.
+    With several threads directories are read in parallel, for network file systems
+    where reading a directory is mostly waiting for the server. Then files come in no particular order."""
+
+    def __init__(self, rootdir, f_type=None, snapshot=None, stat_files=False, threads=DEFAULT_SCAN_THREADS):
+        if not isinstance(rootdir, (list, tuple)):
+            rootdir = [rootdir]
+        self.roots = [strip_directory(root) for root in rootdir]
+        self.rootdir = self.roots[0]
+        self.snapshot = snapshot
+        self.stat_files = stat_files
+        self.threads = max(threads, 1)
+        self.matcher = f_type
+        if not isinstance(f_type, FileMatcher):
+            self.matcher = FileMatcher(f_type)
+
+    def matches(self, name):
+        return self.matcher.matches(name)
+
+    def __iter__(self):
+        if self.threads > 1:
+            return self.scan_parallel()
+        return self.scan_tree()
+
+    def scan_tree(self):
+        pending = [(None, root) for root in reversed(self.roots)]
+        while pending:
+            # Time of the directory reading, without time spent by the caller between files
+            started = time.time()
+            parent, name = pending.pop()
+            if parent is None:
+                directory = name
+            else:
+                directory = intern_path(os.path.join(parent, name))
+            subdirs = []
+            for file_place in self.list_files(directory, subdirs):
+                METRICS.add_time('scan', time.time() - started, 0)
+                yield file_place
+                started = time.time()
+            METRICS.add_time('scan', time.time() - started)
+            # Keeping os.walk() order of subdirectories
+            for entry_name in reversed(subdirs):
+                pending.append((directory, entry_name))
+
+    def scan_parallel(self):
+        """Yields files found by scanner threads, each reading a directory at a time"""
+        directories = Queue.Queue()
+        found = Queue.Queue(maxsize=SCAN_QUEUE_SIZE)
+        # Number of directories queued or being read. All are read when it comes to 0.
+        pending = [len(self.roots)]
+        lock = threading.Lock()
+        for root in self.roots:
+            directories.put((None, root))
+
+        def scanner():
+            while True:
+                item = directories.get()
+                if item is None:
+                    return
+                parent, name = item
+                if parent is None:
+                    directory = name
+                else:
+                    directory = intern_path(os.path.join(parent, name))
+                subdirs = []
+                try:
+                    started = time.time()
+                    for file_place in self.list_files(directory, subdirs):
+                        found.put(file_place)
+                    METRICS.add_time('scan', time.time() - started)
+                finally:
+                    with lock:
+                        pending[0] += len(subdirs) - 1
+                        done = not pending[0]
+                    for entry_name in subdirs:
+                        directories.put((directory, entry_name))
+                    if done:
+                        found.put(None)
+
+        threads = []
+        for i in range(self.threads):
+            thread = threading.Thread(target=scanner, name='directory-scanner-%s' % i)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        try:
+            while True:
+                try:
+                    # Waiting with timeout keeps main thread responsive to Ctrl+C
+                    file_place = found.get(timeout=UPLOAD_QUEUE_TIMEOUT)
+                except Queue.Empty:
+                    continue
+                if file_place is None:
+                    break
+                yield file_place
+        finally:
+            for thread in threads:
+                directories.put(None)
+        # Threads are idle now, waiting for the stop
+        for thread in threads:
+            thread.join()
+
+    def list_files(self, directory, subdirs):
+        """Returns matching files of the directory, new or changed ones only if snapshot is used"""
+        if self.snapshot is None:
+            files = self.scan(directory, subdirs, self.stat_files)
+        else:
+            files = self.snapshot.scan(directory, self, subdirs)
+        if not self.stat_files:
+            files = (file_place for file_place, st in files)
+        return files
+
+    def scan(self, directory, subdirs, stat_files=False):
+        """Yields (file path, os.stat() result) pairs of matching files of the directory,
+        collecting names of its subdirectories not excluded.
+
+        Without stat_files set stat result is None, unless it was taken to list the directory anyway."""
+        matcher = self.matcher
+        for entry_name, is_dir, st in list_directory(directory, stat_files):
+            if is_dir:
+                if not matcher.excludes_directory(entry_name):
+                    subdirs.append(entry_name)
+            elif matcher.matches(entry_name):
+                yield os.path.join(directory, entry_name), st
+
+
+def strip_directory(directory):
+    """Returns directory path without trailing separator, the same as os.path.dirname() of its files"""
+    stripped = directory.rstrip('/' + os.sep)
+    if stripped and not stripped.endswith(':'):
+        return stripped
+    return directory
+
+
+class FileMatcher(object):
+    """Tells files to upload by their names.
+
+    Rules are shell-style wildcards (e.g. '*.pdf', '~$*') or regular expressions after 're:' prefix,
+    searched in the name (e.g. 're:^scan_\\d+'). All include and exclude rules are compiled into one
+    regular expression. File matches if its name matches any include rule, or has one of the file types
+    if there are no include rules, and matches no exclude rule.
+    Exclude rules ending with '/' match names of directories, skipped with all their files.
+    Lease files and the claims directory of WorkClaims are always excluded, whatever the rules are."""
+
+    def __init__(self, f_types=None, include=(), exclude=()):
+        self.f_types = tuple(get_file_types(f_types))
+        self.include = tuple(include)
+        self.exclude = tuple(rule for rule in exclude if not rule.endswith('/'))
+        self.exclude_dirs = tuple(rule[:-1] for rule in exclude if rule.endswith('/'))
+        # Key of the files set matched, for the directory snapshot
+        self.rules = (self.f_types, self.include, self.exclude, self.exclude_dirs)
+        if self.include:
+            pattern = '|'.join(compile_rule(rule) for rule in self.include)
+        elif self.f_types:
+            # Same as os.path.splitext() extension: name is not just dots and extension
+            pattern = r'\.*[^.].*\.(?:%s)\Z' % '|'.join(re.escape(f_type) for f_type in self.f_types)
+        else:
+            pattern = ''
+        # Lease files, also while a stale one is taken over as '<lease file>.<instance>'
+        excludes = [r'.*?%s(?:\Z|\.)' % re.escape(CLAIM_LEASE_SUFFIX)]
+        excludes.extend(compile_rule(rule) for rule in self.exclude)
+        pattern = '(?!%s)(?:%s)' % ('|'.join(excludes), pattern)
+        self.matcher = re.compile(pattern, re.S)
+        exclude_dirs = [r'%s\Z' % re.escape(CLAIM_DIR)]
+        exclude_dirs.extend(compile_rule(rule) for rule in self.exclude_dirs)
+        self.dir_matcher = re.compile('|'.join(exclude_dirs), re.S)
+
+    def matches(self, name):
+        return self.matcher.match(name) is not None
+
+    def excludes_directory(self, name):
+        return self.dir_matcher.match(name) is not None
+
+
+def split_rules(rules):
+    """Returns list of comma separated file name rules"""
+    return [rule.strip() for rule in rules.split(',') if rule.strip()]
+
+
+def get_file_types(f_types):
+    """Returns list of file types from comma separated ones, e.g. 'pdf,tif'"""
+    if not f_types:
+        return []
+    return [f_type.strip().lstrip('.') for f_type in str(f_types).split(',') if f_type.strip()]
+
+
+def compile_rule(rule):
+    """Returns regular expression of a file name rule, matching from the start of the name"""
+    if rule.startswith('re:'):
+        pattern = '.*?(?:%s)' % rule[3:]
+    else:
+        pattern = fnmatch.translate(rule)
+        # Flags are set for the whole expression
+        if pattern.endswith('(?ms)'):
+            pattern = pattern[:-len('(?ms)')]
+        pattern = '(?:%s)' % pattern
+    try:
+        re.compile(pattern)
+    except re.error, e:
+        raise_error(DEFAULT_ERROR_MESSAGES['no_rule'] % (rule, e))
+    return pattern
+
+
+class DirectorySnapshot(object):
+    """State of the scanned directory tree, saved between runs.
+
+    Keeps (size, mtime, inode) of found files and mtime of every directory.
+    Directories with mtime unchanged since the last run are not read again,
+    (their subdirectories are still checked) and only files new or changed are yielded.
+    Files failed to upload are forgotten, so they are tried again on the next run.
+
+    Note: mtime of a directory changes when files are created, removed or renamed in it,
+    not when existing file is rewritten in place."""
+
+    def __init__(self, path, rootdir, f_type=None, full_scan=False):
+        self.path = path
+        if not isinstance(rootdir, (list, tuple)):
+            rootdir = [rootdir]
+        self.scope = (tuple(os.path.abspath(root) for root in rootdir), getattr(f_type, 'rules', f_type))
+        self.lock = threading.Lock()
+        # Directory path: (mtime, time scanned, subdirectories, {file name: (size, mtime, inode)})
+        self.dirs = {}
+        self.old_dirs = {}
+        # Directory path: names of files failed before the directory was stored
+        self.failed = {}
+        if not full_scan:
+            self.load()
+
+    def load(self):
+        try:
+            snapshot_file = open(self.path, 'rb')
+        except IOError:
+            return
+        try:
+            try:
+                data = cPickle.load(snapshot_file)
+            except Exception:
+                # Broken snapshot only means a full scan
+                return
+        finally:
+            snapshot_file.close()
+        if data.get('version') == SNAPSHOT_VERSION and data.get('scope') == self.scope:
+            self.old_dirs = data['dirs']
+
+    def save(self):
+        """Writes snapshot of this run replacing the old one"""
+        temp_path = self.path + '.tmp'
+        snapshot_file = open(temp_path, 'wb')
+        try:
+            self.lock.acquire()
+            try:
+                data = {'version': SNAPSHOT_VERSION, 'scope': self.scope, 'dirs': self.dirs}
+                cPickle.dump(data, snapshot_file, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                self.lock.release()
+        finally:
+            snapshot_file.close()
+        if os.name == 'nt' and os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(temp_path, self.path)
+
+    def scan(self, directory, scanner, subdirs):
+        """Yields files of the directory new or changed since the last run, collecting its subdirectories.
+
+        Files are yielded as (file path, os.stat() result) pairs."""
+        try:
+            dir_mtime = os.stat(directory).st_mtime
+        except OSError:
+            return
+        scanned = time.time()
+        old = self.old_dirs.get(directory)
+        # Directory changed within mtime resolution of the last scan is read again to be sure
+        if old is not None and old[0] == dir_mtime and dir_mtime < old[1] - SNAPSHOT_MTIME_SLACK:
+            subdirs.extend(old[2])
+            self.store(directory, old)
+            return
+        old_files = {}
+        if old is not None:
+            old_files = old[3]
+        files = {}
+        names = []
+        for file_place, st in scanner.scan(directory, names, stat_files=True):
+            file_name = os.path.basename(file_place)
+            record = (st.st_size, st.st_mtime, st.st_ino)
+            files[file_name] = record
+            if old_files.get(file_name) != record:
+                yield file_place, st
+        subdirs.extend(names)
+        self.store(directory, (dir_mtime, scanned, tuple(names), files))
+
+    def store(self, directory, state):
+        self.lock.acquire()
+        try:
+            # Files are yielded while the directory is read, so some can fail before it is stored
+            failed = self.failed.pop(directory, None)
+            if failed:
+                files = dict(state[3])
+                for file_name in failed:
+                    files.pop(file_name, None)
+                state = (None,) + state[1:3] + (files,)
+            self.dirs[directory] = state
+        finally:
+            self.lock.release()
+
+    def forget(self, file_place):
+        """Drops file failed to upload, so the next run tries it again"""
+        directory, file_name = os.path.split(file_place)
+        self.lock.acquire()
+        try:
+            state = self.dirs.get(directory)
+            if state is not None:
+                state[3].pop(file_name, None)
+                # Unknown directory mtime makes next run read it again
+                self.dirs[directory] = (None,) + state[1:]
+            else:
+                self.failed.setdefault(directory, set()).add(file_name)
+        finally:
+            self.lock.release()
+
+
+def intern_path(path):
+    """Returns shared copy of a path string"""
+    if isinstance(path, str):
+        return intern(path)
+    return path
+
+
+def list_directory(directory, stat_files=False):
+    """Yields (name, is directory, os.stat() result of a file) triples of the directory entries.
+
+    Symbolic links to directories are skipped, as os.walk() does.
+    Uses scandir() where available to tell directories without a stat() call for every entry,
+    then files are stat only with stat_files set (stat result is None otherwise).
+    Without scandir() every entry is stat once, and the result is given for files anyway.
+    Entries gone or broken symbolic links are skipped when they are stat."""
+    if scandir is not None:
+        try:
+            entries = scandir(directory)
+        except OSError:
+            return
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        yield entry.name, True, None
+                elif stat_files:
+                    yield entry.name, False, entry.stat()
+                else:
+                    yield entry.name, False, None
+            except OSError:
+                pass
+        return
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(directory, name)
+        try:
+            st = os.lstat(path)
+            is_link = stat.S_ISLNK(st.st_mode)
+            if is_link:
+                st = os.stat(path)
+        except OSError:
+            continue
+        if stat.S_ISDIR(st.st_mode):
+            if not is_link:
+                yield name, True, None
+        else:
+            yield name, False, st
+
+
+###########################################################################################
+################################### DIRECTORY WATCHER #####################################
+###########################################################################################
+def watch_directory(rootdir, f_type=None, settle=DEFAULT_WATCH_SETTLE, interval=DEFAULT_WATCH_INTERVAL):
+    """Yields files of provided format as soon as they are fully written into directory.
+
+    Files found in directory at start are yielded too. Never stops.
+    Uses Linux inotify where available, polling directory every interval seconds otherwise."""
+    try:
+        watcher = InotifyWatcher(rootdir, f_type, settle)
+    except (OSError, AttributeError):
+        watcher = PollingWatcher(rootdir, f_type, settle, interval)
+    return iter(watcher)
+
+
+class InotifyWatcher(object):
+    """Directory tree watcher subscribed to Linux inotify events.
+
+    A file is ready when it is closed after writing or moved into the tree,
+    or when it had no changes for settle seconds (e.g. found at start).
+    New subdirectories are watched as they appear."""
+
+    def __init__(self, rootdir, f_type=None, settle=DEFAULT_WATCH_SETTLE):
+        self.scanner = DirectoryScanner(rootdir, f_type)
+        self.settle = settle
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init() failed')
+        # Watch descriptor: directory path
+        self.watches = {}
+        # File path: time of the last change
+        self.pending = {}
+        self.ready = collections.deque()
+        # File path: (size, mtime) when yielded
+        self.yielded = {}
+
+    def __iter__(self):
+        for root in self.scanner.roots:
+            self.add_tree(root)
+        while True:
+            while self.ready:
+                file_place = self.ready.popleft()
+                if changed_since_yielded(file_place, self.yielded):
+                    yield file_place
+            timeout = None
+            if self.pending:
+                timeout = WATCH_CHECK_INTERVAL
+            try:
+                readable = select.select([self.fd], [], [], timeout)[0]
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                readable = []
+            if readable:
+                self.read_events()
+            self.check_pending()
+
+    def add_tree(self, directory):
+        """Watches directory with its subdirectories. Files already there wait to settle."""
+        now = time.time()
+        pending = [directory]
+        while pending:
+            directory = pending.pop()
+            encoded = directory
+            if isinstance(directory, unicode):
+                encoded = directory.encode(sys.getfilesystemencoding())
+            wd = self.libc.inotify_add_watch(self.fd, encoded, INOTIFY_WATCH_MASK)
+            if wd < 0:
+                continue
+            self.watches[wd] = directory
+            for name, is_dir, st in list_directory(directory):
+                if is_dir:
+                    if not self.scanner.matcher.excludes_directory(name):
+                        pending.append(os.path.join(directory, name))
+                elif self.scanner.matches(name):
+                    self.pending.setdefault(os.path.join(directory, name), now)
+
+    def read_events(self):
+        data = os.read(self.fd, INOTIFY_READ_SIZE)
+        offset = 0
+        while offset + INOTIFY_EVENT_SIZE <= len(data):
+            wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+            name = data[offset + INOTIFY_EVENT_SIZE:offset + INOTIFY_EVENT_SIZE + length].rstrip('\0')
+            offset += INOTIFY_EVENT_SIZE + length
+            self.handle_event(wd, mask, name)
+
+    def handle_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            # Events were lost. Rereading the whole tree.
+            for root in self.scanner.roots:
+                self.add_tree(root)
+            return
+        directory = self.watches.get(wd)
+        if directory is None:
+            return
+        if mask & IN_IGNORED:
+            del self.watches[wd]
+            return
+        if not name:
+            return
+        path = os.path.join(directory, name)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO) and not self.scanner.matcher.excludes_directory(name):
+                self.add_tree(path)
+            return
+        if not self.scanner.matches(name):
+            return
+        if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+            self.pending.pop(path, None)
+            self.ready.append(path)
+        elif mask & (IN_CREATE | IN_MODIFY):
+            self.pending[path] = time.time()
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+            self.pending.pop(path, None)
+            self.yielded.pop(path, None)
+
+    def check_pending(self):
+        """Makes files with no changes for settle seconds ready"""
+        deadline = time.time() - self.settle
+        for path, changed in self.pending.items():
+            if changed <= deadline:
+                del self.pending[path]
+                self.ready.append(path)
+
+
+class PollingWatcher(object):
+    """Directory tree watcher reading the tree every interval seconds.
+
+    A file is ready when its size and mtime did not change for settle seconds."""
+
+    def __init__(self, rootdir, f_type=None, settle=DEFAULT_WATCH_SETTLE, interval=DEFAULT_WATCH_INTERVAL):
+        self.rootdir = rootdir
+        self.f_type = f_type
+        self.settle = settle
+        self.interval = interval
+        # File path: ((size, mtime), time first seen so)
+        self.files = {}
+        # File path: (size, mtime) when yielded
+        self.yielded = {}
+
+    def __iter__(self):
+        while True:
+            now = time.time()
+            found = {}
+            for path, st in DirectoryScanner(self.rootdir, self.f_type, stat_files=True):
+                state = (st.st_size, st.st_mtime)
+                known = self.files.get(path)
+                if known is None or known[0] != state:
+                    known = (state, now)
+                found[path] = known
+                if now - known[1] >= self.settle and changed_since_yielded(path, self.yielded):
+                    yield path
+            self.files = found
+            # Forgetting files gone from the directory
+            for path in self.yielded.keys():
+                if path not in found:
+                    del self.yielded[path]
+            time.sleep(self.interval)
+
+
+def changed_since_yielded(file_place, yielded):
+    """Checks file exists and is not the same as when it was yielded last time. Remembers it as yielded."""
+    try:
+        st = os.stat(file_place)
+    except OSError:
+        return False
+    state = (st.st_size, st.st_mtime)
+    if yielded.get(file_place) == state:
+        return False
+    yielded[file_place] = state
+    return True
+
+
+def remove_file(file_path):
+    """Deletes file with path specified from filesystem"""
+    if os.path.exists(file_path):
+        try:
+            os.remove(file_path)
+            write_successlog(file_path, ' Success removing file:')
+        except Exception, e:
+            raise_error("%s : %s""" % (file_path, e))
+    else:
+        raise_error(DEFAULT_ERROR_MESSAGES['no_file'] + ': ' + file_path)
+
+
+def retry_upload(retries_count, name, opt):
+    """Retries upload of file given amount of times.
+
+    Waits between attempts with exponential backoff, or as long as server asks with Retry-After header.
+    Used for a single file, upload workers put failed files on the retry scheduler instead."""
+    silent_ = opt['silent']
+    scheduler = RetryScheduler(retries_count, opt['retry_base_delay'], opt['retry_max_delay'])
+    opt = dict(opt, retry_scheduler=scheduler)
+    counter = 1
+    uploaded = False
+    while counter <= retries_count:
+        uploaded = False
+        if not silent_:
+            print 'Upload attempt #%s' % counter
+        try:
+            counter += 1
+            uploaded = upload_file(name, opt)
+        except Exception, e:
+            message = 'Exception with upload! Will retry...'
+            write_successlog(message, message=str(e))
+            if not silent_:
+                print '%s %s' % (message, str(e))
+            pass
+        if uploaded:
+            break
+        if counter <= retries_count:
+            time.sleep(scheduler.get_delay(counter - 1, scheduler.pop_retry_after(name)))
+    return uploaded
+
+
+class RetryScheduler(object):
+    """Delay queue of failed uploads.
+
+    Failed file is put back to be uploaded again after a delay growing exponentially with attempt number,
+    with random jitter so retries of many files do not come at once.
+    Delay asked by server with Retry-After header is used when it is longer.
+    Files are given up after max_attempts."""
+
+    def __init__(self, max_attempts=UPLOAD_RETRIES_COUNT, base_delay=DEFAULT_RETRY_BASE_DELAY,
+                 max_delay=DEFAULT_RETRY_MAX_DELAY):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.condition = threading.Condition(threading.Lock())
+        # Heap of (due time, sequence number, file name, attempt)
+        self.delayed = []
+        self.sequence = itertools.count()
+        self.retry_after = {}
+        self.closed = False
+
+    def __len__(self):
+        return len(self.delayed)
+
+    def get_delay(self, attempt, retry_after=None):
+        """Returns seconds to wait after failed attempt number given"""
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        # Equal jitter: half of the delay is kept, another half is random
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+    def note_retry_after(self, name, seconds):
+        """Remembers delay server asked for before next upload of the file"""
+        if seconds is not None:
+            self.condition.acquire()
+            try:
+                self.retry_after[name] = seconds
+            finally:
+                self.condition.release()
+
+    def pop_retry_after(self, name):
+        self.condition.acquire()
+        try:
+            return self.retry_after.pop(name, None)
+        finally:
+            self.condition.release()
+
+    def schedule(self, name, attempt):
+        """Puts file failed on attempt given to the queue. Returns delay or None if attempts are over."""
+        retry_after = self.pop_retry_after(name)
+        if attempt >= self.max_attempts:
+            return None
+        delay = self.get_delay(attempt, retry_after)
+        self.condition.acquire()
+        try:
+            heapq.heappush(self.delayed, (time.time() + delay, self.sequence.next(), name, attempt + 1))
+            self.condition.notify()
+        finally:
+            self.condition.release()
+        return delay
+
+    def pop_due(self):
+        """Returns (file name, attempt) of a retry due now or None"""
+        self.condition.acquire()
+        try:
+            if self.delayed and self.delayed[0][0] <= time.time():
+                due, sequence, name, attempt = heapq.heappop(self.delayed)
+                return name, attempt
+            return None
+        finally:
+            self.condition.release()
+
+    def next_due(self):
+        """Returns seconds left to the nearest retry or None if there are no retries"""
+        self.condition.acquire()
+        try:
+            if not self.delayed:
+                return None
+            return max(self.delayed[0][0] - time.time(), 0)
+        finally:
+            self.condition.release()
+
+    def get(self):
+        """Waits for a retry to get due. Returns (file name, attempt) or None when scheduler is closed."""
+        self.condition.acquire()
+        try:
+            while not self.closed:
+                now = time.time()
+                if self.delayed and self.delayed[0][0] <= now:
+                    due, sequence, name, attempt = heapq.heappop(self.delayed)
+                    return name, attempt
+                timeout = UPLOAD_QUEUE_TIMEOUT
+                if self.delayed:
+                    timeout = min(timeout, self.delayed[0][0] - now)
+                self.condition.wait(timeout)
+            return None
+        finally:
+            self.condition.release()
+
+    def close(self):
+        self.condition.acquire()
+        try:
+            self.closed = True
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+
+
+def get_retry_after(error):
+    """Returns seconds from Retry-After header of HTTP error response or None"""
+    headers = getattr(error, 'hdrs', None)
+    if headers is None or not hasattr(headers, 'getheader'):
+        return None
+    value = headers.getheader('Retry-After')
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return None
+    return max(email.utils.mktime_tz(date) - time.time(), 0)
+
+
+def report_retry(name, attempt, delay, opt):
+    """Logs file upload put off for a retry"""
+    METRICS.count('retries')
+    message = 'Upload attempt #%s failed, will retry in %.1f seconds. For file:' % (attempt, delay)
+    write_successlog(name, message=message)
+    if not opt['silent']:
+        print '%s %s' % (message, name)
+
+
+def upload_files(file_names, opt, workers=DEFAULT_WORKERS):
+    """Uploads files with a pool of worker threads.
+
+    File names are taken from the iterable given as workers get free,
+    through a queue of limited size, so the whole list is never held in memory.
+    With bulk upload API configured, a worker takes small files waiting in the queue as one batch.
+    Returns dictionary of upload statistics."""
+    stats = {'files': 0, 'uploaded': 0, 'failed': 0, 'bytes': 0, 'started': time.time()}
+    stats_lock = threading.Lock()
+    queue_factor = UPLOAD_QUEUE_FACTOR
+    if opt.get('batch_url'):
+        # Enough files queued for every worker to fill a batch
+        queue_factor = max(queue_factor, opt['batch_files'])
+    prefetcher = opt.get('prefetcher')
+    if prefetcher is not None:
+        # Files queued are read ahead as far as the prefetch budget allows
+        queue_factor = max(queue_factor, PREFETCH_QUEUE_FACTOR)
+    work = Queue.Queue(maxsize=workers * queue_factor)
+    # Error level of the first worker stopped by raise_error()
+    exit_codes = []
+    # Files with retry on errors are put off on the retry scheduler, not to hold up other files
+    retries = None
+    if opt['config_retry_on_errors']:
+        retries = RetryScheduler(opt['retry_max_attempts'], opt['retry_base_delay'], opt['retry_max_delay'])
+        opt = dict(opt, retry_scheduler=retries)
+    # Number of files taken to upload and not finished yet, including ones waiting for retry
+    pending = [0]
+    # With adaptive concurrency there is a worker for the highest limit, but only limit of them upload at once
+    controller = opt.get('concurrency_controller')
+
+    def put_work(item):
+        while not exit_codes:
+            try:
+                work.put(item, timeout=UPLOAD_QUEUE_TIMEOUT)
+                return
+            except Queue.Full:
+                pass
+
+    def requeue_retries():
+        while True:
+            item = retries.get()
+            if item is None:
+                return
+            put_work(item)
+
+    def worker():
+        # Item taken from the queue while gathering a batch, but not fitting into it
+        taken = []
+        while True:
+            if taken:
+                item = taken.pop()
+            else:
+                item = work.get()
+            if item is None:
+                return
+            batch = get_batch(item, taken)
+            if batch:
+                upload_batch_files(batch)
+            else:
+                upload(*item)
+
+    def get_batch(item, taken):
+        """Returns files for a batch starting with the item given, or None if the item is sent alone"""
+        name, attempt = item
+        if attempt > 1 or exit_codes:
+            return None
+        try:
+            size = os.path.getsize(name)
+        except OSError:
+            return None
+        if not use_batch_upload(size, opt):
+            return None
+        batch = [(name, size)]
+        total = size
+        while len(batch) < opt['batch_files']:
+            try:
+                item = work.get_nowait()
+            except Queue.Empty:
+                break
+            size = -1
+            if item is not None and item[1] == 1:
+                try:
+                    size = os.path.getsize(item[0])
+                except OSError:
+                    pass
+            if size < 0 or not use_batch_upload(size, opt) or total + size > opt['batch_size']:
+                taken.append(item)
+                break
+            batch.append((item[0], size))
+            total += size
+        if len(batch) == 1:
+            return None
+        return batch
+
+    def upload_batch_files(batch):
+        """Uploads files in one request, failed ones are uploaded one by one"""
+        names = [name for name, size in batch]
+        failed = names
+        if controller is not None:
+            controller.acquire()
+        try:
+            failed = upload_batch(names, opt)
+        except SystemExit, e:
+            exit_codes.append(e.code)
+        except Exception, e:
+            raise_error("%s : %s""" % (', '.join(names), e), retry=True)
+        if controller is not None:
+            controller.release()
+        if prefetcher is not None:
+            for name in names:
+                prefetcher.discard(name)
+        failed = set(failed)
+        for name, size in batch:
+            if name in failed:
+                upload(name, 1)
+            else:
+                finish(name, True, size)
+
+    def upload(name, attempt):
+        if exit_codes:
+            # Draining queue after fatal error
+            if prefetcher is not None:
+                prefetcher.discard(name)
+            finish(name, False, 0)
+            return
+        if attempt > 1 and not opt['silent']:
+            print 'Upload attempt #%s' % attempt
+        uploaded = False
+        size = 0
+        if controller is not None:
+            # Waiting for the number of uploads in flight to get below the current limit
+            controller.acquire()
+        try:
+            size = os.path.getsize(name)
+            uploaded = upload_file(name, opt)
+        except SystemExit, e:
+            exit_codes.append(e.code)
+        except Exception, e:
+            # Worker must survive any error of a single file
+            raise_error("%s : %s""" % (name, e), retry=True)
+        if controller is not None:
+            controller.release()
+        if prefetcher is not None:
+            # Retries read the file again
+            prefetcher.discard(name)
+        if not uploaded and retries is not None and not exit_codes and os.path.isfile(name):
+            delay = retries.schedule(name, attempt)
+            if delay is not None:
+                report_retry(name, attempt, delay, opt)
+                return
+        finish(name, uploaded, size)
+
+    def finish(name, uploaded, size):
+        if not uploaded:
+            METRICS.count('files_failed')
+            if 'snapshot' in opt:
+                opt['snapshot'].forget(name)
+        if 'fanout' in opt:
+            opt['fanout'].finished(name)
+        if 'agent' in opt:
+            opt['agent'].finished(name, uploaded)
+        stats_lock.acquire()
+        try:
+            pending[0] -= 1
+            stats['files'] += 1
+            if uploaded:
+                stats['uploaded'] += 1
+                stats['bytes'] += size
+            else:
+                stats['failed'] += 1
+        finally:
+            stats_lock.release()
+
+    threads = []
+    for i in range(workers):
+        thread = threading.Thread(target=worker, name='upload-worker-%s' % i)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    if retries is not None:
+        retry_thread = threading.Thread(target=requeue_retries, name='retry-scheduler')
+        retry_thread.daemon = True
+        retry_thread.start()
+
+    for name in file_names:
+        if exit_codes:
+            break
+        stats_lock.acquire()
+        pending[0] += 1
+        stats_lock.release()
+        if prefetcher is not None:
+            prefetcher.submit(name)
+        put_work((name, 1))
+    # Waiting for the files put off to retry
+    while pending[0] > 0 and not exit_codes:
+        time.sleep(UPLOAD_QUEUE_TIMEOUT)
+    if retries is not None:
+        retries.close()
+        retry_thread.join()
+    for thread in threads:
+        work.put(None)
+    for thread in threads:
+        # Joining with timeout keeps main thread responsive to Ctrl+C
+        while thread.is_alive():
+            thread.join(UPLOAD_QUEUE_TIMEOUT)
+
+    stats['seconds'] = time.time() - stats['started']
+    if exit_codes:
+        sys.exit(exit_codes[0])
+    return stats
+
+
+def format_upload_stats(stats):
+    """Returns upload statistics as a text line"""
+    seconds = max(stats['seconds'], 0.001)
+    return 'Uploaded %s of %s files (%s failed), %s bytes in %.2f seconds: %.2f files/s, %.0f bytes/s' % (
+        stats['uploaded'],
+        stats['files'],
+        stats['failed'],
+        stats['bytes'],
+        stats['seconds'],
+        stats['uploaded'] / seconds,
+        stats['bytes'] / seconds,
+    )
+
+
+###########################################################################################
+##################################### WORK CLAIMING #######################################
+###########################################################################################
+class WorkClaims(object):
+    """Claims files of a directory shared by several client instances (e.g. on NFS), so every file is uploaded once.
+
+    Modes:
+        lease - file is claimed by creating '<file>.dms_lease' next to it, which fails if it exists already,
+        rename - file is moved into '<claim dir>/<instance>/', keeping its path relative to the directory.
+    Claims held are refreshed every third of timeout. Claims not refreshed for timeout seconds are left
+    by a stopped instance and are taken over. Claim is dropped when the file is uploaded,
+    files failed are given back when the run ends. Renamed files not removed after upload are moved back,
+    and are not claimed again until they change (e.g. found by directory watcher once more)."""
+
+    def __init__(self, rootdir, mode, instance, timeout=DEFAULT_CLAIM_TIMEOUT, claim_dir=None):
+        self.rootdir = os.path.abspath(rootdir)
+        self.mode = mode
+        self.instance = instance
+        self.timeout = timeout
+        self.claim_dir = os.path.abspath(claim_dir or os.path.join(rootdir, CLAIM_DIR))
+        self.area = os.path.join(self.claim_dir, instance)
+        self.lock = threading.Lock()
+        # Lease mode: file path -> lease file path, rename mode: claimed file path -> original path
+        self.held = {}
+        # Rename mode: original path -> (size, mtime) of file moved back after upload
+        self.returned = {}
+        self.stopped = threading.Event()
+        self.closed = False
+        if mode == CLAIM_RENAME:
+            make_directory(self.area)
+            self.heartbeat()
+            self.reclaim_areas()
+        self.refresher = threading.Thread(target=self.refresh, name='claims-refresher')
+        self.refresher.daemon = True
+        self.refresher.start()
+
+    def claim_files(self, file_names):
+        """Yields files claimed by this instance, as paths to upload them from"""
+        for file_place in file_names:
+            if os.path.abspath(file_place).startswith(self.claim_dir + os.sep):
+                # Files claimed by instances, this one included
+                continue
+            if self.returned and self.is_returned(file_place):
+                continue
+            claimed = self.claim(file_place)
+            if claimed is None:
+                METRICS.count('claims_lost')
+                continue
+            METRICS.count('claims')
+            yield claimed
+
+    def is_returned(self, file_place):
+        """Checks the file is moved back by this instance after upload and is not changed since"""
+        with self.lock:
+            state = self.returned.pop(file_place, None)
+        if state is None:
+            return False
+        try:
+            st = os.stat(file_place)
+        except OSError:
+            return False
+        if (st.st_size, st.st_mtime) != state:
+            return False
+        with self.lock:
+            self.returned[file_place] = state
+        return True
+
+    def claim(self, file_place):
+        """Returns path of the file claimed, or None if the file is claimed by another instance or gone"""
+        if self.mode == CLAIM_RENAME:
+            return self.claim_rename(file_place)
+        return self.claim_lease(file_place)
+
+    def claim_lease(self, file_place):
+        lease = file_place + CLAIM_LEASE_SUFFIX
+        with self.lock:
+            if file_place in self.held:
+                return file_place
+        try:
+            lease_fd = os.open(lease, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+        except OSError, e:
+            if e.errno != errno.EEXIST or not self.take_over(lease):
+                return None
+            try:
+                lease_fd = os.open(lease, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+            except OSError:
+                return None
+        try:
+            os.write(lease_fd, '%s %s\n' % (self.instance, time.time()))
+        finally:
+            os.close(lease_fd)
+        if not os.path.isfile(file_place):
+            # Uploaded and removed by another instance after it was found
+            remove_quietly(lease)
+            return None
+        with self.lock:
+            self.held[file_place] = lease
+        return file_place
+
+    def take_over(self, lease):
+        """Removes lease file not refreshed for timeout seconds. Returns True if the file can be claimed again.
+
+        Check and move of the lease are not atomic: another instance may take the lease over and claim
+        the file again in between. So the lease moved away is checked once more and moved back if it is not
+        the stale one."""
+        stale = '%s.%s' % (lease, self.instance)
+        try:
+            seen = self.read_stale_lease(lease)
+            if seen is None:
+                return False
+            os.rename(lease, stale)
+        except (IOError, OSError), e:
+            # Removed meanwhile
+            return e.errno == errno.ENOENT
+        try:
+            moved = self.read_stale_lease(stale)
+        except (IOError, OSError):
+            moved = None
+        if moved != seen:
+            try:
+                os.rename(stale, lease)
+            except OSError, e:
+                write_successlog(lease, message='Claim taken over by mistake not given back: %s. Lease:' % e)
+            return False
+        remove_quietly(stale)
+        write_successlog(lease, message='Stale claim taken over:')
+        return True
+
+    def read_stale_lease(self, lease):
+        """Returns (mtime, contents) of lease file not refreshed for timeout seconds, None for a fresh one"""
+        mtime = os.stat(lease).st_mtime
+        if time.time() - mtime < self.timeout:
+            return None
+        lease_file = open(lease)
+        try:
+            return mtime, lease_file.read()
+        finally:
+            lease_file.close()
+
+    def claim_rename(self, file_place):
+        claimed = os.path.join(self.area, os.path.relpath(os.path.abspath(file_place), self.rootdir))
+        try:
+            make_directory(os.path.dirname(claimed))
+            os.rename(file_place, claimed)
+        except OSError:
+            # Moved by another instance
+            return None
+        with self.lock:
+            self.held[claimed] = file_place
+        return claimed
+
+    def release(self, file_place):
+        """Drops claim of the file. File renamed, if not removed, is moved back."""
+        with self.lock:
+            claim = self.held.pop(file_place, None)
+        if claim is None:
+            return
+        if self.mode == CLAIM_LEASE:
+            remove_quietly(claim)
+        elif os.path.exists(file_place):
+            try:
+                st = os.stat(file_place)
+                # Remembered before the move, as directory watcher may find the file right after it
+                with self.lock:
+                    self.returned[claim] = (st.st_size, st.st_mtime)
+                make_directory(os.path.dirname(claim))
+                os.rename(file_place, claim)
+            except OSError, e:
+                with self.lock:
+                    self.returned.pop(claim, None)
+                raise_error('%s : %s' % (file_place, e), retry=True)
+
+    def heartbeat(self):
+        heartbeat_file = open(os.path.join(self.area, CLAIM_HEARTBEAT_FILE), 'w')
+        heartbeat_file.write('%s\n' % time.time())
+        heartbeat_file.close()
+
+    def refresh(self):
+        """Keeps claims held fresh, so other instances do not take them over.
+
+        In rename mode, files of instances stopped meanwhile are moved back into the directory too."""
+        while not self.stopped.wait(self.timeout / 3.0):
+            try:
+                if self.mode == CLAIM_RENAME:
+                    self.heartbeat()
+                    self.reclaim_areas()
+                    continue
+                with self.lock:
+                    leases = self.held.values()
+                for lease in leases:
+                    os.utime(lease, None)
+            except (IOError, OSError), e:
+                write_successlog(self.instance, message='Claims refresh error: %s. For instance:' % e)
+
+    def reclaim_areas(self):
+        """Moves files of instances stopped without giving them back into the directory again"""
+        for name in os.listdir(self.claim_dir):
+            area = os.path.join(self.claim_dir, name)
+            if name == self.instance or name.startswith('.') or not os.path.isdir(area):
+                continue
+            try:
+                if time.time() - os.stat(os.path.join(area, CLAIM_HEARTBEAT_FILE)).st_mtime < self.timeout:
+                    continue
+            except OSError:
+                try:
+                    if time.time() - os.stat(area).st_mtime < self.timeout:
+                        continue
+                except OSError:
+                    # Reclaimed by another instance meanwhile
+                    continue
+            # Only one of instances reclaiming the same area succeeds in moving it away
+            taken = os.path.join(self.claim_dir, '.%s.%s' % (name, self.instance))
+            try:
+                os.rename(area, taken)
+            except OSError:
+                continue
+            restored = 0
+            for directory, subdirs, files in os.walk(taken):
+                for file_name in files:
+                    path = os.path.join(directory, file_name)
+                    if directory == taken and file_name == CLAIM_HEARTBEAT_FILE:
+                        continue
+                    original = os.path.join(self.rootdir, os.path.relpath(path, taken))
+                    make_directory(os.path.dirname(original))
+                    os.rename(path, original)
+                    restored += 1
+            remove_tree(taken)
+            write_successlog(name, message='Stale claims of %s files taken over from instance:' % restored)
+
+    def close(self):
+        """Gives back claims of files not uploaded"""
+        if self.closed:
+            return
+        self.closed = True
+        self.stopped.set()
+        self.refresher.join()
+        with self.lock:
+            held = list(self.held)
+        for file_place in held:
+            self.release(file_place)
+        if self.mode == CLAIM_RENAME:
+            remove_tree(self.area)
+
+
+def shard_files(file_names, rootdir, number, count):
+    """Yields files of the shard number of count: all files of a directory go to one shard,
+    chosen by hash of the directory path relative to rootdir, so nodes split a tree without claiming files."""
+    rootdir = os.path.abspath(rootdir)
+    last_directory = None
+    selected = False
+    for file_place in file_names:
+        directory = os.path.dirname(file_place)
+        if directory != last_directory:
+            last_directory = directory
+            relative = os.path.relpath(os.path.abspath(directory), rootdir)
+            selected = (zlib.crc32(relative) & 0xffffffff) % count == number
+        if selected:
+            yield file_place
+
+
+def parse_shard(value):
+    """Returns (number, count) pair of '<number>/<count>' shard option, None if not set"""
+    if not value:
+        return None
+    try:
+        number, count = [int(part) for part in value.split('/')]
+    except ValueError:
+        number, count = -1, 0
+    if not 0 <= number < count:
+        raise_error(DEFAULT_ERROR_MESSAGES['no_shard'])
+    return number, count
+
+
+def make_directory(path):
+    """Creates directory with its parents, if it does not exist"""
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
 
-    except IOError, e:
-        if not _silent:
-            print e
-            print 'Trying to read standard config file: ./' + DEFAULT_CFG_FILE
-        # Trying to get config from default file if exists
+
+def remove_tree(path):
+    """Removes directory tree, files left in it included"""
+    for directory, subdirs, files in os.walk(path, topdown=False):
+        for file_name in files:
+            remove_quietly(os.path.join(directory, file_name))
         try:
-            config_instance = open(DEFAULT_CFG_FILE, "rb")
-        except IOError, e:
-            if not _silent:
-                print e
-                print 'Not found standard config. can now function only with console params'
-        pass
+            os.rmdir(directory)
+        except OSError:
+            pass
 
-    if not config_instance:
-        if not _silent:
-            print 'config used ......................................................no'
-        return None
-    # Warning! allow_no_value may cause bugs in Python < 2.7
-    cfg = ConfigParser.RawConfigParser()  # allow_no_value=True)
-    cfg.readfp(config_instance)
 
-    config_options = {}
-    for option in DEFAULT_CFG_OPTIONS:
-        get_option(cfg, option, config_options)
+###########################################################################################
+################################# ADAPTIVE CONCURRENCY ####################################
+###########################################################################################
+class ConcurrencyController(object):
+    """AIMD limit of uploads in flight, following server latency and errors.
 
-    if not _silent:
-        print 'config used ......................................................yes'
-    return config_options
+    Upload results are collected in windows of limit uploads. After a window:
+        - timeouts, 5xx or 429 responses cut the limit by half (multiplicative decrease),
+        - latency staying flat, close to the lowest seen, raises the limit by one (additive increase),
+        - rising latency keeps the limit.
+    Latency is counted per request and megabyte sent, so large files do not look like a slow server.
+    Limit never goes out of [floor, ceiling]."""
 
+    def __init__(self, floor, ceiling, silent=False):
+        self.floor = max(floor, 1)
+        self.ceiling = max(ceiling, self.floor)
+        self.limit = self.floor
+        self.silent = silent
+        self.condition = threading.Condition(threading.Lock())
+        self.in_flight = 0
+        self.baseline = None
+        self.window_latency = 0.0
+        self.window_samples = 0
+        self.window_errors = 0
+        self.lowest = self.highest = self.limit
 
-def raise_error(message=None, error_level=1, retry=False):
-    """Breaks program with error, message provided.
+    def acquire(self):
+        self.condition.acquire()
+        try:
+            while self.in_flight >= self.limit:
+                self.condition.wait(UPLOAD_QUEUE_TIMEOUT)
+            self.in_flight += 1
+        finally:
+            self.condition.release()
 
-    Writes down error text to file."""
-    if message:
-        if os.path.isfile(ERROR_FILE_MAIN):
-            err_file = open(ERROR_FILE_MAIN, 'a')
+    def release(self):
+        self.condition.acquire()
+        try:
+            self.in_flight -= 1
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def record(self, seconds, size=0, error=None):
+        """Counts upload request result. Errors not caused by server load are not counted."""
+        overloaded = error is not None and is_overload_error(error)
+        if error is not None and not overloaded:
+            return
+        self.condition.acquire()
+        try:
+            self.window_samples += 1
+            if overloaded:
+                self.window_errors += 1
+            else:
+                self.window_latency += seconds / (1.0 + float(size) / CONCURRENCY_LATENCY_SIZE_UNIT)
+            if self.window_samples >= self.limit:
+                self.adjust()
+        finally:
+            self.condition.release()
+
+    def adjust(self):
+        """Sets new limit after a window of uploads. Must be called with the lock held."""
+        limit = self.limit
+        latency = None
+        if self.window_samples > self.window_errors:
+            latency = self.window_latency / (self.window_samples - self.window_errors)
+        if self.window_errors:
+            limit = max(self.floor, int(limit * CONCURRENCY_DECREASE_FACTOR))
+            reason = '%s overload errors' % self.window_errors
+        elif self.baseline is None or latency <= self.baseline * CONCURRENCY_LATENCY_TOLERANCE:
+            limit = min(self.ceiling, limit + 1)
+            reason = 'latency %.1f ms' % (latency * 1000)
         else:
-            err_file = open(ERROR_FILE_MAIN, 'w')
-            err_file.seek(0)
-
-        err_file.write('\n-----------------------------------------------------------------------------\n')
-        err_file.write(str(datetime.datetime.now())+'\n')
-        err_file.write('-----------------------------------------------------------------------------\n')
-        err_file.write(str(message))
-        err_file.close()
-        write_successlog('Error!', message=message)
-    print message
-    if not retry:
-        sys.exit(error_level)
+            reason = 'latency %.1f ms rising' % (latency * 1000)
+        if latency is not None:
+            # Lowest latency seen, slowly following the server getting slower overall
+            if self.baseline is None:
+                self.baseline = latency
+            else:
+                self.baseline = min(self.baseline * CONCURRENCY_BASELINE_DRIFT, latency)
+        self.window_latency = 0.0
+        self.window_samples = 0
+        self.window_errors = 0
+        if limit != self.limit:
+            self.limit = limit
+            self.lowest = min(self.lowest, limit)
+            self.highest = max(self.highest, limit)
+            self.condition.notify_all()
+            message = 'Concurrency set to %s (%s)' % (limit, reason)
+            write_successlog(message, message='ADAPTIVE CONCURRENCY:')
+            if not self.silent:
+                print message
 
+    def format(self):
+        return 'Concurrency %s (lowest %s, highest %s, limits %s..%s)' % (
+            self.limit, self.lowest, self.highest, self.floor, self.ceiling
+        )
 
-def write_successlog(file_name, message=''):
-    """Writes down action of succeeded sending."""
-    if os.path.isfile(LOG_FILE_MAIN):
-        log_file = open(LOG_FILE_MAIN, 'a')
-    else:
-        log_file = open(LOG_FILE_MAIN, 'w')
-        log_file.seek(0)
-    log_file.write('\n-----------------------------------------------------------------------------\n')
-    log_file.write(str(datetime.datetime.now())+'\n')
-    log_file.write('-----------------------------------------------------------------------------\n')
-    if message:
-        log_file.write(message + u' ' + unicode(file_name))
+
+def is_overload_error(error):
+    """Checks upload error means server is overloaded: timeout, 5xx or 429 response"""
+    if isinstance(error, urllib2.HTTPError):
+        return error.code == 429 or error.code >= 500
+    if isinstance(error, urllib2.URLError):
+        error = error.reason
+    if isinstance(error, socket.timeout):
+        return True
+    return isinstance(error, socket.error) and error.errno in (errno.ETIMEDOUT, errno.ECONNRESET, errno.ECONNREFUSED)
+
+
+###########################################################################################
+################################## PERFORMANCE METRICS ####################################
+###########################################################################################
+class Metrics(object):
+    """Time spent in upload phases and counters of the work done, collected in-process.
+
+    Phases (they overlap: send includes read and compress of the body sent):
+        scan - reading directories, dedup - looking up content in deduplication index,
+        read - reading files, compress - gzip compression, send - upload requests,
+        verify - file revisions checks, prefetch_wait - uploads waiting for files being read ahead
+    Counters of other objects (e.g. connection pool) are added with add_source()."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        # Phase name: [count, seconds, longest]
+        self.timers = {}
+        self.counters = {}
+        self.sources = []
+
+    def add_time(self, phase, seconds, count=1):
+        self.lock.acquire()
+        try:
+            timer = self.timers.get(phase)
+            if timer is None:
+                timer = self.timers[phase] = [0, 0.0, 0.0]
+            timer[0] += count
+            timer[1] += seconds
+            if seconds > timer[2]:
+                timer[2] = seconds
+        finally:
+            self.lock.release()
+
+    def timer(self, phase):
+        """Returns context manager timing the phase"""
+        return PhaseTimer(self, phase)
+
+    def count(self, name, value=1):
+        self.lock.acquire()
+        try:
+            self.counters[name] = self.counters.get(name, 0) + value
+        finally:
+            self.lock.release()
+
+    def add_source(self, prefix, get_counters):
+        """Adds function returning dictionary of counters to export with the prefix given"""
+        self.sources.append((prefix, get_counters))
+
+    def snapshot(self):
+        """Returns current metrics as a dictionary"""
+        self.lock.acquire()
+        try:
+            timers = dict(
+                (phase, {'count': count, 'seconds': round(seconds, 6), 'max_seconds': round(longest, 6)})
+                for phase, (count, seconds, longest) in self.timers.items()
+            )
+            counters = dict(self.counters)
+        finally:
+            self.lock.release()
+        for prefix, get_counters in self.sources:
+            for name, value in get_counters().items():
+                counters[prefix + name] = value
+        return {
+            'time': time.time(),
+            'uptime_seconds': round(time.time() - self.started, 3),
+            'phases': timers,
+            'counters': counters,
+        }
+
+
+class PhaseTimer(object):
+
+    def __init__(self, metrics, phase):
+        self.metrics = metrics
+        self.phase = phase
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.add_time(self.phase, time.time() - self.started)
+        return False
+
+
+METRICS = Metrics()
+
+
+def format_metrics_prometheus(snapshot):
+    """Returns metrics in Prometheus text exposition format"""
+    lines = []
+    for name, help_text, field in (
+        ('phase_seconds_total', 'Time spent in upload phase', 'seconds'),
+        ('phase_count_total', 'Number of timed upload phase runs', 'count'),
+        ('phase_max_seconds', 'Longest upload phase run', 'max_seconds'),
+    ):
+        metric = METRICS_PREFIX + name
+        lines.append('# HELP %s %s' % (metric, help_text))
+        lines.append('# TYPE %s %s' % (metric, 'gauge' if name.endswith('max_seconds') else 'counter'))
+        for phase in sorted(snapshot['phases']):
+            lines.append('%s{phase="%s"} %s' % (metric, phase, snapshot['phases'][phase][field]))
+    for name in sorted(snapshot['counters']):
+        metric = METRICS_PREFIX + name + '_total'
+        lines.append('# TYPE %s counter' % metric)
+        lines.append('%s %s' % (metric, snapshot['counters'][name]))
+    metric = METRICS_PREFIX + 'uptime_seconds'
+    lines.append('# TYPE %s gauge' % metric)
+    lines.append('%s %s' % (metric, snapshot['uptime_seconds']))
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics(path, metrics_format=METRICS_FORMAT_PROMETHEUS):
+    """Writes metrics snapshot to the file.
+
+    File is replaced at once, so a reader (e.g. Prometheus node exporter) never sees it half written."""
+    snapshot = METRICS.snapshot()
+    if metrics_format == METRICS_FORMAT_JSON:
+        data = json.dumps(snapshot, indent=2, sort_keys=True) + '\n'
     else:
-        log_file.write('UPLOAD SUCCESSFUL of file: %s' % str(file_name))
-    log_file.close()
+        data = format_metrics_prometheus(snapshot)
+    temp_path = path + '.tmp'
+    metrics_file = open(temp_path, 'wb')
+    try:
+        metrics_file.write(data)
+    finally:
+        metrics_file.close()
+    if os.name == 'nt' and os.path.exists(path):
+        os.remove(path)
+    os.rename(temp_path, path)
 
 
-def walk_directory(rootdir, f_type=None):
-    """Walks through directory with files of provided format and
+class MetricsExporter(object):
+    """Writes metrics file every interval seconds in background and once more when closed"""
+
+    def __init__(self, path, metrics_format=METRICS_FORMAT_PROMETHEUS, interval=DEFAULT_METRICS_INTERVAL):
+        self.path = path
+        self.metrics_format = metrics_format
+        self.interval = interval
+        self.closed = threading.Event()
+        self.thread = None
+        if interval > 0:
+            self.thread = threading.Thread(target=self.export_periodically, name='metrics-exporter')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def export(self):
+        try:
+            write_metrics(self.path, self.metrics_format)
+        except (IOError, OSError), e:
+            print 'Metrics %s write error: %s' % (self.path, e)
+
+    def export_periodically(self):
+        while not self.closed.is_set():
+            self.closed.wait(self.interval)
+            if not self.closed.is_set():
+                self.export()
+
+    def close(self):
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.export()
+
+
+###########################################################################################
+################################## ASYNC UPLOAD ENGINE ####################################
+###########################################################################################
+class AsyncHTTPRequest(asyncore.dispatcher):
+    """Single HTTP request running on the asyncore event loop.
+
+    Sends request head and streams body from the file-like object given,
+    then reads the response until server closes the connection.
+    Calls back with (response, error) pair when finished."""
+
+    def __init__(self, engine, url, method, headers, body, callback):
+        asyncore.dispatcher.__init__(self, map=engine.socket_map)
+        self.callback = callback
+        self.body = body
+        self.received = []
+        self.handshaking = False
+        self.handshake_wants_read = False
+        self.request_sent = False
+        self.finished = False
+        self.last_activity = time.time()
+
+        parts = urlparse.urlsplit(url)
+        self.https = parts.scheme == 'https'
+        self.host = parts.hostname
+        port = parts.port or (self.https and httplib.HTTPS_PORT or httplib.HTTP_PORT)
+        selector = parts.path or '/'
+        if parts.query:
+            selector += '?' + parts.query
+        headers = [('Host', parts.netloc)] + headers + [('Connection', 'close')]
+        self.out = '%s %s HTTP/1.1\r\n' % (method, selector)
+        self.out += ''.join('%s: %s\r\n' % header for header in headers) + '\r\n'
+        self.ssl_context = engine.get_ssl_context() if self.https else None
+
+        family, address = engine.resolve(self.host, port)
+        self.create_socket(family, socket.SOCK_STREAM)
+        set_nodelay(self.socket)
+        try:
+            self.connect(address)
+        except socket.error:
+            self.close()
+            raise
+
+    def handle_connect(self):
+        if self.https:
+            sock = self.ssl_context.wrap_socket(
+                self.socket, do_handshake_on_connect=False, server_hostname=self.host
+            )
+            self.del_channel()
+            self.set_socket(sock, self._map)
+            self.handshaking = True
+            self.do_handshake()
 
-    returns the list of their name with path (ready to open) or empty list."""
-    file_list = []
-    for root, subFolders, files in os.walk(rootdir):
-        for f in files:
-            if f_type:
-                if '.' in f:
-                    if os.path.splitext(f)[1] == ('.' + str(f_type)):
-                        file_list.append(os.path.join(root, f))
+    def do_handshake(self):
+        try:
+            self.socket.do_handshake()
+            self.handshaking = False
+        except ssl.SSLWantReadError:
+            self.handshake_wants_read = True
+        except ssl.SSLWantWriteError:
+            self.handshake_wants_read = False
+
+    def readable(self):
+        if self.handshaking:
+            return self.handshake_wants_read
+        return True
+
+    def writable(self):
+        if not self.connected:
+            return True
+        if self.handshaking:
+            return not self.handshake_wants_read
+        return not self.request_sent
+
+    def handle_write(self):
+        self.last_activity = time.time()
+        if self.handshaking:
+            return self.do_handshake()
+        if not self.out:
+            if self.body is not None:
+                self.out = self.body.read(MULTIPART_CHUNK_SIZE)
+            if not self.out:
+                self.request_sent = True
+                return
+        try:
+            sent = self.socket.send(self.out)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return
+        except socket.error, e:
+            if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                return
+            raise
+        self.out = self.out[sent:]
+
+    def handle_read(self):
+        self.last_activity = time.time()
+        if self.handshaking:
+            return self.do_handshake()
+        while True:
+            try:
+                data = self.socket.recv(ASYNC_RECV_SIZE)
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                return
+            except socket.error, e:
+                if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    return
+                raise
+            if not data:
+                return self.handle_close()
+            self.received.append(data)
+            # SSL socket may hold decrypted data select() does not know about
+            if not (self.https and self.socket.pending()):
+                return
+
+    def handle_close(self):
+        if self.finished:
+            return
+        try:
+            response = httplib.HTTPResponse(ReceivedData(''.join(self.received)))
+            response.begin()
+            response.body = response.read()
+        except httplib.HTTPException, e:
+            return self.fail(e)
+        self.finish(response, None)
+
+    def handle_error(self):
+        self.fail(sys.exc_info()[1])
+
+    def fail(self, error):
+        self.finish(None, error)
+
+    def finish(self, response, error):
+        if self.finished:
+            return
+        self.finished = True
+        self.close()
+        self.callback(response, error)
+
+
+class ReceivedData(object):
+    """Socket look-alike feeding httplib.HTTPResponse with data already received"""
+
+    def __init__(self, data):
+        self.data = data
+
+    def makefile(self, *args, **kwargs):
+        return StringIO.StringIO(self.data)
+
+
+class AsyncUploadEngine(object):
+    """Uploads files on a single thread with the asyncore event loop.
+
+    Does the same work as upload_file(): streaming multipart POST with preemptive Basic auth,
+    file revisions check and optional removal of the file.
+    Number of uploads in flight is limited by the concurrency semaphore."""
+
+    def __init__(self, opt, concurrency=DEFAULT_ASYNC_CONCURRENCY):
+        self.opt = opt
+        self.concurrency = concurrency
+        # Semaphore counter of free upload slots
+        self.available = concurrency
+        self.socket_map = {}
+        self.addresses = {}
+        self.ssl_context = None
+        self.retries = RetryScheduler(opt['retry_max_attempts'], opt['retry_base_delay'], opt['retry_max_delay'])
+        self.auth = get_basic_auth(opt['username'], opt['password'])
+        self.stats = {'files': 0, 'uploaded': 0, 'failed': 0, 'bytes': 0, 'started': time.time()}
+        self.controller = opt.get('concurrency_controller')
+        if self.controller is not None:
+            self.concurrency = self.available = self.controller.limit
+
+    def adjust_concurrency(self):
+        """Follows the limit of uploads in flight set by adaptive concurrency controller"""
+        limit = self.controller.limit
+        # Free slots go negative when limit is cut below the number of uploads in flight
+        self.available += limit - self.concurrency
+        self.concurrency = limit
+
+    def resolve(self, host, port):
+        """Returns (family, address) of the host. Name lookup is done once per host."""
+        if (host, port) not in self.addresses:
+            family, socktype, proto, canonname, address = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+            self.addresses[(host, port)] = (family, address)
+        return self.addresses[(host, port)]
+
+    def get_ssl_context(self):
+        if self.ssl_context is None:
+            self.ssl_context = ssl._create_default_https_context()
+        return self.ssl_context
+
+    def run(self, file_names):
+        """Uploads all files from iterable given. Returns dictionary of upload statistics."""
+        names = iter(file_names)
+        exhausted = False
+        last_timeouts_check = time.time()
+        while True:
+            if self.controller is not None:
+                self.adjust_concurrency()
+            while self.available > 0:
+                retry = self.retries.pop_due()
+                if retry is not None:
+                    name, attempt = retry
+                elif not exhausted:
+                    try:
+                        name, attempt = names.next(), 1
+                    except StopIteration:
+                        exhausted = True
+                        continue
+                else:
+                    break
+                self.available -= 1
+                self.start(name, attempt)
+            if self.available == self.concurrency and exhausted and not self.retries:
+                break
+            timeout = ASYNC_LOOP_TIMEOUT
+            if self.available > 0 and self.retries:
+                timeout = min(timeout, self.retries.next_due())
+            if self.socket_map:
+                asyncore.loop(timeout=timeout, map=self.socket_map, count=1)
             else:
-                file_list.append(os.path.join(root, f))
-    return file_list
+                # Only retries put off are left
+                time.sleep(timeout)
+            if time.time() - last_timeouts_check > ASYNC_LOOP_TIMEOUT:
+                self.check_timeouts()
+                last_timeouts_check = time.time()
+        self.stats['seconds'] = time.time() - self.stats['started']
+        return self.stats
 
+    def check_timeouts(self):
+        """Fails requests with no network activity for too long"""
+        deadline = time.time() - DEFAULT_ASYNC_TIMEOUT
+        for request in self.socket_map.values():
+            if request.last_activity < deadline:
+                request.fail(socket.timeout('timed out'))
 
-def remove_file(file_path):
-    """Deletes file with path specified from filesystem"""
-    if os.path.exists(file_path):
+    def request(self, url, method, headers, body, callback):
+        headers = [('User-Agent', self.opt['user_agent']), ('Authorization', self.auth)] + headers
         try:
-            os.remove(file_path)
-            write_successlog(file_path, ' Success removing file:')
-        except Exception, e:
-            raise_error("%s : %s""" % (file_path, e))
-    else:
-        raise_error(DEFAULT_ERROR_MESSAGES['no_file'] + ': ' + file_path)
+            AsyncHTTPRequest(self, url, method, headers, body, callback)
+        except socket.error, e:
+            callback(None, urllib2.URLError(e))
 
+    def start(self, file_place, attempt):
+        """Starts upload of a file"""
+        silent_ = self.opt['silent']
+        file_name = get_full_filename(file_place)
+        dedup = self.opt.get('dedup')
+        content_hash = None
+        started = time.time()
+        try:
+            if dedup:
+                with METRICS.timer('dedup'):
+                    duplicate, content_hash = dedup.find(file_place)
+                if duplicate:
+                    skip_duplicate(file_place, duplicate, self.opt)
+                    return self.succeeded(file_place, 0, finished=False)
+            work_file = open(file_place, "rb")
+        except (IOError, OSError), e:
+            return self.failed(file_place, attempt, e)
+        form = MultiPartForm()
+        form.add_file('file', file_name, file_handle=work_file, current_mimetype=self.opt['mimetype'])
+        size = get_file_size(work_file)
+        headers = [
+            ('Content-Type', form.get_content_type()),
+        ]
+        url = self.opt['url'] + file_name
+        body = form.get_body(hash_files=bool(dedup) and content_hash is None)
+        compressed = use_compression(file_place, self.opt)
+        if compressed:
+            body = GzipBody(body, self.opt['compress_level'])
+            headers += [('Content-Encoding', 'gzip'), ('Transfer-Encoding', 'chunked')]
+        else:
+            headers.append(('Content-Length', str(form.get_content_length())))
+        # Upload result shared by the callbacks
+        result = {'code': '', 'hash': content_hash}
+
+        def uploaded(response, error):
+            work_file.close()
+            METRICS.add_time('send', time.time() - started)
+            if error is None:
+                error = get_response_error(url, response)
+            if self.controller is not None:
+                self.controller.record(time.time() - started, size if error is None else 0, error)
+            if error is not None:
+                if not silent_:
+                    print 'SERVER RESPONSE: %s' % error
+                return self.failed(file_place, attempt, error)
+            if not silent_:
+                print 'SERVER RESPONSE: OK'
+            if compressed:
+                METRICS.count('bytes_sent', body.compressed_size)
+                self.opt['compression_stats'].add(file_place, body, self.opt)
+            else:
+                METRICS.count('bytes_sent', form.get_content_length())
+            if body.digest is not None:
+                result['hash'] = body.digest.hexdigest()
+            if not self.opt['fileinfo_loc']:
+                return self.succeeded(file_place, size, content_hash=result['hash'])
+            try:
+                result['code'] = json.loads(response.body)
+            except ValueError:
+                raise_error('No Json returned from API: %s' % file_name)
+            if 'verifier' in self.opt:
+                self.opt['verifier'].submit(file_place, result['code'], result['hash'])
+                return self.succeeded(file_place, size, finished=False)
+            code = check_uploaded_code(file_place, result['code'], self.opt)
+            result['verify_started'] = time.time()
+            self.request(get_fileinfo_url(code, self.opt), 'GET', [], None, verified)
+
+        def verified(response, error):
+            METRICS.add_time('verify', time.time() - result['verify_started'])
+            if error is None:
+                error = get_response_error(url, response)
+            if error is None:
+                try:
+                    if int(response.body) > 0:
+                        return self.succeeded(file_place, size, result['code'], result['hash'])
+                except ValueError:
+                    pass
+            METRICS.count('verify_failures')
+            raise_error('File uploaded check failed %s' % file_name, retry=self.opt['config_retry_on_errors'])
+            self.failed(file_place, attempt, None)
 
-def retry_upload(retries_count, name, opt):
-    """Retries upload of file given amount of times"""
-    silent_ = opt['silent']
-    counter = 1
-    while counter <= retries_count:
-        uploaded = False
         if not silent_:
-            print 'Upload attempt #%s' % counter
+            print 'SENDING FILE: %s' % file_place
+        self.request(url, 'POST', headers, body, uploaded)
+
+    def succeeded(self, file_place, size, uploaded_code='', content_hash=None, finished=True):
+        if finished:
+            finish_upload(file_place, self.opt, uploaded_code, content_hash)
+        self.stats['files'] += 1
+        self.stats['uploaded'] += 1
+        self.stats['bytes'] += size
+        self.available += 1
+
+    def failed(self, file_place, attempt, error):
+        """Counts failed upload or schedules it to retry"""
+        retry = self.opt['config_retry_on_errors']
+        if error is not None:
+            raise_error("%s : %s" % (file_place, error), retry=retry)
+            self.retries.note_retry_after(file_place, get_retry_after(error))
+        delay = None
+        if retry and os.path.isfile(file_place):
+            delay = self.retries.schedule(file_place, attempt)
+        if delay is not None:
+            report_retry(file_place, attempt, delay, self.opt)
+        else:
+            METRICS.count('files_failed')
+            if 'snapshot' in self.opt:
+                self.opt['snapshot'].forget(file_place)
+            self.stats['files'] += 1
+            self.stats['failed'] += 1
+        self.available += 1
+
+
+def get_response_error(url, response):
+    """Returns urllib2.HTTPError for a response with status other then 200"""
+    if response.status != 200:
+        return urllib2.HTTPError(url, response.status, response.reason, response.msg, None)
+    return None
+
+
+###########################################################################################
+##################################### UPLOAD AGENT ########################################
+###########################################################################################
+class UploadAgent(object):
+    """Resident uploader taking files to upload over a Unix domain socket.
+
+    Config, connection pool and upload workers stay ready between files, so a file handed over
+    (by 'dms_client.py -f <file>' with agent_socket set) is uploaded without program start up costs.
+    Protocol is json lines: {"file": path, "wait": false} is answered with {"file": path, "queued": true},
+    with "wait": true it is answered when the upload is finished, with {"file": path, "uploaded": true or false}.
+    Errors are answered with {"error": text}.
+    Only files of the directories (roots) matching the file name rules are taken, wherever their links lead."""
+
+    def __init__(self, path, roots, matcher):
+        self.path = path
+        # Root directories with trailing separator, links resolved
+        self.roots = [os.path.join(os.path.realpath(root), '') for root in roots]
+        self.matcher = matcher
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        # File path: [event, uploaded] lists of requests waiting for the upload result
+        self.waiting = {}
+        self.closed = False
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except socket.error:
+                # Left by an agent stopped without cleaning up
+                os.remove(path)
+            else:
+                raise_error(DEFAULT_ERROR_MESSAGES['no_agent_running'])
+            finally:
+                probe.close()
+        self.server = AgentServer(path, AgentRequestHandler)
+        self.server.agent = self
+        os.chmod(path, AGENT_SOCKET_MODE)
+        self.thread = threading.Thread(target=self.server.serve_forever, name='upload-agent')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def files(self):
+        """Yields files handed to the agent, until it is closed"""
+        while not self.closed:
+            try:
+                # Waiting with timeout keeps main thread responsive to Ctrl+C
+                yield self.queue.get(timeout=UPLOAD_QUEUE_TIMEOUT)
+            except Queue.Empty:
+                pass
+
+    def accepts(self, file_place):
+        """Checks the file is in one of the directories to upload, not excluded by file name rules"""
+        real_place = os.path.realpath(file_place)
+        for root in self.roots:
+            if real_place.startswith(root):
+                names = real_place[len(root):].split(os.sep)
+                return self.matcher.matches(names[-1]) and not any(map(self.matcher.excludes_directory, names[:-1]))
+        return False
+
+    def submit(self, file_place, wait=False):
+        """Queues file to upload. Returns [event, uploaded] list set when the upload is finished, if wait is set."""
+        waiter = None
+        if wait:
+            waiter = [threading.Event(), False]
+            with self.lock:
+                self.waiting.setdefault(file_place, []).append(waiter)
+        METRICS.count('agent_requests')
+        self.queue.put(file_place)
+        return waiter
+
+    def finished(self, file_place, uploaded):
+        with self.lock:
+            waiters = self.waiting.pop(file_place, [])
+        for waiter in waiters:
+            waiter[1] = uploaded
+            waiter[0].set()
+
+    def close(self):
+        """Stops taking files, requests still waiting are answered as not uploaded"""
+        self.closed = True
+        self.server.shutdown()
+        self.server.server_close()
+        remove_quietly(self.path)
+        with self.lock:
+            waiting = self.waiting.values()
+            self.waiting = {}
+        for waiters in waiting:
+            for waiter in waiters:
+                waiter[0].set()
+
+
+class AgentServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class AgentRequestHandler(SocketServer.StreamRequestHandler):
+    """Reads upload agent requests of a connection, one json object per line"""
+
+    def handle(self):
+        agent = self.server.agent
+        for line in iter(self.rfile.readline, ''):
+            try:
+                request = json.loads(line)
+                file_place = request['file']
+            except (ValueError, KeyError, TypeError):
+                self.reply({'error': 'request must be json object with "file" path'})
+                continue
+            if not os.path.isfile(file_place):
+                self.reply({'file': file_place, 'error': DEFAULT_ERROR_MESSAGES['no_file']})
+                continue
+            if not agent.accepts(file_place):
+                METRICS.count('agent_refused')
+                self.reply({'file': file_place, 'error': DEFAULT_ERROR_MESSAGES['no_agent_file']})
+                continue
+            waiter = agent.submit(file_place, bool(request.get('wait')))
+            if waiter is None:
+                self.reply({'file': file_place, 'queued': True})
+            else:
+                waiter[0].wait()
+                self.reply({'file': file_place, 'uploaded': waiter[1]})
+
+    def reply(self, data):
+        self.wfile.write(json.dumps(data) + '\n')
+        self.wfile.flush()
+
+
+def send_to_agent(path, file_place, wait=False):
+    """Hands the file to the upload agent listening on the socket.
+
+    Returns reply of the agent, or None if no agent listens on the socket."""
+    agent = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
         try:
-            counter += 1
-            uploaded = upload_file(name, options)
-        except Exception, e:
-            message = 'Exception with upload! Will retry...'
-            write_successlog(message, message=str(e))
-            if not silent_:
-                print '%s %s' % (message, str(e))
-            pass
-        if uploaded:
-            break
+            agent.connect(path)
+        except socket.error:
+            return None
+        agent.sendall(json.dumps({'file': os.path.abspath(file_place), 'wait': wait}) + '\n')
+        reply = agent.makefile('rb').readline()
+    finally:
+        agent.close()
+    try:
+        return json.loads(reply)
+    except ValueError:
+        # Agent stopped before answering, file may be uploaded or not
+        return {'error': 'no reply from upload agent'}
 
 
 ###########################################################################################
@@ -571,10 +5037,40 @@ if __name__ == '__main__':
 
     config = parse_config(cfg_file_name=config_file_name, config_chapter=cfg_chapter, _silent=silent)
 
+    log_format = get_option(app_args, config, '-log_format', 'log_format', LOG_FORMAT_TEXT)
+    if log_format not in LOG_FORMATS:
+        raise_error(DEFAULT_ERROR_MESSAGES['no_log_format'])
+    configure_logs(
+        log_format,
+        get_number_option(
+            app_args, config, '-log_flush_interval', 'log_flush_interval', DEFAULT_LOG_FLUSH_INTERVAL, float
+        ),
+        get_number_option(app_args, config, '-log_flush_size', 'log_flush_size', DEFAULT_LOG_FLUSH_SIZE),
+    )
+
     if not app_args and not config:
         if not silent:
             raise_error(DEFAULT_ERROR_MESSAGES['no_config_or_console'])
 
+    agent = '-agent' in app_args
+    agent_socket = get_option(app_args, config, '-agent_socket', 'agent_socket', '')
+    # Handing single file to the upload agent, if it is running
+    if filename and agent_socket and not agent:
+        if not os.path.isfile(filename):
+            raise_error(DEFAULT_ERROR_MESSAGES['no_proper_data'])
+        agent_wait = get_flag_option(app_args, config, '-wait', 'agent_wait')
+        reply = send_to_agent(agent_socket, filename, agent_wait)
+        if reply is not None:
+            if 'error' in reply:
+                raise_error('Upload agent error: %s : %s' % (filename, reply['error']))
+            if agent_wait and not reply.get('uploaded'):
+                raise_error('Upload agent failed to upload file: %s' % filename)
+            if not silent:
+                print 'File %s by upload agent: %s' % ('uploaded' if agent_wait else 'queued', filename)
+            sys.exit(0)
+        if not silent:
+            print 'Upload agent is not running, uploading file directly.'
+
     # Getting option from sys.argv first then trying config file
     username = ''
     if '-user' in app_args:
@@ -632,6 +5128,9 @@ if __name__ == '__main__':
             mimetype = config['mimetype']
     if not silent:
         print 'Using Mimetype: %s' % mimetype
+    if mimetype == MIMETYPE_AUTO:
+        # Guessed from the name of every file, for several file types
+        mimetype = None
 
     fileinfo_loc = None
     if '-fileinfo_location' in app_args:
@@ -648,7 +5147,7 @@ if __name__ == '__main__':
     if not directory:
         if 'directory' in config:
             directory = config['directory']
-    if (not directory) and (not filename):
+    if (not directory) and (not filename) and (not agent):
         if not silent:
             raise_error(DEFAULT_ERROR_MESSAGES['no_data'])
     # Forcing filename provided to override default sending directory of files
@@ -676,13 +5175,172 @@ if __name__ == '__main__':
             if retry_value == 'yes':
                 config_retry_on_errors = True
 
+    retry_max_attempts = max(
+        get_number_option(app_args, config, '-retry_max_attempts', 'retry_max_attempts', UPLOAD_RETRIES_COUNT), 1
+    )
+    retry_base_delay = get_number_option(
+        app_args, config, '-retry_base_delay', 'retry_base_delay', DEFAULT_RETRY_BASE_DELAY, float
+    )
+    retry_max_delay = get_number_option(
+        app_args, config, '-retry_max_delay', 'retry_max_delay', DEFAULT_RETRY_MAX_DELAY, float
+    )
+
+    compress = get_flag_option(app_args, config, '-compress', 'compress')
+    compress_threshold = get_number_option(
+        app_args, config, '-compress_threshold', 'compress_threshold', DEFAULT_COMPRESS_THRESHOLD
+    )
+    compress_level = get_number_option(app_args, config, '-compress_level', 'compress_level', DEFAULT_COMPRESS_LEVEL)
+    compress_level = min(max(compress_level, 1), 9)
+    compress_skip = get_option(app_args, config, '-compress_skip', 'compress_skip', DEFAULT_COMPRESS_SKIP)
+    compress_skip = set(ext.strip().lstrip('.').lower() for ext in compress_skip.split(',') if ext.strip())
+
+    metrics_file = get_option(app_args, config, '-metrics_file', 'metrics_file', '')
+    metrics_format = get_option(app_args, config, '-metrics_format', 'metrics_format', METRICS_FORMAT_PROMETHEUS)
+    if metrics_format not in METRICS_FORMATS:
+        raise_error(DEFAULT_ERROR_MESSAGES['no_metrics_format'])
+    metrics_interval = get_number_option(
+        app_args, config, '-metrics_interval', 'metrics_interval', DEFAULT_METRICS_INTERVAL, float
+    )
+
+    zero_copy = get_option(app_args, config, '-zero_copy', 'zero_copy', 'yes') == 'yes'
+
+    workers = get_number_option(app_args, config, '-workers', 'workers', DEFAULT_WORKERS)
+    if workers < 1:
+        raise_error(DEFAULT_ERROR_MESSAGES['no_workers'])
+
+    async_engine = get_flag_option(app_args, config, '-async', 'async_engine')
+    async_concurrency = get_number_option(
+        app_args, config, '-async_concurrency', 'async_concurrency', DEFAULT_ASYNC_CONCURRENCY
+    )
+    if async_concurrency < 1:
+        raise_error(DEFAULT_ERROR_MESSAGES['no_concurrency'])
+
+    verify_mode = get_option(app_args, config, '-verify', 'verify', VERIFY_INLINE)
+    if verify_mode not in VERIFY_MODES:
+        raise_error(DEFAULT_ERROR_MESSAGES['no_verify_mode'])
+    verify_sample = max(get_number_option(app_args, config, '-verify_sample', 'verify_sample', DEFAULT_VERIFY_SAMPLE), 1)
+
+    dedup = get_flag_option(app_args, config, '-dedup', 'dedup')
+    dedup_remove = get_flag_option(app_args, config, '-dedup_remove', 'dedup_remove')
+    dedup_index = get_option(app_args, config, '-dedup_index', 'dedup_index', DEDUP_INDEX_FILE)
+    dedup_max_age = get_number_option(app_args, config, '-dedup_max_age', 'dedup_max_age', 0)
+    include = get_option(app_args, config, '-include', 'include', '')
+    exclude = get_option(app_args, config, '-exclude', 'exclude', '')
+    scan_threads = get_number_option(app_args, config, '-scan_threads', 'scan_threads', DEFAULT_SCAN_THREADS)
+
+    # Index maintenance commands
+    if '-dedup_rebuild' in app_args or '-dedup_compact' in app_args:
+        index = DedupIndex(dedup_index)
+        if '-dedup_rebuild' in app_args:
+            file_names = []
+            if directory:
+                roots = [root for root in directory.split(os.pathsep) if root]
+                for root in roots:
+                    if not os.path.isdir(root):
+                        raise_error(DEFAULT_ERROR_MESSAGES['no_proper_data'])
+                file_names = walk_directory(
+                    roots, FileMatcher(file_type, split_rules(include), split_rules(exclude)), threads=scan_threads
+                )
+            message = 'Deduplication index rebuilt, records kept: %s, added from directory: %s' % index.rebuild(
+                file_names
+            )
+        else:
+            message = 'Deduplication index compacted, records removed: %s' % index.compact(dedup_max_age)
+        index.close()
+        write_successlog(dedup_index, message=message)
+        if not silent:
+            print message
+        sys.exit(0)
+
+    snapshot_file = get_option(app_args, config, '-snapshot', 'snapshot', '')
+    order = get_option(app_args, config, '-order', 'order', UPLOAD_ORDER_SCAN)
+    if order not in UPLOAD_ORDERS:
+        raise_error(DEFAULT_ERROR_MESSAGES['no_order'])
+
+    claim = get_option(app_args, config, '-claim', 'claim', '')
+    if claim and claim not in CLAIM_MODES:
+        raise_error(DEFAULT_ERROR_MESSAGES['no_claim'])
+    claim_timeout = get_number_option(app_args, config, '-claim_timeout', 'claim_timeout', DEFAULT_CLAIM_TIMEOUT, float)
+    claim_dir = get_option(app_args, config, '-claim_dir', 'claim_dir', '')
+    instance = get_option(app_args, config, '-instance', 'instance', '%s-%s' % (socket.gethostname(), os.getpid()))
+    shard = parse_shard(get_option(app_args, config, '-shard', 'shard', ''))
+
+    watch = get_flag_option(app_args, config, '-watch', 'watch')
+    watch_settle = get_number_option(app_args, config, '-watch_settle', 'watch_settle', DEFAULT_WATCH_SETTLE, float)
+    watch_interval = get_number_option(
+        app_args, config, '-watch_interval', 'watch_interval', DEFAULT_WATCH_INTERVAL, float
+    )
+
+    chunk_url = get_option(app_args, config, '-chunk_url', 'chunk_url', '')
+    chunk_size = max(get_number_option(app_args, config, '-chunk_size', 'chunk_size', DEFAULT_CHUNK_SIZE), 1)
+    chunk_threshold = get_number_option(
+        app_args, config, '-chunk_threshold', 'chunk_threshold', DEFAULT_CHUNK_THRESHOLD
+    )
+
+    batch_url = get_option(app_args, config, '-batch_url', 'batch_url', '')
+    batch_files = max(get_number_option(app_args, config, '-batch_files', 'batch_files', DEFAULT_BATCH_FILES), 1)
+    batch_size = get_number_option(app_args, config, '-batch_size', 'batch_size', DEFAULT_BATCH_SIZE)
+
+    adaptive_concurrency = get_flag_option(app_args, config, '-adaptive', 'adaptive_concurrency')
+    concurrency_min = get_number_option(
+        app_args, config, '-concurrency_min', 'concurrency_min', DEFAULT_CONCURRENCY_MIN
+    )
+    # Highest limit is the number of async uploads, or workers when more than one is asked for, unless given
+    concurrency_max = get_number_option(app_args, config, '-concurrency_max', 'concurrency_max', 0)
+    if adaptive_concurrency:
+        if not concurrency_max:
+            if async_engine:
+                concurrency_max = async_concurrency
+            else:
+                concurrency_max = workers if workers > DEFAULT_WORKERS else DEFAULT_CONCURRENCY_MAX
+        if concurrency_max <= concurrency_min:
+            raise_error(DEFAULT_ERROR_MESSAGES['no_concurrency_range'])
+        if async_engine:
+            async_concurrency = concurrency_max
+        else:
+            workers = concurrency_max
+
+    pool_size = get_number_option(app_args, config, '-pool_size', 'pool_size', DEFAULT_POOL_SIZE)
+    pool_idle_timeout = get_number_option(
+        app_args, config, '-pool_idle_timeout', 'pool_idle_timeout', DEFAULT_POOL_IDLE_TIMEOUT, float
+    )
+    # Keeping a connection for every worker
+    pool_size = max(pool_size, workers)
+    expect_threshold = get_number_option(
+        app_args, config, '-expect_threshold', 'expect_threshold', DEFAULT_EXPECT_THRESHOLD
+    )
+    expect_timeout = get_number_option(
+        app_args, config, '-expect_timeout', 'expect_timeout', DEFAULT_EXPECT_TIMEOUT, float
+    )
+
+    prefetch_budget = get_number_option(
+        app_args, config, '-prefetch_budget', 'prefetch_budget', DEFAULT_PREFETCH_BUDGET
+    )
+
+
+    targets = get_option(app_args, config, '-targets', 'targets', '')
+    targets = [chapter.strip() for chapter in targets.split(',') if chapter.strip()]
+    if targets and async_engine:
+        # Every file is sent to targets from threads of its own
+        if not silent:
+            print 'Fan-out to several targets uses upload workers, -async is not used.'
+        async_engine = False
+
     # Other miscellaneous error handling
+    roots = []
+    matcher = None
     if directory:
-        if not os.path.isdir(directory):
-            raise_error(DEFAULT_ERROR_MESSAGES['no_proper_data'])
-        if not file_type:
+        # Several directories are separated like in PATH, e.g. /mnt/scans:/mnt/archive
+        roots = [root for root in directory.split(os.pathsep) if root]
+        for root in roots:
+            if not os.path.isdir(root):
+                raise_error(DEFAULT_ERROR_MESSAGES['no_proper_data'])
+        if not file_type and not include:
             raise_error(DEFAULT_ERROR_MESSAGES['no_filetype'])
-    if not mimetype:
+        matcher = FileMatcher(file_type, split_rules(include), split_rules(exclude))
+        if claim == CLAIM_RENAME and len(roots) > 1:
+            raise_error(DEFAULT_ERROR_MESSAGES['no_claim_roots'])
+    if mimetype == '':
         raise_error(DEFAULT_ERROR_MESSAGES['no_mimetype'])
     if not username:
         raise_error(DEFAULT_ERROR_MESSAGES['no_username'])
@@ -702,22 +5360,159 @@ if __name__ == '__main__':
         'silent': silent,
         'fileinfo_loc': fileinfo_loc,
         'config_retry_on_errors': config_retry_on_errors,
+        'retry_max_attempts': retry_max_attempts,
+        'retry_base_delay': retry_base_delay,
+        'retry_max_delay': retry_max_delay,
+        'compress': compress,
+        'compress_threshold': compress_threshold,
+        'compress_level': compress_level,
+        'compress_skip': compress_skip,
+        'compression_stats': CompressionStats(),
+        'zero_copy': zero_copy,
+        'pool_size': pool_size,
+        'pool_idle_timeout': pool_idle_timeout,
+        'expect_threshold': expect_threshold,
+        'expect_timeout': expect_timeout,
+        'dedup_remove': dedup_remove,
+        'chunk_url': chunk_url,
+        'chunk_size': chunk_size,
+        'chunk_threshold': chunk_threshold,
+        'batch_url': batch_url,
+        'batch_files': batch_files,
+        'batch_size': batch_size,
     }
+    if dedup:
+        options['dedup'] = DedupIndex(dedup_index)
+    if adaptive_concurrency:
+        options['concurrency_controller'] = ConcurrencyController(concurrency_min, concurrency_max, silent)
+    options['opener'] = build_opener(options)
+    pool = options['opener'].pool
+    METRICS.add_source('pool_', lambda: dict(pool.stats))
+    if metrics_file:
+        # Written every metrics_interval seconds and at exit, also when stopped by an error
+        atexit.register(MetricsExporter(metrics_file, metrics_format, metrics_interval).close)
+    if prefetch_budget > 0 and not async_engine and not targets:
+        # Files sent in chunks are read by chunks
+        options['prefetcher'] = Prefetcher(prefetch_budget, chunk_url and chunk_threshold - 1)
+        prefetcher = options['prefetcher']
+        METRICS.add_source('prefetch_', lambda: dict(prefetcher.stats))
+    if claim and directory:
+        options['claims'] = WorkClaims(roots[0], claim, instance, claim_timeout, claim_dir)
+        # Files failed are given back also when stopped by an error
+        atexit.register(options['claims'].close)
+    if targets:
+        options['fanout'] = FanOut(
+            [get_fanout_target(chapter, options, config_file_name, cfg_chapter or DEFAULT_CFG_CHAPTER)
+             for chapter in targets],
+            silent,
+        )
+        # Files are checked on every target right after upload
+        verify_mode = VERIFY_INLINE
+        if not silent:
+            print 'Uploading to targets: %s' % ', '.join(targets)
 
     # Calling main send function for either one file or directory with directory walker
-    if filename:
-        upload_file(filename, options)
-    elif directory:
-        options['opener'] = build_opener(options)
-        filenames = walk_directory(directory, file_type)
+    if agent:
+        if not agent_socket:
+            raise_error(DEFAULT_ERROR_MESSAGES['no_agent_socket'])
+        if not roots:
+            raise_error(DEFAULT_ERROR_MESSAGES['no_agent_dir'])
+        options['agent'] = UploadAgent(agent_socket, roots, matcher)
         if not silent:
-            print 'Sending files: %s' % filenames
-        if not filenames:
+            print 'Upload agent listening on: %s' % agent_socket
+        try:
+            upload_files(options['agent'].files(), options, workers)
+        except KeyboardInterrupt:
+            if not silent:
+                print 'Upload agent stopped.'
+        options['agent'].close()
+    elif filename:
+        if config_retry_on_errors:
+            retry_upload(retry_max_attempts, filename, options)
+        else:
+            upload_file(filename, options)
+    elif directory and watch:
+        if fileinfo_loc and verify_mode != VERIFY_INLINE:
+            options['verifier'] = RevisionVerifier(options, verify_mode, verify_sample)
+        if not silent:
+            print 'Watching for new files in: %s' % directory
+        filenames = watch_directory(roots, matcher, watch_settle, watch_interval)
+        if shard:
+            filenames = shard_files(filenames, roots[0], *shard)
+        if claim:
+            filenames = options['claims'].claim_files(filenames)
+        try:
+            upload_files(filenames, options, workers)
+        except KeyboardInterrupt:
+            if not silent:
+                print 'Stopped watching directory.'
+        if 'verifier' in options:
+            options['verifier'].close()
+    elif directory:
+        snapshot = None
+        if snapshot_file:
+            snapshot = DirectorySnapshot(snapshot_file, roots, matcher, full_scan='-full_scan' in app_args)
+            options['snapshot'] = snapshot
+        filenames = walk_directory(roots, matcher, snapshot, order, scan_threads)
+        if shard:
+            filenames = shard_files(filenames, roots[0], *shard)
+        if claim:
+            filenames = options['claims'].claim_files(filenames)
+        first_file = next(filenames, None)
+        if first_file is None:
+            if snapshot:
+                snapshot.save()
             if not silent:
                 print 'Nothing to send in this directory.'
             sys.exit(0)
-        for name in filenames:
-            if config_retry_on_errors:
-                retry_upload(UPLOAD_RETRIES_COUNT, name, options)
-            else:
-                upload_file(name, options)
+        if not silent:
+            print 'Sending files from: %s' % directory
+        filenames = itertools.chain([first_file], filenames)
+        if fileinfo_loc and verify_mode != VERIFY_INLINE:
+            options['verifier'] = RevisionVerifier(options, verify_mode, verify_sample)
+        if async_engine:
+            upload_stats = AsyncUploadEngine(options, async_concurrency).run(filenames)
+        else:
+            upload_stats = upload_files(filenames, options, workers)
+        summary = format_upload_stats(upload_stats)
+        write_successlog(summary, message='Directory upload finished:')
+        if not silent:
+            print summary
+        if adaptive_concurrency:
+            summary = options['concurrency_controller'].format()
+            write_successlog(summary, message='ADAPTIVE CONCURRENCY:')
+            if not silent:
+                print summary
+        if targets:
+            summary = options['fanout'].format()
+            write_successlog(summary, message='Fan-out targets:')
+            if not silent:
+                print summary
+        if 'prefetcher' in options:
+            summary = options['prefetcher'].format()
+            write_successlog(summary, message='Read-ahead prefetch:')
+            if not silent:
+                print summary
+        if options['compression_stats'].files:
+            summary = options['compression_stats'].format()
+            write_successlog(summary, message='Upload compression:')
+            if not silent:
+                print summary
+        if 'verifier' in options:
+            summary = format_verify_stats(options['verifier'].close())
+            write_successlog(summary, message='Uploaded files check finished:')
+            if not silent:
+                print summary
+        if snapshot:
+            snapshot.save()
+    if dedup:
+        options['dedup'].close()
+    if targets:
+        options['fanout'].close()
+    if 'claims' in options:
+        options['claims'].close()
+    if 'prefetcher' in options:
+        options['prefetcher'].close()
+    options['opener'].pool.close()
+    if not silent and options['opener'].pool.stats['requests']:
+        print format_pool_stats(options['opener'].pool)
@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+"""
+Module: Adlibre DMS File Upload Client stand-in server
+Project: Adlibre DMS File Upload Client
+Copyright: Adlibre Pty Ltd 2012
+License: See LICENSE for license information
+
+Minimal local imitation of the Adlibre DMS API, used to try the client without a real DMS.
+
+Implements:
+    POST <url><file name>               multipart file upload, returns the stored file name in json
+    GET <fileinfo location><code>       returns number of revisions stored for the code
+    POST <chunk url><file name>         starts chunked upload (X-Upload-Length header is the file size)
+    GET <chunk url><upload id>          returns {"offset": bytes received}
+    PUT <chunk url><upload id>          stores a part given with Content-Range header
+    POST <chunk url><upload id>/complete  finishes chunked upload
+    POST <batch url>                    multipart upload of several files, returns json list of per file results
+
+Uploaded content is not stored, only counted and hashed.
+Requests with 'Expect: 100-continue' header get '100 Continue' when the body is about to be read,
+or the final response without reading the body, if they are rejected before (e.g. for wrong credentials).
+Latency, error rate and bandwidth of the API can be set, to try the client in conditions close to real ones.
+
+Usage:
+    python mock_dms_server.py -p 8000
+    python mock_dms_server.py -p 8000 --user admin --password admin --chunk-fail-rate 0.3
+    python mock_dms_server.py -p 8000 --latency 0.05 --error-rate 0.01 --bandwidth 1048576
+"""
+
+import BaseHTTPServer
+import SocketServer
+import StringIO
+import base64
+import cgi
+import hashlib
+import itertools
+import json
+import optparse
+import random
+import re
+import sys
+import threading
+import time
+import zlib
+
+
+DEFAULT_PORT = 8000
+READ_BLOCK_SIZE = 64 * 1024
+CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+class DMSState(object):
+    """Shared state of the server: revision counters and chunked uploads in progress"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.revisions = {}
+        self.uploads = {}
+        self.upload_ids = itertools.count(1)
+        # Seconds spent on every file upload request, from request line read to response sent
+        self.latencies = []
+        self.errors = 0
+        self.received = 0
+        # Files stored since stats reset
+        self.stored = 0
+
+    def store(self, file_name):
+        code = file_name.rsplit('.', 1)[0]
+        with self.lock:
+            self.revisions[code] = self.revisions.get(code, 0) + 1
+            self.stored += 1
+
+    def record(self, seconds, size, error=False):
+        with self.lock:
+            self.latencies.append(seconds)
+            self.received += size
+            if error:
+                self.errors += 1
+
+    def reset_stats(self):
+        with self.lock:
+            self.latencies = []
+            self.errors = 0
+            self.received = 0
+            self.stored = 0
+
+    def revision_count(self, code):
+        with self.lock:
+            return self.revisions.get(code, 0)
+
+    def start_upload(self, file_name, size):
+        with self.lock:
+            upload_id = str(self.upload_ids.next())
+            self.uploads[upload_id] = {'name': file_name, 'size': size, 'offset': 0, 'hash': hashlib.sha1()}
+        return upload_id
+
+
+class DMSRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'MockDMS/1.0'
+    # Response is written out at once, not header by header
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def parse_request(self):
+        self.started = time.time()
+        return BaseHTTPServer.BaseHTTPRequestHandler.parse_request(self)
+
+    def log_message(self, format, *args):
+        if self.server.options.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def reply(self, code, data, headers=None):
+        body = json.dumps(data)
+        self.send_response(code)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def expects_continue(self):
+        return self.headers.get('Expect', '').lower() == '100-continue' and self.server.options.expect_continue
+
+    def read_body(self, digest=None, output=None):
+        """Reads request body, returns its size. Body is written to output file, if given.
+
+        Chunked transfer encoding and gzip content encoding are decoded."""
+        if self.expects_continue():
+            self.wfile.write('%s 100 Continue\r\n\r\n' % self.protocol_version)
+            self.wfile.flush()
+        decompressor = None
+        if self.headers.get('Content-Encoding') == 'gzip':
+            decompressor = zlib.decompressobj(GZIP_WBITS)
+        size = 0
+        for block in self.read_blocks():
+            if decompressor is not None:
+                block = decompressor.decompress(block)
+            if digest is not None:
+                digest.update(block)
+            if output is not None:
+                output.write(block)
+            size += len(block)
+        return size
+
+    def read_blocks(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                length = int(self.rfile.readline().split(';', 1)[0], 16)
+                if not length:
+                    # Skipping trailer
+                    while self.rfile.readline().strip():
+                        pass
+                    return
+                for block in self.read_exactly(length):
+                    yield block
+                self.rfile.readline()
+        else:
+            for block in self.read_exactly(int(self.headers.get('Content-Length', 0))):
+                yield block
+
+    def read_exactly(self, left):
+        bandwidth = self.server.options.bandwidth
+        started = time.time()
+        received = 0
+        while left > 0:
+            block = self.rfile.read(min(left, READ_BLOCK_SIZE))
+            if not block:
+                return
+            left -= len(block)
+            received += len(block)
+            if bandwidth:
+                # Slowing reading down to the bandwidth of the connection
+                delay = started + float(received) / bandwidth - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            yield block
+
+    def delay(self):
+        """Waits as long as API latency option says"""
+        if self.server.options.latency:
+            time.sleep(self.server.options.latency)
+
+    def authorized(self):
+        options = self.server.options
+        if not options.user:
+            return True
+        expected = 'Basic ' + base64.b64encode('%s:%s' % (options.user, options.password))
+        if self.headers.get('Authorization') == expected:
+            return True
+        if self.expects_continue():
+            # Body is not sent by client, connection can not be used for next requests
+            self.close_connection = 1
+        else:
+            self.read_body()
+        self.send_response(401)
+        self.send_header('WWW-Authenticate', 'Basic realm="DMS"')
+        self.send_header('Content-Length', '0')
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        return False
+
+    def route(self):
+        """Returns (endpoint, argument) for the request path"""
+        path = self.path.split('?', 1)[0]
+        options = self.server.options
+        for endpoint, prefix in (
+            ('batch', options.batch_url),
+            ('chunk', options.chunk_url),
+            ('file', options.url),
+            ('fileinfo', options.fileinfo_location),
+        ):
+            if prefix and path.startswith(prefix):
+                return endpoint, path[len(prefix):]
+        return None, path
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        endpoint, argument = self.route()
+        if endpoint == 'fileinfo':
+            self.delay()
+            return self.reply(200, self.server.state.revision_count(argument))
+        if endpoint == 'chunk':
+            upload = self.server.state.uploads.get(argument)
+            if upload is None:
+                return self.reply(404, {'error': 'unknown upload'})
+            return self.reply(200, {'offset': upload['offset']})
+        self.reply(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+        endpoint, argument = self.route()
+        state = self.server.state
+        if endpoint == 'file':
+            size = self.read_body()
+            if self.headers.get('Content-Encoding') == 'gzip':
+                self.log_message('Compressed upload of %s, %s bytes', argument, size)
+            self.delay()
+            if random.random() < self.server.options.error_rate:
+                self.reply(503, {'error': 'simulated failure'}, {'Retry-After': self.server.options.retry_after})
+                state.record(time.time() - self.started, size, error=True)
+                return
+            state.store(argument)
+            self.reply(200, argument)
+            state.record(time.time() - self.started, size)
+            return
+        if endpoint == 'batch':
+            return self.upload_batch()
+        if endpoint == 'chunk' and argument.endswith('/complete'):
+            self.read_body()
+            upload_id = argument[:-len('/complete')]
+            upload = state.uploads.get(upload_id)
+            if upload is None:
+                return self.reply(404, {'error': 'unknown upload'})
+            if upload['offset'] != upload['size']:
+                return self.reply(409, {'error': 'incomplete', 'offset': upload['offset']})
+            del state.uploads[upload_id]
+            state.store(upload['name'])
+            sys.stderr.write('Chunked upload of %s completed, sha1 %s\n' % (upload['name'], upload['hash'].hexdigest()))
+            return self.reply(200, upload['name'])
+        if endpoint == 'chunk':
+            self.read_body()
+            try:
+                size = int(self.headers.get('X-Upload-Length'))
+            except (TypeError, ValueError):
+                return self.reply(400, {'error': 'X-Upload-Length header required'})
+            return self.reply(200, {'upload_id': state.start_upload(argument, size), 'offset': 0})
+        self.read_body()
+        self.reply(404, {'error': 'not found'})
+
+    def upload_batch(self):
+        """Stores every file of the multipart form, failing each one with error rate option chance"""
+        body = StringIO.StringIO()
+        size = self.read_body(output=body)
+        body.seek(0)
+        form = cgi.FieldStorage(
+            fp=body,
+            headers={'content-type': self.headers.get('Content-Type', ''), 'content-length': str(size)},
+            environ={'REQUEST_METHOD': 'POST'},
+        )
+        files = form['file'] if 'file' in form else []
+        if not isinstance(files, list):
+            files = [files]
+        self.delay()
+        results = []
+        state = self.server.state
+        for item in files:
+            if random.random() < self.server.options.error_rate:
+                results.append({'file': item.filename, 'error': 'simulated failure'})
+            else:
+                state.store(item.filename)
+                results.append({'file': item.filename, 'code': item.filename})
+        self.log_message('Batch of %s files, %s bytes', len(files), size)
+        self.reply(200, results)
+        state.record(time.time() - self.started, size)
+
+    def do_PUT(self):
+        if not self.authorized():
+            return
+        endpoint, argument = self.route()
+        upload = self.server.state.uploads.get(argument) if endpoint == 'chunk' else None
+        if upload is None:
+            self.read_body()
+            return self.reply(404, {'error': 'unknown upload'})
+        match = CONTENT_RANGE_RE.match(self.headers.get('Content-Range', ''))
+        if not match or int(match.group(1)) != upload['offset'] or int(match.group(3)) != upload['size']:
+            self.read_body()
+            return self.reply(416, {'offset': upload['offset']})
+        if random.random() < self.server.options.chunk_fail_rate:
+            # Part is received but lost, like on a broken connection
+            self.read_body()
+            return self.reply(503, {'error': 'simulated failure'})
+        digest = upload['hash'].copy()
+        received = self.read_body(digest)
+        if received != int(match.group(2)) - int(match.group(1)) + 1:
+            return self.reply(400, {'offset': upload['offset']})
+        upload['hash'] = digest
+        upload['offset'] += received
+        self.reply(200, {'offset': upload['offset']})
+
+
+class DMSServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+    def __init__(self, address, options):
+        BaseHTTPServer.HTTPServer.__init__(self, address, DMSRequestHandler)
+        self.options = options
+        self.state = DMSState()
+
+
+def parse_options(argv):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-p', '--port', type='int', default=DEFAULT_PORT)
+    parser.add_option('-b', '--bind', default='127.0.0.1')
+    parser.add_option('--url', default='/api/file/', help='file upload API location')
+    parser.add_option('--fileinfo-location', default='/api/revision_count/', help='file revisions API location')
+    parser.add_option('--chunk-url', default='/api/chunked/', help='chunked upload API location, empty disables it')
+    parser.add_option('--batch-url', default='/api/files/', help='bulk upload API location, empty disables it')
+    parser.add_option('--user', default='', help='require Basic auth with this user')
+    parser.add_option('--password', default='')
+    parser.add_option('--chunk-fail-rate', type='float', default=0.0, help='share of chunks to fail, 0..1')
+    parser.add_option('--latency', type='float', default=0.0, help='seconds to wait before answering API calls')
+    parser.add_option('--error-rate', type='float', default=0.0, help='share of file uploads to fail with 503, 0..1')
+    parser.add_option('--retry-after', type='int', default=1, help='Retry-After seconds of failed uploads')
+    parser.add_option('--bandwidth', type='int', default=0, help='upload bytes/s of a connection, 0 is unlimited')
+    parser.add_option('--no-expect', dest='expect_continue', action='store_false', default=True,
+                      help='ignore Expect: 100-continue header, like servers not supporting it')
+    parser.add_option('-v', '--verbose', action='store_true', default=False, help='log every request')
+    options, args = parser.parse_args(argv)
+    return options
+
+
+if __name__ == '__main__':
+    options = parse_options(sys.argv[1:])
+    server = DMSServer((options.bind, options.port), options)
+    print 'Mock DMS listening on http://%s:%s/' % (options.bind, options.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass